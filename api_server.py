@@ -1,7 +1,45 @@
-from app import webserver
-# Your code will go in the app/ directory.
-# Have a look in:
-#   * __init__.py
-#   * routes.py
-#   * data_ingestor.py
-#   * task_runner.py
+import os
+import socket
+
+def serve(host, port, processes):
+    '''Serve the app from processes pre-forked server processes accepting connections on one
+    shared listening socket. Every process loads the dataset and runs its own pool, and they
+    share the jobs and results through the TP_JOB_STORE database (jobs.db by default).'''
+    os.environ.setdefault("TP_JOB_STORE", "jobs.db")
+    listener = socket.create_server((host, port), backlog=1024)
+
+    children = []
+    for _ in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            # Imported after the fork, so that every process starts its own threads
+            from werkzeug.serving import make_server
+            from app import webserver
+
+            make_server(host, port, webserver, threaded=True, fd=listener.fileno()).serve_forever()
+            os._exit(0)
+        children.append(pid)
+
+    listener.close()
+    for pid in children:
+        os.waitpid(pid, 0)
+
+if __name__ == "__main__":
+    # TP_PROCESSES=<n> pre-forks n server processes
+    processes = int(os.environ.get("TP_PROCESSES", 1))
+    host = os.environ.get("TP_HOST", "127.0.0.1")
+    port = int(os.environ.get("TP_PORT", 5000))
+
+    if processes > 1:
+        serve(host, port, processes)
+    else:
+        from app import webserver
+        webserver.run(host, port, threaded=True)
+else:
+    # Your code will go in the app/ directory.
+    # Have a look in:
+    #   * __init__.py
+    #   * routes.py
+    #   * data_ingestor.py
+    #   * task_runner.py
+    from app import webserver
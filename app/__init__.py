@@ -1,17 +1,41 @@
 import os
+from threading import Lock
 from flask import Flask
 from app.data_ingestor import DataIngestor
 from app.task_runner import ThreadPool
+from app.process_pool import ProcessPool
 
-if not os.path.exists('results'):
-    os.mkdir('results')
+# Held while the app is created, so that it is only created once
+webserver_lock = Lock()
 
-webserver = Flask(__name__)
+def create_webserver():
+    '''Load the dataset, start the pool and register the routes of the app.'''
+    if not os.path.exists('results'):
+        os.mkdir('results')
 
-webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv")
+    webserver = Flask(__name__)
 
-webserver.tasks_runner = ThreadPool(webserver.data_ingestor.data, webserver.data_ingestor)
+    # TP_CSV_PATH serves another CSV (e.g. one made by the generator of app/client.py)
+    webserver.data_ingestor = DataIngestor(os.environ.get("TP_CSV_PATH", "./nutrition_activity_obesity_usa_subset.csv"))
 
-webserver.job_counter = 1
+    # TP_BACKEND=process runs the jobs in worker processes instead of threads
+    if os.environ.get("TP_BACKEND") == "process":
+        webserver.tasks_runner = ProcessPool(webserver.data_ingestor.data, webserver.data_ingestor)
+    else:
+        webserver.tasks_runner = ThreadPool(webserver.data_ingestor.data, webserver.data_ingestor)
 
-from app import routes
+    # Set before the routes are imported, they register themselves on it
+    globals()["webserver"] = webserver
+    from app import routes
+    return webserver
+
+def __getattr__(name):
+    '''Create the app on the first "from app import webserver", so that importing a module of
+    the package (e.g. app/client.py) neither loads the dataset nor starts the pool.'''
+    if name == "webserver":
+        with webserver_lock:
+            # Another thread may have created it while this one waited for the lock
+            if "webserver" not in globals():
+                create_webserver()
+        return globals()["webserver"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
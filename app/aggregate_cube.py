@@ -0,0 +1,144 @@
+import math
+
+# Single NaN object used for every missing stratification, so that the missing
+# values of a question all fall into the same group
+MISSING = float("nan")
+
+def normalize_missing(value):
+    '''Replace a NaN value with the shared MISSING object.'''
+    if isinstance(value, float) and math.isnan(value):
+        return MISSING
+    return value
+
+def is_missing(value):
+    '''Check if a stratification value is missing.'''
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+class AggregateCube:
+    '''(sum, count) aggregates of Data_Value keyed by question, state, stratification category
+    and stratification, together with their per-state and per-question roll-ups.'''
+    def __init__(self):
+        # question -> state -> (category, stratification) -> [sum, count]
+        self.cells = {}
+        # question -> state -> [sum, count]
+        self.states = {}
+        # question -> [sum, count]
+        self.questions = {}
+        # (question, group) -> means of the groups, filled by means
+        self.means_cache = {}
+
+    def add(self, question, state, category, stratification, value):
+        '''Add one row to the cube.'''
+        key = (normalize_missing(category), normalize_missing(stratification))
+
+        question_cells = self.cells.setdefault(question, {})
+        cell = question_cells.setdefault(state, {}).setdefault(key, [0, 0])
+        cell[0] += value
+        cell[1] += 1
+
+        state_totals = self.states.setdefault(question, {}).setdefault(state, [0, 0])
+        state_totals[0] += value
+        state_totals[1] += 1
+
+        question_totals = self.questions.setdefault(question, [0, 0])
+        question_totals[0] += value
+        question_totals[1] += 1
+
+        self.forget_means(question)
+
+    def forget_means(self, question):
+        '''Drop the cached means of a question, after rows were added to it.'''
+        if self.means_cache:
+            self.means_cache.pop((question, "state"), None)
+            self.means_cache.pop((question, "stratification"), None)
+
+    def copy(self, questions):
+        '''Copy the cube to add rows of the given questions to the copy. Only the aggregates of
+        these questions are copied, the others are shared with this cube.'''
+        cube = AggregateCube()
+        cube.cells = dict(self.cells)
+        cube.states = dict(self.states)
+        cube.questions = dict(self.questions)
+        # Copied first (atomically), the readers keep caching means while it is filtered
+        cube.means_cache = {key: means for key, means in dict(self.means_cache).items()
+                            if key[0] not in questions}
+
+        for question in questions:
+            if question in self.questions:
+                cube.cells[question] = {state: {key: list(cell) for key, cell in strata.items()}
+                                        for state, strata in self.cells[question].items()}
+                cube.states[question] = {state: list(totals)
+                                         for state, totals in self.states[question].items()}
+                cube.questions[question] = list(self.questions[question])
+
+        return cube
+
+    def export(self):
+        '''Export the aggregates as JSON serializable lists, in insertion order. They are nested
+        by question and state, so that every question and state is only written once.'''
+        return {
+            "cells": [[question, [[state, [[category, stratification, cell[0], cell[1]]
+                                           for (category, stratification), cell in strata.items()]]
+                                  for state, strata in states.items()]]
+                      for question, states in self.cells.items()],
+            "states": [[question, [[state, totals[0], totals[1]] for state, totals in states.items()]]
+                       for question, states in self.states.items()],
+            "questions": [[question, totals[0], totals[1]]
+                          for question, totals in self.questions.items()],
+        }
+
+    @classmethod
+    def from_export(cls, exported):
+        '''Rebuild a cube from the lists of export.'''
+        cube = cls()
+
+        for question, states in exported["cells"]:
+            cube.cells[normalize_missing(question)] = {
+                normalize_missing(state): {
+                    (normalize_missing(category), normalize_missing(stratification)): [total, count]
+                    for category, stratification, total, count in strata
+                }
+                for state, strata in states
+            }
+
+        for question, states in exported["states"]:
+            cube.states[normalize_missing(question)] = {normalize_missing(state): [total, count]
+                                                        for state, total, count in states}
+
+        for question, total, count in exported["questions"]:
+            cube.questions[normalize_missing(question)] = [total, count]
+
+        return cube
+
+    def question_totals(self, question):
+        '''Get the [sum, count] of a question, or None if the question is unknown.'''
+        return self.questions.get(question)
+
+    def state_totals(self, question):
+        '''Get the [sum, count] of every state for a question, in order of appearance.'''
+        return self.states.get(question, {})
+
+    def strata(self, question):
+        '''Get the [sum, count] of every (state, category, stratification) group of a question.'''
+        return self.cells.get(question, {})
+
+    def means(self, question, group):
+        '''Get the (key, mean) pairs of the groups of a question, in order of appearance:
+        the states for the "state" group and the (state, category, stratification) triples
+        with a stratification for the "stratification" group. Computed once per question.'''
+        cache_key = (question, group)
+        means = self.means_cache.get(cache_key)
+        if means is not None:
+            return means
+
+        if group == "state":
+            means = [(state, totals[0] / totals[1])
+                     for state, totals in self.state_totals(question).items()]
+        else:
+            means = [((state, category, stratification), totals[0] / totals[1])
+                     for state, strata in self.strata(question).items()
+                     for (category, stratification), totals in strata.items()
+                     if not is_missing(category) and not is_missing(stratification)]
+
+        self.means_cache[cache_key] = means
+        return means
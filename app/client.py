@@ -1,40 +1,459 @@
-import requests
+'''Load generator for the webserver.
 
-url = 'http://localhost:5000/api/state_mean'
-data = {
-    "question": "Percent of adults who report consuming fruit less than one time daily",
-    "state": "Wyoming"
-}
+    python app/client.py generate --rows 1000000 --output big.csv
+    python app/client.py run --clients 16 --requests 5000 --mix state_mean=3,best5=1
+    python app/client.py run --url http://localhost:5000 --rate 200 --requests 2000
+    python app/client.py sweep --sizes 1000,100000,10000000
+
+Without --url, the requests go to the app imported in this process through Flask test
+clients (run it from the directory holding the CSV, or pass --csv). The report holds the
+throughput, the submit-to-result latency percentiles and the queue depth over time.'''
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
 
-x = requests.post(url, json=data)
+# Run as a script, the app package is in the parent directory of this file
+if not __package__:
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-print(x.text)
+# Importing them does not load the app, which is only created by import_webserver
+from app.data_ingestor import QUESTIONS_BEST_IS_MIN, QUESTIONS_BEST_IS_MAX
+from app.result_cache import STATE_JOB_TYPES
+from app.task_runner import JOB_TYPES
 
-url = 'http://localhost:5000/api/state_mean'
+QUESTIONS = QUESTIONS_BEST_IS_MIN + QUESTIONS_BEST_IS_MAX
+
+# State name -> abbreviation, as in the LocationDesc and LocationAbbr columns
+STATES = {
+    "Alabama": "AL", "Alaska": "AK", "Arizona": "AZ", "Arkansas": "AR", "California": "CA",
+    "Colorado": "CO", "Connecticut": "CT", "Delaware": "DE", "District of Columbia": "DC",
+    "Florida": "FL", "Georgia": "GA", "Guam": "GU", "Hawaii": "HI", "Idaho": "ID",
+    "Illinois": "IL", "Indiana": "IN", "Iowa": "IA", "Kansas": "KS", "Kentucky": "KY",
+    "Louisiana": "LA", "Maine": "ME", "Maryland": "MD", "Massachusetts": "MA",
+    "Michigan": "MI", "Minnesota": "MN", "Mississippi": "MS", "Missouri": "MO",
+    "Montana": "MT", "National": "US", "Nebraska": "NE", "Nevada": "NV",
+    "New Hampshire": "NH", "New Jersey": "NJ", "New Mexico": "NM", "New York": "NY",
+    "North Carolina": "NC", "North Dakota": "ND", "Ohio": "OH", "Oklahoma": "OK",
+    "Oregon": "OR", "Pennsylvania": "PA", "Puerto Rico": "PR", "Rhode Island": "RI",
+    "South Carolina": "SC", "South Dakota": "SD", "Tennessee": "TN", "Texas": "TX",
+    "Utah": "UT", "Vermont": "VT", "Virgin Islands": "VI", "Virginia": "VA",
+    "Washington": "WA", "West Virginia": "WV", "Wisconsin": "WI", "Wyoming": "WY",
+}
 
-data = {
-    "question": "Percent of adults who report consuming fruit less than one time daily",
-    "state": "Connecticut"
+STRATIFICATIONS = {
+    "Age (years)": ["18 - 24", "25 - 34", "35 - 44", "45 - 54", "55 - 64", "65 or older"],
+    "Education": ["Less than high school", "High school graduate", "Some college or technical school",
+                  "College graduate"],
+    "Gender": ["Male", "Female"],
+    "Income": ["Less than $15,000", "$15,000 - $24,999", "$25,000 - $34,999", "$35,000 - $49,999",
+               "$50,000 - $74,999", "$75,000 or greater", "Data not reported"],
+    "Race/Ethnicity": ["Non-Hispanic White", "Non-Hispanic Black", "Hispanic", "Asian",
+                       "American Indian/Alaska Native", "2 or more races", "Other"],
+    "Total": ["Total"],
 }
 
-x = requests.post(url, json=data)
+CSV_HEADER = ["YearStart", "YearEnd", "LocationAbbr", "LocationDesc", "Datasource", "Question",
+              "Data_Value", "StratificationCategory1", "Stratification1"]
+
+def generate_csv(path, rows, seed=0, missing_rate=0.02, questions=None):
+    '''Write a synthetic CSV of the given number of rows, shaped like the survey extract,
+    asking the given questions (the survey questions by default). The rows are written as
+    they are generated, so any size fits in memory.'''
+    rng = random.Random(seed)
+    questions = questions or QUESTIONS
+    states = list(STATES.items())
+    strata = [(category, value) for category, values in STRATIFICATIONS.items() for value in values]
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+
+        for _ in range(rows):
+            year = rng.randint(2011, 2022)
+            state, abbreviation = rng.choice(states)
+            category, stratification = rng.choice(strata)
+            value = "" if rng.random() < missing_rate else round(rng.uniform(5, 60), 1)
+            writer.writerow([year, year, abbreviation, state, "BRFSS", rng.choice(questions),
+                             value, category, stratification])
+
+class FlaskClientTransport:
+    '''Send the requests to a Flask app of this process, with one test client per thread.'''
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def client(self):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.app.test_client()
+            self.local.client = client
+        return client
+
+    def post(self, path, body):
+        response = self.client().post(path, json=body)
+        return response.status_code, response.get_json(silent=True)
+
+    def get(self, path):
+        response = self.client().get(path)
+        return response.status_code, response.get_json(silent=True)
+
+class HttpTransport:
+    '''Send the requests to a running server, with one HTTP session per thread.'''
+    def __init__(self, url):
+        import requests
+
+        self.requests = requests
+        self.url = url.rstrip("/")
+        self.local = threading.local()
+
+    def session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.requests.Session()
+            self.local.session = session
+        return session
+
+    def post(self, path, body):
+        response = self.session().post(self.url + path, json=body)
+        return response.status_code, self.decode(response)
+
+    def get(self, path):
+        response = self.session().get(self.url + path)
+        return response.status_code, self.decode(response)
+
+    @staticmethod
+    def decode(response):
+        try:
+            return response.json()
+        except ValueError:
+            return None
+
+def parse_mix(text):
+    '''Parse a request mix like "state_mean=3,best5=1" (a missing weight is 1) into
+    {kind: weight}. The kinds are the job types and "batch".'''
+    if not text:
+        return {job_type: 1 for job_type in JOB_TYPES}
+
+    mix = {}
+    for item in text.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in JOB_TYPES and kind != "batch":
+            raise ValueError(f"Unknown request kind: {kind}")
+        mix[kind] = float(weight) if weight else 1.0
+    return mix
+
+def percentile(sorted_values, fraction):
+    '''Get the nearest-rank percentile of sorted values, or None if there are none.'''
+    if not sorted_values:
+        return None
+    index = min(max(math.ceil(fraction * len(sorted_values)) - 1, 0), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def summarize(latencies):
+    '''Summarize latencies in seconds into their count, mean and percentiles.'''
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "mean": sum(latencies) / len(latencies) if latencies else None,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "max": latencies[-1] if latencies else None,
+    }
+
+class LoadTest:
+    '''Drive the server with concurrent clients and measure it.
+
+    Every request submits a job (or a batch of batch_size jobs) of a kind drawn from mix and
+    then waits for its result with get_results?wait, so the submit-to-result latency includes
+    the time in the queue. With rate > 0, the requests arrive at rate per second (Poisson
+    arrivals, open loop) and their latency counts from their scheduled arrival, otherwise every
+    client sends its next request as soon as the previous one is answered (closed loop). The
+    queue depth is sampled from /api/num_jobs.'''
+    def __init__(self, transport, mix=None, clients=8, requests=1000, rate=0, wait=5,
+                 batch_size=8, questions=None, states=None, sample_interval=0.1, seed=0):
+        self.transport = transport
+        self.mix = mix or parse_mix(None)
+        self.clients = clients
+        self.requests = requests
+        self.rate = rate
+        self.wait = wait
+        self.batch_size = batch_size
+        self.questions = questions or QUESTIONS
+        self.states = states or list(STATES)
+        self.sample_interval = sample_interval
+        self.seed = seed
+
+        self.lock = threading.Lock()
+        self.next_request = itertools.count()
+        self.latencies = {}
+        self.errors = 0
+        self.depths = []
+
+    def run(self):
+        '''Run the load test and return its report.'''
+        rng = random.Random(self.seed)
+        kinds = rng.choices(list(self.mix), weights=list(self.mix.values()), k=self.requests)
+
+        # Arrival offsets of the requests, in seconds from the start
+        arrivals = [0.0] * self.requests
+        if self.rate > 0:
+            offset = 0.0
+            for i in range(self.requests):
+                offset += rng.expovariate(self.rate)
+                arrivals[i] = offset
+
+        stop = threading.Event()
+        self.start = time.monotonic()
+        sampler = threading.Thread(target=self.sample_queue, args=(stop,), daemon=True)
+        sampler.start()
+
+        threads = [threading.Thread(target=self.run_client, args=(kinds, arrivals, i))
+                   for i in range(self.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.monotonic() - self.start
+        stop.set()
+        sampler.join()
+
+        return self.report(elapsed)
+
+    def run_client(self, kinds, arrivals, client_id):
+        '''Send the requests claimed by one client.'''
+        rng = random.Random(f"{self.seed}-{client_id}")
+
+        while True:
+            with self.lock:
+                i = next(self.next_request)
+            if i >= len(kinds):
+                break
+
+            delay = self.start + arrivals[i] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            kind = kinds[i]
+            # In open loop, the latency counts from the scheduled arrival, so that a request
+            # sent late because the clients were all busy still counts the time it waited
+            start = self.start + arrivals[i] if self.rate > 0 else time.monotonic()
+            ok = self.submit_batch(rng) if kind == "batch" else self.submit_job(kind, rng)
+            latency = time.monotonic() - start
+
+            with self.lock:
+                if ok:
+                    self.latencies.setdefault(kind, []).append(latency)
+                else:
+                    self.errors += 1
+
+    def job_body(self, job_type, rng):
+        '''Build the body of a job request.'''
+        body = {"question": rng.choice(self.questions)}
+        if job_type in STATE_JOB_TYPES:
+            body["state"] = rng.choice(self.states)
+        return body
+
+    def submit_job(self, job_type, rng):
+        '''Submit a job and wait for its result. Returns True if it succeeded.'''
+        status, body = self.transport.post(f"/api/{job_type}", self.job_body(job_type, rng))
+        if status != 200 or not body or "job_id" not in body:
+            return False
+        return self.wait_for(body["job_id"])
+
+    def submit_batch(self, rng):
+        '''Submit a batch of jobs and wait for all their results. Returns True if all succeeded.'''
+        jobs = []
+        for job_type in rng.choices(JOB_TYPES, k=self.batch_size):
+            job = self.job_body(job_type, rng)
+            job["job_type"] = job_type
+            jobs.append(job)
+
+        status, body = self.transport.post("/api/batch", {"jobs": jobs})
+        if status != 200 or not body or "job_ids" not in body:
+            return False
+        return all([self.wait_for(job_id) for job_id in body["job_ids"]])
+
+    def wait_for(self, job_id):
+        '''Wait until a job is done. Returns True if its result was received.'''
+        while True:
+            status, body = self.transport.get(f"/api/get_results/{job_id}?wait={self.wait}")
+            if status != 200 or not body:
+                return False
+            if body.get("status") != "running":
+                return body.get("status") == "done"
+
+    def sample_queue(self, stop):
+        '''Sample the queue depth until stop is set.'''
+        while not stop.is_set():
+            status, body = self.transport.get("/api/num_jobs")
+            if status == 200 and body:
+                self.depths.append((round(time.monotonic() - self.start, 3), body["data"]))
+            stop.wait(self.sample_interval)
+
+    def report(self, elapsed):
+        '''Build the report of the finished run.'''
+        all_latencies = [latency for latencies in self.latencies.values() for latency in latencies]
+        depths = [depth for _, depth in self.depths]
+
+        return {
+            "requests": self.requests,
+            "completed": len(all_latencies),
+            "errors": self.errors,
+            "clients": self.clients,
+            "rate": self.rate,
+            "elapsed": elapsed,
+            "throughput": len(all_latencies) / elapsed if elapsed > 0 else None,
+            "latency": summarize(all_latencies),
+            "by_kind": {kind: summarize(latencies) for kind, latencies in sorted(self.latencies.items())},
+            "queue_depth": {
+                "max": max(depths) if depths else None,
+                "mean": sum(depths) / len(depths) if depths else None,
+                "samples": self.depths,
+            },
+        }
+
+def format_seconds(seconds):
+    '''Format a duration in milliseconds.'''
+    return "-" if seconds is None else f"{seconds * 1000:.2f}ms"
+
+def print_report(report, out=sys.stdout):
+    '''Print a report in a readable form.'''
+    latency = report["latency"]
+    print(f"{report['completed']}/{report['requests']} requests in {report['elapsed']:.2f}s "
+          f"({report['errors']} errors), {report['throughput'] or 0:.1f} requests/s", file=out)
+    print(f"submit-to-result: p50 {format_seconds(latency['p50'])}, "
+          f"p95 {format_seconds(latency['p95'])}, p99 {format_seconds(latency['p99'])}, "
+          f"max {format_seconds(latency['max'])}", file=out)
+
+    for kind, summary in report["by_kind"].items():
+        print(f"  {kind:<24} {summary['count']:>7}  p50 {format_seconds(summary['p50']):>10}  "
+              f"p95 {format_seconds(summary['p95']):>10}  p99 {format_seconds(summary['p99']):>10}",
+              file=out)
+
+    depth = report["queue_depth"]
+    print(f"queue depth: max {depth['max']}, mean {depth['mean'] or 0:.1f}", file=out)
+    # About 20 evenly spaced samples show how the queue grows or drains over the run
+    samples = depth["samples"]
+    step = max(len(samples) // 20, 1)
+    print("  " + " ".join(f"{t:.1f}s:{d}" for t, d in samples[::step]), file=out)
+
+def import_webserver(csv_path):
+    '''Import the app in this process, serving csv_path if given.'''
+    if csv_path:
+        os.environ["TP_CSV_PATH"] = csv_path
+    from app import webserver
+    return webserver
+
+def add_run_arguments(parser):
+    '''Add the options of a load test run to a parser.'''
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=1000, help="requests to send")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="arrivals per second (0 sends as fast as the clients can)")
+    parser.add_argument("--mix", help="request kinds and weights, e.g. state_mean=3,best5=1,batch=1")
+    parser.add_argument("--wait", type=float, default=5, help="get_results wait, in seconds")
+    parser.add_argument("--batch-size", type=int, default=8, help="jobs per batch request")
+    parser.add_argument("--sample-interval", type=float, default=0.1,
+                        help="seconds between two queue depth samples")
+    parser.add_argument("--states", help="comma separated states to ask for (default: the states "
+                        "of the served CSV in this process, else every state)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the report to this JSON file")
+
+def load_test(args, transport, webserver=None):
+    '''Run a load test with the parsed options.'''
+    questions = None
+    states = args.states.split(",") if args.states else None
+
+    # Only ask for the questions and states the served CSV has, the state_diff_from_mean
+    # jobs of the other ones fail
+    if webserver is not None:
+        cube = webserver.data_ingestor.cube
+        questions = [question for question in QUESTIONS if cube.question_totals(question)]
+        if states is None:
+            states = list(dict.fromkeys(state for question in questions
+                                        for state in cube.state_totals(question)))
+
+    return LoadTest(transport, parse_mix(args.mix), args.clients, args.requests, args.rate,
+                    args.wait, args.batch_size, questions, states,
+                    sample_interval=args.sample_interval, seed=args.seed).run()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for the webserver")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="write a synthetic CSV")
+    generate.add_argument("--rows", type=int, default=1000)
+    generate.add_argument("--output", required=True)
+    generate.add_argument("--seed", type=int, default=0)
+
+    run = commands.add_parser("run", help="run a load test")
+    run.add_argument("--url", help="server to test (default: the app in this process)")
+    run.add_argument("--csv", help="CSV served by the app in this process")
+    run.add_argument("--shutdown", action="store_true", help="shut the server down afterwards")
+    add_run_arguments(run)
+
+    sweep = commands.add_parser("sweep", help="run a load test for every dataset size")
+    sweep.add_argument("--sizes", default="1000,10000,100000,1000000,10000000")
+    sweep.add_argument("--directory", default=".", help="where the synthetic CSVs are written")
+    add_run_arguments(sweep)
+
+    args = parser.parse_args(argv)
 
-print(x.text)
+    if args.command == "generate":
+        generate_csv(args.output, args.rows, args.seed)
+        return
 
-url = 'http://localhost:5000/api/get_results/1'
+    reports = []
 
-x = requests.get(url)
+    if args.command == "run":
+        if args.url:
+            transport = HttpTransport(args.url)
+        else:
+            webserver = import_webserver(args.csv)
+            transport = FlaskClientTransport(webserver)
 
-print(x.text)
+        report = load_test(args, transport, None if args.url else webserver)
+        print_report(report)
+        reports.append(report)
 
-url = 'http://localhost:5000/api/get_results/2'
+        if args.shutdown or not args.url:
+            transport.get("/api/graceful_shutdown")
+    else:
+        webserver = None
+        for rows in [int(size) for size in args.sizes.split(",")]:
+            csv_path = os.path.join(args.directory, f"synthetic_{rows}.csv")
+            if not os.path.exists(csv_path):
+                generate_csv(csv_path, rows, args.seed)
 
-x = requests.get(url)
+            # The first dataset is loaded with the app, the next ones are swapped in
+            if webserver is None:
+                webserver = import_webserver(csv_path)
+            else:
+                webserver.data_ingestor.csv_path = csv_path
+                webserver.tasks_runner.reload_dataset()
 
-print(x.text)
+            report = load_test(args, FlaskClientTransport(webserver), webserver)
+            report["rows"] = rows
+            print(f"--- {rows} rows")
+            print_report(report)
+            reports.append(report)
 
-url = 'http://localhost:5000/api/graceful_shutdown'
+        webserver.test_client().get("/api/graceful_shutdown")
 
-x = requests.get(url)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports if args.command == "sweep" else reports[0], f, indent=2)
 
-print(x.text)
+if __name__ == "__main__":
+    main()
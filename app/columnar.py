@@ -0,0 +1,217 @@
+from array import array
+import json
+import sys
+
+from app.aggregate_cube import normalize_missing
+
+# Columns of the dataset that hold strings, stored dictionary encoded
+STRING_COLUMNS = ["LocationDesc", "StratificationCategory1", "Stratification1"]
+VALUE_COLUMN = "Data_Value"
+QUESTION_COLUMN = "Question"
+
+HEADER_LENGTH_SIZE = 8
+
+def align(position):
+    '''Round a position up to a multiple of 8 bytes.'''
+    return (position + 7) & ~7
+
+def encode(values, table, codes):
+    '''Append the codes of values into their string table to codes, adding the new strings
+    to table (string -> code).'''
+    for value in values:
+        value = normalize_missing(value)
+        code = table.get(value)
+        if code is None:
+            code = len(table)
+            table[value] = code
+        codes.append(code)
+
+class CompactDataset:
+    '''The rows the jobs look at, stored column by column instead of as one dict per row:
+    Data_Value as a float64 array and every string column as int32 codes into a table of its
+    distinct strings. The rows are grouped by question (keeping their order within a question),
+    the rows of the i-th question being the range offsets[i]:offsets[i + 1].'''
+    def __init__(self, questions, offsets, values, tables, codes):
+        self.questions = questions
+        self.offsets = offsets
+        self.values = values
+        self.tables = tables
+        self.codes = codes
+        self.question_ids = {question: i for i, question in enumerate(questions)}
+
+    @classmethod
+    def from_columns(cls, columns):
+        '''Build the dataset from whole columns (column -> list of values, in row order).'''
+        return cls.empty().append(columns)
+
+    @classmethod
+    def empty(cls):
+        '''Build a dataset without rows.'''
+        return cls([], array("q", [0]), array("d"), {column: [] for column in STRING_COLUMNS},
+                   {column: array("i") for column in STRING_COLUMNS})
+
+    def append(self, columns):
+        '''Build a new dataset holding these rows followed by the given ones (column -> list
+        of values, in row order). The dataset itself is left unchanged, and its rows are
+        copied question by question without being decoded.'''
+        question_table = dict(self.question_ids)
+        question_codes = array("i")
+        encode(columns[QUESTION_COLUMN], question_table, question_codes)
+
+        # Positions of the new rows of every question, in row order
+        buckets = [[] for _ in question_table]
+        for position, code in enumerate(question_codes):
+            buckets[code].append(position)
+
+        string_tables = {column: {value: code for code, value in enumerate(self.tables[column])}
+                         for column in STRING_COLUMNS}
+        offsets = array("q", [0])
+        values = array("d")
+        codes = {column: array("i") for column in STRING_COLUMNS}
+
+        for i, bucket in enumerate(buckets):
+            if i < len(self.questions):
+                # Copied as bytes, the columns can be views over a mapped buffer
+                start, end = self.offsets[i], self.offsets[i + 1]
+                values.frombytes(memoryview(self.values)[start:end].cast("B"))
+                for column in STRING_COLUMNS:
+                    codes[column].frombytes(memoryview(self.codes[column])[start:end].cast("B"))
+
+            values.extend(map(columns[VALUE_COLUMN].__getitem__, bucket))
+            for column in STRING_COLUMNS:
+                encode(map(columns[column].__getitem__, bucket), string_tables[column], codes[column])
+            offsets.append(len(values))
+
+        tables = {column: list(string_tables[column]) for column in STRING_COLUMNS}
+        return CompactDataset(list(question_table), offsets, values, tables, codes)
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''Build the dataset from row dicts.'''
+        columns = {column: [row[column] for row in rows]
+                   for column in [QUESTION_COLUMN, VALUE_COLUMN] + STRING_COLUMNS}
+        return cls.from_columns(columns)
+
+    def __len__(self):
+        return len(self.values)
+
+    def rows(self, question):
+        '''Iterate over the (state, value, category, stratification) rows of a question.'''
+        i = self.question_ids.get(question)
+        if i is None:
+            return iter(())
+
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return zip(self.decode("LocationDesc", start, end), self.values[start:end],
+                   self.decode("StratificationCategory1", start, end),
+                   self.decode("Stratification1", start, end))
+
+    def decode(self, column, start, end):
+        '''Iterate over the strings of a string column in the rows start:end.'''
+        return map(self.tables[column].__getitem__, self.codes[column][start:end])
+
+    def partition(self, question):
+        '''Get the rows of a question as column -> list of values (empty lists if the question
+        is unknown).'''
+        i = self.question_ids.get(question)
+        start, end = (0, 0) if i is None else (self.offsets[i], self.offsets[i + 1])
+
+        partition = {VALUE_COLUMN: self.values[start:end].tolist()}
+        for column in STRING_COLUMNS:
+            partition[column] = list(self.decode(column, start, end))
+        return partition
+
+    def memory_usage(self):
+        '''Get the bytes used by every part of the dataset (arrays, string tables) and in total.'''
+        usage = {
+            "values": self.values.itemsize * len(self.values),
+            "codes": sum(codes.itemsize * len(codes) for codes in self.codes.values()),
+            "offsets": self.offsets.itemsize * len(self.offsets),
+            "tables": sum(sys.getsizeof(table) + sum(map(sys.getsizeof, table))
+                          for table in [self.questions] + list(self.tables.values())),
+        }
+        usage["total"] = sum(usage.values())
+        return usage
+
+    def row_dicts_memory_usage(self):
+        '''Estimate the bytes the same rows would use as the row dicts of
+        DataFrame.to_dict(orient="records"), with a copy of every string in every row.
+        Only the five columns held here are counted, so this is a lower bound.'''
+        row_bytes = sys.getsizeof({column: None for column in
+                                   [QUESTION_COLUMN, VALUE_COLUMN] + STRING_COLUMNS})
+        row_bytes += sys.getsizeof(0.0)
+        total = row_bytes * len(self)
+
+        for i, question in enumerate(self.questions):
+            total += sys.getsizeof(question) * (self.offsets[i + 1] - self.offsets[i])
+
+        for column in STRING_COLUMNS:
+            sizes = [sys.getsizeof(value) for value in self.tables[column]]
+            total += sum(map(sizes.__getitem__, self.codes[column]))
+
+        return total
+
+def pack_dataset(dataset, metadata=None):
+    '''Pack a CompactDataset into a flat binary layout.
+
+    The layout is the length of a JSON header (8 bytes, little endian), the header itself
+    (questions, row offset of every question, the string table of every string column and
+    the optional metadata), then the Data_Value column as float64 and every string column
+    as int32 codes into its table.'''
+    header = json.dumps({
+        "rows": len(dataset),
+        "questions": dataset.questions,
+        "offsets": dataset.offsets.tolist(),
+        "tables": dataset.tables,
+        "metadata": metadata,
+    }).encode()
+
+    blob = bytearray(len(header).to_bytes(HEADER_LENGTH_SIZE, "little"))
+    blob += header
+    blob += bytes(align(len(blob)) - len(blob))
+    blob += dataset.values.tobytes()
+    for column in STRING_COLUMNS:
+        blob += dataset.codes[column].tobytes()
+
+    return bytes(blob)
+
+def read_header(buffer):
+    '''Read the header of a buffer holding the layout of pack_dataset, returning the header
+    and its length.'''
+    with memoryview(buffer) as view:
+        header_length = int.from_bytes(view[:HEADER_LENGTH_SIZE], "little")
+        header = json.loads(bytes(view[HEADER_LENGTH_SIZE:HEADER_LENGTH_SIZE + header_length]))
+    return header, header_length
+
+def unpack_dataset(buffer, copy=True, header=None):
+    '''Rebuild a CompactDataset from a buffer holding the layout of pack_dataset. The arrays
+    are copied, so the buffer can be closed afterwards, unless copy is False: the columns are
+    then memoryviews over the buffer, which has to stay open as long as the dataset is used.
+    header is the (header, length) pair of read_header, if the caller already read it.'''
+    header, header_length = header or read_header(buffer)
+    rows = header["rows"]
+    view = memoryview(buffer)
+    position = align(HEADER_LENGTH_SIZE + header_length)
+
+    def column(typecode, size):
+        nonlocal position
+        data = view[position:position + size * rows]
+        position += size * rows
+        if not copy:
+            return data.cast(typecode)
+        with data:
+            copied = array(typecode)
+            copied.frombytes(data)
+            return copied
+
+    try:
+        values = column("d", 8)
+        codes = {name: column("i", 4) for name in STRING_COLUMNS}
+    finally:
+        if copy:
+            view.release()
+
+    tables = {column: [normalize_missing(value) for value in header["tables"][column]]
+              for column in STRING_COLUMNS}
+
+    return CompactDataset(header["questions"], array("q", header["offsets"]), values, tables, codes)
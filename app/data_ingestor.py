@@ -1,24 +1,315 @@
 import os
+import gc
 import json
-import pandas as pd
+import hashlib
+import mmap
+
+from contextlib import contextmanager
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock
+
+import numpy as np
+
+from app import log
+from app.aggregate_cube import AggregateCube
+from app.columnar import (CompactDataset, pack_dataset, read_header, unpack_dataset,
+                          QUESTION_COLUMN, VALUE_COLUMN, STRING_COLUMNS)
+from app.groupby import add_rows, encode_column, factorize_series
+
+# Columns of the CSV the jobs look at, the only ones loaded
+DATASET_COLUMNS = [QUESTION_COLUMN, VALUE_COLUMN] + STRING_COLUMNS
+# Types of these columns, so that every chunk of a streamed CSV is parsed the same way
+DATASET_DTYPES = {column: str for column in DATASET_COLUMNS}
+DATASET_DTYPES[VALUE_COLUMN] = "float64"
+# Questions whose best states have the lowest and the highest values
+QUESTIONS_BEST_IS_MIN = [
+    'Percent of adults aged 18 years and older who have an overweight classification',
+    'Percent of adults aged 18 years and older who have obesity',
+    'Percent of adults who engage in no leisure-time physical activity',
+    'Percent of adults who report consuming fruit less than one time daily',
+    'Percent of adults who report consuming vegetables less than one time daily'
+]
+
+QUESTIONS_BEST_IS_MAX = [
+    'Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)',
+    'Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic physical activity and engage in muscle-strengthening activities on 2 or more days a week',
+    'Percent of adults who achieve at least 300 minutes a week of moderate-intensity aerobic physical activity or 150 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)',
+    'Percent of adults who engage in muscle-strengthening activities on 2 or more days a week',
+]
+
+# Layout of the snapshots, the snapshots of another layout are written again
+SNAPSHOT_VERSION = 2
+
+@contextmanager
+def paused_gc():
+    '''Pause the cyclic garbage collector, which would otherwise scan the containers over and
+    over while a cube of many (mostly new) containers is parsed and rebuilt.'''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def load_cube(metadata):
+    '''Rebuild the cube exported to the metadata of a packed dataset, or return None.'''
+    if not metadata or "cube" not in metadata:
+        return None
+    return AggregateCube.from_export(metadata["cube"])
+
+class DatasetVersion:
+    '''One immutable version of the dataset: its number, the compact rows and their aggregate
+    cube. A new version is swapped in as a whole, so a reader holding a version keeps seeing
+    consistent rows and aggregates.'''
+    def __init__(self, number, dataset, cube):
+        self.number = number
+        self.dataset = dataset
+        self.cube = cube
 
 class DataIngestor:
 
-    def __init__(self, csv_path: str):
-        self.data = pd.read_csv(csv_path).to_dict(orient='records')
+    def __init__(self, csv_path: str, dataset=None, cube=None):
+        '''Load the dataset from csv_path, or use the already built CompactDataset and (if
+        given) its cube (e.g. mapped from shared memory) without reading the CSV at all.
+
+        Unless TP_DATA_SNAPSHOT=0, a binary snapshot of the dataset is written next to the
+        CSV (<csv_path>.snapshot) and the following loads map it instead of parsing the CSV,
+        as long as the CSV did not change.
+
+        With TP_INGEST=stream, the CSV is read in chunks of TP_INGEST_CHUNK_ROWS rows which
+        are only aggregated into the cube, so the rows are not kept in memory.'''
         self.csv_path = csv_path
+        self.source = "memory"
+        self.streamed = os.environ.get("TP_INGEST", "rows") == "stream"
+        self.chunk_rows = int(os.environ.get("TP_INGEST_CHUNK_ROWS", 100000))
+        # Serializes the appends and reloads, the readers never lock
+        self.update_lock = Lock()
+
+        if dataset is None:
+            dataset, cube = self.load()
+        if cube is None:
+            cube = self.build_aggregate_cube(dataset)
+
+        self.current = DatasetVersion(1, dataset, cube)
+
+        self.questions_best_is_min = QUESTIONS_BEST_IS_MIN
+        self.questions_best_is_max = QUESTIONS_BEST_IS_MAX
+
+        # Hashed, so that finding the direction of a question is O(1)
+        self.best_is_min = frozenset(self.questions_best_is_min)
+
+    @property
+    def dataset(self):
+        '''The CompactDataset of the current version.'''
+        return self.current.dataset
+
+    @property
+    def data(self):
+        '''The rows of the current version, the jobs only look at the compact dataset.'''
+        return self.current.dataset
+
+    @property
+    def cube(self):
+        '''The aggregate cube of the current version.'''
+        return self.current.cube
+
+    @property
+    def version(self):
+        '''The number of the current version.'''
+        return self.current.number
+
+    def load(self):
+        '''Load the dataset from the snapshot of the CSV if it is valid, else from the CSV.
+        Returns the dataset and its cube (None if it has to be built from the dataset).'''
+        loaded = None
+
+        if os.environ.get("TP_DATA_SNAPSHOT", "1") != "0":
+            loaded = self.load_snapshot()
+            self.source = "snapshot"
+
+        if loaded is None:
+            if self.streamed:
+                loaded = self.stream_csv()
+            else:
+                dataset = self.read_csv()
+                loaded = dataset, self.build_aggregate_cube(dataset)
+            self.source = "csv"
+
+            if os.environ.get("TP_DATA_SNAPSHOT", "1") != "0":
+                self.write_snapshot(*loaded)
+
+        dataset, cube = loaded
+        usage = dataset.memory_usage()
+        log.logger.info(f"Loaded {len(dataset)} rows of {self.csv_path} from {self.source}, "
+                        f"using {usage['total']} bytes ({usage})")
+
+        return dataset, cube
+
+    def reload(self):
+        '''Load the CSV again and swap it in as a new version. Returns the new version.'''
+        with self.update_lock:
+            dataset, cube = self.load()
+            if cube is None:
+                cube = self.build_aggregate_cube(dataset)
+
+            self.current = DatasetVersion(self.current.number + 1, dataset, cube)
+            return self.current
+
+    def append_rows(self, columns):
+        '''Append rows (column -> list of values, in row order) and swap them in as a new
+        version. The aggregates of the questions the rows belong to are copied and updated,
+        the others are shared with the previous version. Returns the new version.'''
+        with self.update_lock:
+            current = self.current
+            dataset = current.dataset.append(columns)
+
+            questions = encode_column(columns[QUESTION_COLUMN])
+            cube = current.cube.copy(set(questions[1]))
+            add_rows(cube, [questions] + [encode_column(columns[column]) for column in STRING_COLUMNS],
+                     [float(value) for value in columns[VALUE_COLUMN]])
+
+            self.current = DatasetVersion(current.number + 1, dataset, cube)
+            return self.current
+
+    def read_csv(self):
+        '''Parse the columns the jobs look at from the CSV into a CompactDataset.'''
+        # Only imported when the CSV has to be parsed
+        import pandas as pd
+
+        frame = pd.read_csv(self.csv_path, usecols=DATASET_COLUMNS, dtype=DATASET_DTYPES)
+        return CompactDataset.from_columns({column: frame[column].tolist()
+                                            for column in DATASET_COLUMNS})
+
+    def stream_csv(self):
+        '''Aggregate the CSV chunk by chunk into a cube, without keeping the rows. Returns an
+        empty dataset and the cube.'''
+        # Only imported when the CSV has to be parsed
+        import pandas as pd
+
+        cube = AggregateCube()
+        rows = 0
+
+        with pd.read_csv(self.csv_path, usecols=DATASET_COLUMNS, dtype=DATASET_DTYPES,
+                         chunksize=self.chunk_rows) as chunks:
+            for chunk in chunks:
+                # Aggregated in row order, so the sums are the same as when loading the rows
+                add_rows(cube, [factorize_series(chunk[column])
+                                for column in [QUESTION_COLUMN] + STRING_COLUMNS],
+                         chunk[VALUE_COLUMN].to_numpy(dtype="float64"))
+                rows += len(chunk)
+
+        log.logger.info(f"Streamed {rows} rows of {self.csv_path} in chunks of "
+                        f"{self.chunk_rows} rows into {len(cube.questions)} questions")
+
+        return CompactDataset.empty(), cube
+
+    def build_aggregate_cube(self, dataset):
+        '''Aggregate the rows of every question into the (sum, count) cube.'''
+        offsets = np.frombuffer(dataset.offsets, dtype=np.int64)
+        questions = np.repeat(np.arange(len(dataset.questions), dtype=np.int64), np.diff(offsets))
+
+        return add_rows(AggregateCube(), [(questions, dataset.questions)] + [
+            (np.frombuffer(dataset.codes[column], dtype=np.int32).astype(np.int64),
+             dataset.tables[column]) for column in STRING_COLUMNS
+        ], np.frombuffer(dataset.values, dtype=np.float64))
+
+    def get_question_partition(self, question):
+        '''Get the columnar partition of a question (empty columns if it is unknown).'''
+        return self.dataset.partition(question)
+
+    def memory_usage(self, dataset=None):
+        '''Compare the bytes used by the compact dataset (the current one by default) with the
+        estimated bytes the same rows would use as row dicts.'''
+        dataset = dataset if dataset is not None else self.dataset
+        return {
+            "compact": dataset.memory_usage()["total"],
+            "row_dicts": dataset.row_dicts_memory_usage(),
+        }
+
+    def snapshot_path(self):
+        '''Get the path of the snapshot of the CSV.'''
+        return self.csv_path + ".snapshot"
+
+    def source_metadata(self, with_hash):
+        '''Describe the CSV the snapshot is built from: path, size, mtime and (if asked) hash.'''
+        stat = os.stat(self.csv_path)
+        metadata = {
+            "path": os.path.abspath(self.csv_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+        if with_hash:
+            digest = hashlib.sha256()
+            with open(self.csv_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            metadata["sha256"] = digest.hexdigest()
+
+        return metadata
+
+    def is_snapshot_valid(self, metadata):
+        '''Check if a snapshot of the current layout built from the given CSV metadata matches
+        the CSV. The hash is only computed when the size matches but the mtime does not (e.g.
+        the file was touched).'''
+        if metadata is None or metadata.get("version") != SNAPSHOT_VERSION:
+            return False
+
+        current = self.source_metadata(with_hash=False)
+        if current["path"] != metadata.get("path") or current["size"] != metadata.get("size"):
+            return False
+        if current["mtime_ns"] == metadata.get("mtime_ns"):
+            return True
+
+        return self.source_metadata(with_hash=True)["sha256"] == metadata.get("sha256")
+
+    def load_snapshot(self):
+        '''Map the snapshot of the CSV and rebuild the dataset and the cube from it, or return
+        None if there is no valid snapshot. The columns of the dataset are views over the
+        mapping, which is unmapped once they are all dropped, so only the pages read are
+        loaded.'''
+        try:
+            with open(self.snapshot_path(), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            with paused_gc():
+                header = read_header(mapped)
+                metadata = header[0].get("metadata")
+                # The snapshot of a streamed CSV holds no rows
+                if not self.is_snapshot_valid(metadata) or metadata.get("streamed") != self.streamed:
+                    mapped.close()
+                    return None
+                return unpack_dataset(mapped, copy=False, header=header), load_cube(metadata)
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                log.logger.warning(f"Ignoring the snapshot of {self.csv_path}: {e}")
+            return None
+
+    def write_snapshot(self, dataset, cube):
+        '''Write the snapshot of the dataset and of its cube next to the CSV.'''
+        metadata = self.source_metadata(with_hash=True)
+        metadata["version"] = SNAPSHOT_VERSION
+        metadata["streamed"] = self.streamed
+        metadata["cube"] = cube.export()
+        blob = pack_dataset(dataset, metadata)
+        temporary_path = self.snapshot_path() + ".tmp"
+
+        try:
+            with open(temporary_path, "wb") as f:
+                f.write(blob)
+            # Replaced atomically, so a concurrent start never maps a partial snapshot
+            os.replace(temporary_path, self.snapshot_path())
+        except OSError as e:
+            log.logger.warning(f"Could not write the snapshot of {self.csv_path}: {e}")
+
+    def export_shared_memory(self):
+        '''Copy the dataset into a new shared memory segment, which worker processes can map
+        with columnar.unpack_dataset. The cube is exported too, so that the workers do not
+        build it again. The caller owns (and has to unlink) the segment.'''
+        blob = pack_dataset(self.dataset, {"cube": self.cube.export()})
+
+        shared_memory = SharedMemory(create=True, size=len(blob))
+        shared_memory.buf[:len(blob)] = blob
 
-        self.questions_best_is_min = [
-            'Percent of adults aged 18 years and older who have an overweight classification',
-            'Percent of adults aged 18 years and older who have obesity',
-            'Percent of adults who engage in no leisure-time physical activity',
-            'Percent of adults who report consuming fruit less than one time daily',
-            'Percent of adults who report consuming vegetables less than one time daily'
-        ]
-
-        self.questions_best_is_max = [
-            'Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)',
-            'Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic physical activity and engage in muscle-strengthening activities on 2 or more days a week',
-            'Percent of adults who achieve at least 300 minutes a week of moderate-intensity aerobic physical activity or 150 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)',
-            'Percent of adults who engage in muscle-strengthening activities on 2 or more days a week',
-        ]
+        return shared_memory
@@ -0,0 +1,99 @@
+import numpy as np
+
+from app.aggregate_cube import MISSING, normalize_missing
+from app.columnar import encode
+
+def factorize(keys):
+    '''Number the distinct values of an integer array in order of first appearance. Returns the
+    group of every element and the index of the first element of every group.'''
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind="stable")
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    return ranks[inverse.reshape(-1)], first[order]
+
+def encode_column(values):
+    '''Dictionary encode a list of values (normalized with normalize_missing) into the int64
+    code of every value and the table of the distinct values.'''
+    table = {}
+    codes = []
+    encode(values, table, codes)
+    return np.array(codes, dtype=np.int64), list(table)
+
+def factorize_series(series):
+    '''Dictionary encode a pandas Series like encode_column, without a Python loop over it.'''
+    codes, uniques = series.factorize()
+    table = [normalize_missing(value) for value in uniques.tolist()]
+    # Missing values are coded -1, they get the MISSING entry at the end of the table
+    codes = np.where(codes < 0, len(table), codes).astype(np.int64)
+    return codes, table + [MISSING]
+
+def group_totals(groups, count, values, existing):
+    '''Sum and count values by group. The sums add the values in row order after the existing
+    [sum, count] of the group (None for a new group), exactly like adding them one by one,
+    as np.bincount accumulates its weights in order.'''
+    seeded = [group for group, totals in enumerate(existing) if totals is not None]
+
+    sums = np.bincount(np.concatenate([np.array(seeded, dtype=np.int64), groups]),
+                       weights=np.concatenate([np.array([existing[group][0] for group in seeded],
+                                                        dtype=np.float64), values]),
+                       minlength=count).tolist()
+    counts = np.bincount(groups, minlength=count).tolist()
+
+    for group in seeded:
+        counts[group] += existing[group][1]
+
+    return sums, counts
+
+def add_rows(cube, keys, values):
+    '''Add rows to an AggregateCube with vectorized group-bys, giving the same cube, sums and
+    key order included, as AggregateCube.add on every row in order.
+
+    keys holds the (codes, table) pairs of the question, state, category and stratification
+    of the rows, codes being the int64 code of every row into the table of the distinct
+    values (normalized with normalize_missing), and values the Data_Value of the rows.'''
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+        return cube
+
+    (questions, question_table), (states, state_table), (categories, category_table), \
+        (stratifications, stratification_table) = keys
+
+    # Every level is numbered densely before combining it with the next column, so that the
+    # combined keys stay below rows * table size
+    question_groups, question_first = factorize(questions)
+    state_groups, state_first = factorize(question_groups * len(state_table) + states)
+    category_groups, _ = factorize(state_groups * len(category_table) + categories)
+    cell_groups, cell_first = factorize(category_groups * len(stratification_table) + stratifications)
+
+    def decode(rows):
+        rows = np.asarray(rows)
+        return zip(map(question_table.__getitem__, questions[rows].tolist()),
+                   map(state_table.__getitem__, states[rows].tolist()),
+                   map(category_table.__getitem__, categories[rows].tolist()),
+                   map(stratification_table.__getitem__, stratifications[rows].tolist()))
+
+    # The first rows of the groups are in row order, so the new keys are inserted in the order
+    # the rows would have inserted them
+    cells = [(cube.cells.setdefault(question, {}).setdefault(state, {}), (category, stratification))
+             for question, state, category, stratification in decode(cell_first)]
+    sums, counts = group_totals(cell_groups, len(cells), values,
+                                [strata.get(key) for strata, key in cells])
+    for (strata, key), total, count in zip(cells, sums, counts):
+        strata[key] = [total, count]
+
+    state_totals = [(cube.states.setdefault(question, {}), state)
+                    for question, state, _, _ in decode(state_first)]
+    sums, counts = group_totals(state_groups, len(state_totals), values,
+                                [totals.get(state) for totals, state in state_totals])
+    for (totals, state), total, count in zip(state_totals, sums, counts):
+        totals[state] = [total, count]
+
+    question_keys = [question for question, _, _, _ in decode(question_first)]
+    sums, counts = group_totals(question_groups, len(question_keys), values,
+                                [cube.questions.get(question) for question in question_keys])
+    for question, total, count in zip(question_keys, sums, counts):
+        cube.questions[question] = [total, count]
+        cube.forget_means(question)
+
+    return cube
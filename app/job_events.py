@@ -0,0 +1,106 @@
+from collections import deque
+from threading import Condition, Event, Lock
+import json
+
+def format_event(job_id, status, res):
+    '''Format the server-sent event of a completed job.'''
+    data = json.dumps({"job_id": job_id, "status": status, "result": res})
+    return f"id: {job_id}\nevent: job\ndata: {data}\n\n"
+
+class Subscriber:
+    '''Subscriber to the stream of job completions, optionally filtered by a set of job ids.
+    The (job_id, event) pairs are buffered up to max_buffer, the ones over it are dropped and
+    counted, so that a slow reader never blocks the workers.'''
+    def __init__(self, job_ids, max_buffer):
+        self.job_ids = job_ids
+        self.max_buffer = max_buffer
+        self.events = deque()
+        self.dropped = 0
+        self.condition = Condition()
+
+    def matches(self, job_id):
+        '''Check if the subscriber wants the events of a job.'''
+        return self.job_ids is None or job_id in self.job_ids
+
+    def push(self, job_id, event):
+        '''Buffer the event of a job, dropping it if the buffer is full.'''
+        with self.condition:
+            if len(self.events) >= self.max_buffer:
+                self.dropped += 1
+                return
+            self.events.append((job_id, event))
+            self.condition.notify()
+
+    def pop_all(self, timeout):
+        '''Wait up to timeout seconds for events, then return the buffered (job_id, event)
+        pairs and the number of events dropped since the last call.'''
+        with self.condition:
+            if not self.events and not self.dropped:
+                self.condition.wait(timeout)
+
+            events = list(self.events)
+            self.events.clear()
+            dropped = self.dropped
+            self.dropped = 0
+
+        return events, dropped
+
+class JobEvents:
+    '''Completion signalling of jobs: a waiter blocks on a per-job event, which is set
+    when TaskRunner completes the job, and subscribers receive a stream of completions.'''
+    def __init__(self):
+        # job_id -> [event, number of waiters]
+        self.waiters = {}
+        # Replaced on every change, so that publish can iterate it without the lock
+        self.subscribers = ()
+        self.lock = Lock()
+
+    def wait(self, job_id, is_done, timeout):
+        '''Wait for a job to complete, for at most timeout seconds. is_done checks if the job
+        is already complete. Returns True if the job completed.'''
+        with self.lock:
+            waiter = self.waiters.setdefault(job_id, [Event(), 0])
+            waiter[1] += 1
+
+        try:
+            # Checked after registering, so a completion cannot be missed in between
+            if is_done():
+                return True
+            return waiter[0].wait(timeout)
+        finally:
+            with self.lock:
+                waiter[1] -= 1
+                if waiter[1] == 0 and self.waiters.get(job_id) is waiter:
+                    del self.waiters[job_id]
+
+    def notify(self, job_id):
+        '''Wake up the waiters of a completed job.'''
+        with self.lock:
+            waiter = self.waiters.pop(job_id, None)
+
+        if waiter is not None:
+            waiter[0].set()
+
+    def subscribe(self, job_ids, max_buffer):
+        '''Subscribe to the completions of the given job ids (all jobs if None).'''
+        subscriber = Subscriber(job_ids, max_buffer)
+
+        with self.lock:
+            self.subscribers = self.subscribers + (subscriber,)
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        '''Stop sending completions to a subscriber.'''
+        with self.lock:
+            self.subscribers = tuple(s for s in self.subscribers if s is not subscriber)
+
+    def publish(self, job_id, status, res):
+        '''Send the completion of a job to the subscribers interested in it.'''
+        event = None
+
+        for subscriber in self.subscribers:
+            if subscriber.matches(job_id):
+                if event is None:
+                    event = format_event(job_id, status, res)
+                subscriber.push(job_id, event)
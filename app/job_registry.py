@@ -0,0 +1,221 @@
+from array import array
+from threading import Lock
+import itertools
+import time
+
+# Status codes stored in the registry
+STATUSES = ["running", "done", "error"]
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+
+class JobRegistry:
+    '''Registry of the jobs, replacing the plain jobs_dict: it allocates the job ids and keeps
+    the status, type and creation time of every job in compact arrays indexed by job id.
+
+    The oldest completed jobs are evicted once there are more than max_jobs jobs or once they
+    are older than max_age seconds (0 disables the age limit), and on_evict is called with the
+    evicted ids. The running jobs are never evicted: the ones older than an evicted job are
+    detached from the arrays until they complete, so that a stuck job does not block the
+    eviction of the jobs after it. It can be used like the jobs_dict it replaces (in, [], get,
+    items).'''
+    def __init__(self, max_jobs, max_age, on_evict=None):
+        self.max_jobs = max_jobs
+        self.max_age = max_age
+        self.on_evict = on_evict
+        # Evict in chunks, so that shifting the arrays is amortized over many jobs
+        self.evict_chunk = max(1, max_jobs // 16)
+
+        self.lock = Lock()
+        # Id of the oldest retained job, the job with id first_id + i is at index i
+        self.first_id = 1
+        self.statuses = bytearray()
+        self.job_types = bytearray()
+        self.created = array("d")
+        # job_id -> [status code, type code, created] of the jobs detached from the arrays,
+        # with ids lower than first_id
+        self.detached = {}
+        self.type_codes = {}
+        self.type_names = []
+        self.batch_ids = itertools.count(1)
+        self.last_age_check = 0
+
+    def allocate(self, job_type, parameters=None):
+        '''Register a new running job and return its id. The parameters are only kept by the
+        durable SharedJobRegistry, the jobs here do not outlive the process.'''
+        return self.allocate_many([job_type])[0]
+
+    def allocate_many(self, job_types, parameters=None):
+        '''Register new running jobs, one per job type, and return their consecutive ids.'''
+        now = time.time()
+
+        with self.lock:
+            first_id = self.first_id + len(self.statuses)
+            for job_type in job_types:
+                self.statuses.append(STATUS_CODES["running"])
+                self.job_types.append(self.type_code(job_type))
+                self.created.append(now)
+
+            evicted = self.evict(now)
+
+        if evicted and self.on_evict is not None:
+            self.on_evict(evicted)
+
+        return list(range(first_id, first_id + len(job_types)))
+
+    def allocate_batch_id(self, job_ids=None):
+        '''Allocate the id of a new batch. Its job ids are kept by the pool, not here.'''
+        # itertools.count is advanced atomically
+        return next(self.batch_ids)
+
+    def type_code(self, job_type):
+        '''Get the code of a job type, assigning one to new job types.'''
+        code = self.type_codes.get(job_type)
+        if code is None:
+            code = len(self.type_names)
+            self.type_codes[job_type] = code
+            self.type_names.append(job_type)
+        return code
+
+    def evict(self, now):
+        '''Evict the oldest completed jobs over the limits, returning the evicted ids.
+        Must be called with the lock held.'''
+        excess = len(self) - self.max_jobs
+        # Age based eviction is checked at most once per second
+        check_age = self.max_age and now - self.last_age_check >= 1
+
+        if excess < self.evict_chunk and not check_age:
+            return []
+        if check_age:
+            self.last_age_check = now
+
+        running = STATUS_CODES["running"]
+        evicted = []
+
+        # The detached jobs are the oldest ones
+        for job_id, (status, _, created) in list(self.detached.items()):
+            if status != running and (len(evicted) < excess or (check_age and now - created > self.max_age)):
+                del self.detached[job_id]
+                evicted.append(job_id)
+
+        # Cut the arrays after the last evicted job, detaching the running jobs before it
+        count = 0
+        detached = []
+        for index in range(len(self.statuses)):
+            too_many = len(evicted) < excess
+            too_old = check_age and now - self.created[index] > self.max_age
+            if not too_many and not too_old:
+                break
+            if self.statuses[index] == running:
+                detached.append(index)
+            else:
+                evicted.append(self.first_id + index)
+                count = index + 1
+
+        if count == 0:
+            return evicted
+
+        for index in detached:
+            if index < count:
+                self.detached[self.first_id + index] = [self.statuses[index], self.job_types[index],
+                                                        self.created[index]]
+
+        del self.statuses[:count]
+        del self.job_types[:count]
+        del self.created[:count]
+        self.first_id += count
+        return evicted
+
+    def index(self, job_id):
+        '''Get the index of a retained job in the arrays, or None.'''
+        index = job_id - self.first_id
+        if 0 <= index < len(self.statuses):
+            return index
+        return None
+
+    def get(self, job_id, default=None):
+        '''Get the status of a job, or default if it is unknown or evicted.'''
+        with self.lock:
+            index = self.index(job_id)
+            if index is not None:
+                return STATUSES[self.statuses[index]]
+            if job_id in self.detached:
+                return STATUSES[self.detached[job_id][0]]
+            return default
+
+    def get_type(self, job_id):
+        '''Get the type of a job, or None if it is unknown or evicted.'''
+        with self.lock:
+            index = self.index(job_id)
+            if index is not None:
+                return self.type_names[self.job_types[index]]
+            if job_id in self.detached:
+                return self.type_names[self.detached[job_id][1]]
+            return None
+
+    def __contains__(self, job_id):
+        return self.get(job_id) is not None
+
+    def __getitem__(self, job_id):
+        status = self.get(job_id)
+        if status is None:
+            raise KeyError(job_id)
+        return status
+
+    def __setitem__(self, job_id, status):
+        with self.lock:
+            index = self.index(job_id)
+            if index is not None:
+                self.statuses[index] = STATUS_CODES[status]
+            elif job_id in self.detached:
+                self.detached[job_id][0] = STATUS_CODES[status]
+
+    def __len__(self):
+        return len(self.detached) + len(self.statuses)
+
+    def items(self):
+        '''Get the (job_id, status) pairs of the retained jobs.'''
+        with self.lock:
+            detached = [(job_id, STATUSES[job[0]]) for job_id, job in self.detached.items()]
+            statuses = bytes(self.statuses)
+            first_id = self.first_id
+
+        return detached + [(first_id + i, STATUSES[code]) for i, code in enumerate(statuses)]
+
+    def page(self, after_id, limit, status=None, job_type=None):
+        '''Get up to limit (job_id, status, job_type) triples of the retained jobs with ids greater
+        than after_id, optionally filtered by status and job type. At most 16 * limit jobs
+        are scanned, so a call costs O(limit) whatever the number of jobs. Returns the
+        triples, the last scanned id (to resume from) and whether there are more jobs.'''
+        status_code = STATUS_CODES.get(status) if status is not None else None
+        type_code = self.type_codes.get(job_type) if job_type is not None else None
+
+        with self.lock:
+            # The detached jobs come first, they have the lowest ids
+            jobs = sorted((job_id, job[0], job[1]) for job_id, job in self.detached.items()
+                          if job_id > after_id)
+            start = max(after_id + 1 - self.first_id, 0)
+            end = min(start + 16 * limit, len(self.statuses))
+            first_id = self.first_id + start
+            jobs += [(first_id + i, code, job_type_code) for i, (code, job_type_code)
+                     in enumerate(zip(self.statuses[start:end], self.job_types[start:end]))]
+            total = len(jobs) + len(self.statuses) - end
+
+        if (status is not None and status_code is None) or (job_type is not None and type_code is None):
+            return [], max(jobs[-1][0] if jobs else first_id - 1, after_id), False
+
+        matches = []
+        scanned = 0
+        for scanned, (job_id, code, job_type_code) in enumerate(jobs, 1):
+            if status_code is not None and code != status_code:
+                continue
+            if type_code is not None and job_type_code != type_code:
+                continue
+            matches.append((job_id, STATUSES[code], self.type_names[job_type_code]))
+            if len(matches) == limit:
+                break
+
+        last_id = max(jobs[scanned - 1][0] if scanned else first_id - 1, after_id)
+        return matches, last_id, scanned < total
+
+    def values(self):
+        '''Get the statuses of the retained jobs.'''
+        return [status for _, status in self.items()]
@@ -1,19 +1,131 @@
+import atexit
+import copy
 import logging
+import os
+import queue
+import random
 import time
 
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler
+from threading import Lock, Thread
 
 class UTCFormatter(logging.Formatter):
     def formatTime(self, record, datefmt=None):
         ct = time.gmtime(record.created)
         return time.strftime("%Y-%m-%d %H:%M:%S", ct)
 
+class BatchRotatingFileHandler(RotatingFileHandler):
+    '''RotatingFileHandler flushing only when flush_batch is called, instead of after every
+    record, so that a whole batch of records is written with a single flush.'''
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        '''Flush the records written since the last call.'''
+        super().flush()
+
+class DroppingQueueHandler(QueueHandler):
+    '''QueueHandler which never blocks the logging thread: when the bounded queue is full,
+    the record is dropped and counted instead.'''
+    def __init__(self, record_queue, max_message):
+        super().__init__(record_queue)
+        self.max_message = max_message
+        self.dropped = 0
+        self.dropped_lock = Lock()
+
+    def prepare(self, record):
+        '''Format the message on the logging thread, truncating the overly long ones. Only the
+        message is truncated, the traceback of an exception is appended to it afterwards.'''
+        message = record.getMessage()
+        if len(message) > self.max_message:
+            record = copy.copy(record)
+            record.msg = message[:self.max_message] + "..."
+            record.args = None
+        return super().prepare(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+class SamplingFilter(logging.Filter):
+    '''Filter keeping a random fraction (rate) of the records.'''
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return self.rate >= 1 or random.random() < self.rate
+
+class BatchWriter(Thread):
+    '''Background thread writing the queued records to a handler, in batches of at most
+    batch_size records flushed together. A None record stops it.'''
+    def __init__(self, record_queue, handler, batch_size):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = record_queue
+        self.handler = handler
+        self.batch_size = batch_size
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            for record in batch:
+                if record is None:
+                    stop = True
+                else:
+                    self.handler.handle(record)
+            self.handler.flush_batch()
+
+            if stop:
+                break
+
+    def stop(self, timeout=5):
+        '''Write the queued records and stop the thread, waiting at most timeout seconds (the
+        records still queued then are lost, e.g. if the queue stays full).'''
+        deadline = time.monotonic() + timeout
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.join(max(deadline - time.monotonic(), 0))
+
+def forward_records(record_queue):
+    '''Queue the records of this process on record_queue instead of the queue of the writer
+    thread, which does not run in a forked process. The process reading record_queue writes
+    them with logger.handle.'''
+    logger.removeHandler(queue_handler)
+    logger.addHandler(DroppingQueueHandler(record_queue, queue_handler.max_message))
+
+def dropped_records():
+    '''Get the number of log records dropped because the log queue was full.'''
+    return queue_handler.dropped
+
 logger = logging.getLogger("webserver")
 logger.setLevel(logging.INFO)
 
-handler = RotatingFileHandler("webserver.log", maxBytes = 1024*1024, backupCount = 5)
+# Per-request lines go through this logger, which keeps TP_LOG_SAMPLE_RATE of them
+request_logger = logger.getChild("requests")
+request_logger.addFilter(SamplingFilter(float(os.environ.get("TP_LOG_SAMPLE_RATE", 1))))
+
+handler = BatchRotatingFileHandler("webserver.log", maxBytes = 1024*1024, backupCount = 5)
 formatter = UTCFormatter("[%(asctime)s] [%(levelname)s] - %(message)s")
 handler.setFormatter(formatter)
 
+# The request threads only queue the records, the file is written by the writer thread
+record_queue = queue.Queue(int(os.environ.get("TP_LOG_QUEUE_SIZE", 10000)))
+queue_handler = DroppingQueueHandler(record_queue, int(os.environ.get("TP_LOG_MAX_MESSAGE", 1024)))
+writer = BatchWriter(record_queue, handler, int(os.environ.get("TP_LOG_BATCH_SIZE", 256)))
+
 if not logger.hasHandlers():
-    logger.addHandler(handler)
+    logger.addHandler(queue_handler)
+    writer.start()
+    atexit.register(writer.stop)
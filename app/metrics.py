@@ -0,0 +1,150 @@
+from collections import deque
+from threading import Lock, current_thread, local
+import bisect
+import weakref
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+class MetricsShard:
+    '''Counters and histograms written by a single thread, so that recording needs no lock.'''
+    def __init__(self):
+        # (name, job_type) -> value
+        self.counters = {}
+        # (name, job_type) -> [count of every bucket..., count over the last bucket, sum]
+        self.histograms = {}
+
+    def inc(self, name, job_type, amount=1):
+        '''Increment a counter.'''
+        key = (name, job_type)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, job_type, seconds):
+        '''Record a duration in a histogram.'''
+        key = (name, job_type)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = [0] * (len(BUCKETS) + 1) + [0.0]
+            self.histograms[key] = histogram
+
+        histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    def merge(self, shard):
+        '''Add the counters and histograms of another shard to this one.'''
+        for key, value in shard.counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, histogram in shard.histograms.items():
+            total = self.histograms.get(key)
+            self.histograms[key] = list(histogram) if total is None else [a + b for a, b in zip(total, histogram)]
+
+class Metrics:
+    '''Instrumentation of the thread pool. Every thread records into its own shard and a scrape
+    sums the shards without locking them, so recording never contends with scraping. The shard
+    of a finished thread (e.g. a request thread) is folded into the retired totals.'''
+    def __init__(self):
+        self.shards = []
+        self.local = local()
+        self.lock = Lock()
+        # Totals of the finished threads, and their shards waiting to be folded into them
+        self.retired = MetricsShard()
+        self.finished = deque()
+        # name -> (help, function returning the value)
+        self.gauges = {}
+        self.help = {}
+
+    def shard(self):
+        '''Get the shard of the calling thread.'''
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = MetricsShard()
+            self.local.shard = shard
+            # Only taken once per thread
+            with self.lock:
+                self.fold_finished()
+                self.shards = self.shards + [shard]
+            # Not folded by the finalizer itself, which can run in any thread, even one
+            # holding the lock
+            weakref.finalize(current_thread(), self.finished.append, shard).atexit = False
+        return shard
+
+    def fold_finished(self):
+        '''Fold the shards of the finished threads into the retired totals.
+        Must be called with the lock held.'''
+        if not self.finished:
+            return
+
+        finished = []
+        while self.finished:
+            finished.append(self.finished.popleft())
+        for shard in finished:
+            self.retired.merge(shard)
+        finished_ids = {id(shard) for shard in finished}
+        self.shards = [shard for shard in self.shards if id(shard) not in finished_ids]
+
+    def describe(self, name, help):
+        '''Set the help text of a counter or histogram.'''
+        self.help[name] = help
+
+    def add_gauge(self, name, help, function):
+        '''Add a gauge, whose value is read from function at scrape time.'''
+        self.gauges[name] = (help, function)
+
+    def inc(self, name, job_type, amount=1):
+        '''Increment a counter of a job type.'''
+        self.shard().inc(name, job_type, amount)
+
+    def observe(self, name, job_type, seconds):
+        '''Record a duration of a job type in a histogram.'''
+        self.shard().observe(name, job_type, seconds)
+
+    def collect(self):
+        '''Sum the counters and histograms of all shards and of the finished threads.'''
+        with self.lock:
+            self.fold_finished()
+            shards = self.shards
+            counters = dict(self.retired.counters)
+            histograms = {key: list(histogram) for key, histogram in self.retired.histograms.items()}
+
+        for shard in shards:
+            # dict.copy is atomic, so the owner thread can keep recording
+            for key, value in shard.counters.copy().items():
+                counters[key] = counters.get(key, 0) + value
+            for key, histogram in shard.histograms.copy().items():
+                histogram = list(histogram)
+                total = histograms.get(key)
+                histograms[key] = histogram if total is None else [a + b for a, b in zip(total, histogram)]
+
+        return counters, histograms
+
+    def render(self):
+        '''Render the metrics in the Prometheus text format.'''
+        counters, histograms = self.collect()
+        lines = []
+
+        for name, (help, function) in self.gauges.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {function()}")
+
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for (counter_name, job_type), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append(f'{name}{{job_type="{job_type}"}} {value}')
+
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for (histogram_name, job_type), histogram in sorted(histograms.items()):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ["+Inf"], histogram):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{job_type="{job_type}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{job_type="{job_type}"}} {histogram[-1]}')
+                lines.append(f'{name}_count{{job_type="{job_type}"}} {cumulative}')
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,193 @@
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock, Thread
+import logging
+import multiprocessing
+import os
+import time
+
+from app import log
+from app.columnar import read_header, unpack_dataset
+from app.data_ingestor import DataIngestor, load_cube, paused_gc
+from app.task_runner import ThreadPool, TaskRunner, JobError, task_jobs
+
+def map_dataset(shared_memory_name, csv_path):
+    '''Build an ingestor from the dataset and cube exported to a shared memory segment. The
+    columns are views over the segment, so all the workers share its pages instead of each
+    holding a copy. Returns the ingestor and the segment, which stays open while it is used.'''
+    shared_memory = SharedMemory(name=shared_memory_name)
+    with paused_gc():
+        header = read_header(shared_memory.buf)
+        cube = load_cube(header[0]["metadata"])
+    return DataIngestor(csv_path, unpack_dataset(shared_memory.buf, copy=False, header=header),
+                        cube), shared_memory
+
+def close_segment(shared_memory):
+    '''Close a segment mapped by map_dataset, once the ingestor using it is dropped.'''
+    try:
+        shared_memory.close()
+    except BufferError:
+        # Still viewed by a leftover reference, the mapping goes away with it
+        log.logger.warning(f"Could not close the shared memory segment {shared_memory.name}")
+
+def run_worker(shared_memory_name, csv_path, task_queue, done_queue):
+    '''Worker process loop: map the dataset from shared memory, then compute the tasks from
+    task_queue until a None sentinel is received, sending back the segment they were computed
+    against and their (job, result) pairs. A task that cannot be computed at all gets a
+    JobError result for each of its jobs, so that they are still completed. The records the
+    worker logs are sent back the same way.'''
+    log.forward_records(done_queue)
+    dataIngestor, shared_memory = map_dataset(shared_memory_name, csv_path)
+    runner = TaskRunner(None, None, None, None, dataIngestor.data, dataIngestor)
+    del dataIngestor
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        try:
+            # A new dataset version was swapped in since the previous task
+            if task[2]["segment"] != shared_memory.name:
+                runner.dataIngestor = runner.data = None
+                close_segment(shared_memory)
+                runner.dataIngestor, shared_memory = map_dataset(task[2]["segment"], csv_path)
+                runner.data = runner.dataIngestor.data
+
+            results = runner.execute_task(task)
+        except Exception as error:
+            log.logger.exception(f"Worker failed to compute task {task[0]}")
+            results = [(job, JobError.from_exception(error), None) for job in task_jobs(task)]
+
+        done_queue.put((task[2]["segment"], results))
+
+    runner.dataIngestor = runner.data = None
+    close_segment(shared_memory)
+
+class ProcessPool(ThreadPool):
+    '''ThreadPool backend running the jobs in worker processes, so that CPU bound jobs are not
+    serialized by the GIL. The dataset is mapped by the workers from a shared memory segment
+    instead of being pickled to them, and the results are sent back to a collector thread that
+    completes the jobs in the web process.
+
+    Every dataset version is exported to its own segment and the tasks are stamped with the
+    segment of the version current when they are queued, which the workers switch to. A segment
+    is freed once it is not current and all the tasks stamped with it are collected.
+
+    The workers read a multiprocessing queue, so the jobs are run in FIFO order, and the time
+    the tasks spend in it is not measured.'''
+    def start_workers(self):
+        '''Start the worker processes and the collector thread.'''
+        # Fork, so that the workers do not import the app package (and build a server) again
+        context = multiprocessing.get_context("fork")
+
+        self.shared_memory = self.dataIngestor.export_shared_memory()
+        # Segment name -> [segment, number of queued or running tasks stamped with it]
+        self.segments = {self.shared_memory.name: [self.shared_memory, 0]}
+        self.segments_lock = Lock()
+        self.task_queue = context.Queue()
+        self.done_queue = context.Queue()
+
+        for _ in range(self.num_threads):
+            process = context.Process(target=run_worker,
+                                      args=(self.shared_memory.name, self.dataIngestor.csv_path,
+                                            self.task_queue, self.done_queue),
+                                      daemon=True)
+            process.start()
+            self.threads.append(process)
+
+        # Number of tasks sent back by the workers, only written by the collector
+        self.collected_tasks = 0
+        self.collector = Thread(target=self.collect_results)
+        self.collector.start()
+
+    def add_task(self, task):
+        '''Queue a task, stamped with the segment of the current dataset version.'''
+        with self.segments_lock:
+            task[2]["segment"] = self.shared_memory.name
+            self.segments[self.shared_memory.name][1] += 1
+
+        super().add_task(task)
+
+    def swap_dataset(self, version):
+        '''Export the new dataset version to a new segment, used by the tasks queued from now on.'''
+        shared_memory = self.dataIngestor.export_shared_memory()
+
+        with self.segments_lock:
+            previous = self.shared_memory.name
+            self.shared_memory = shared_memory
+            self.segments[shared_memory.name] = [shared_memory, 0]
+            self.release_segment(previous)
+
+        return super().swap_dataset(version)
+
+    def release_segment(self, name):
+        '''Free a segment if it is not current and no queued or running task uses it anymore.
+        Must be called with the segments lock held.'''
+        shared_memory, tasks = self.segments[name]
+        if tasks == 0 and shared_memory is not self.shared_memory:
+            del self.segments[name]
+            shared_memory.close()
+            shared_memory.unlink()
+
+    def busy_workers(self):
+        '''Estimate the number of busy workers from the tasks sent but not collected yet.'''
+        counters, _ = self.metrics.collect()
+        enqueued = sum(value for (name, _), value in counters.items()
+                       if name == "tp_tasks_enqueued_total")
+        running = enqueued - self.collected_tasks - self.task_queue.qsize()
+        return min(max(running, 0), self.num_threads)
+
+    def collect_results(self):
+        '''Complete the jobs computed by the workers and write the records they logged, until
+        a None sentinel is received.'''
+        while True:
+            done = self.done_queue.get()
+            if done is None:
+                break
+            if isinstance(done, logging.LogRecord):
+                log.logger.handle(done)
+                continue
+
+            segment, results = done
+            self.finish_jobs(results)
+            self.collected_tasks += 1
+
+            with self.segments_lock:
+                self.segments[segment][1] -= 1
+                self.release_segment(segment)
+
+    def shutdown(self):
+        '''Shutdown the pool once the queued jobs are done, then free the shared memory.
+        Returns the number of seconds it took to drain the queue and stop the workers.'''
+        start = time.monotonic()
+        deadline = start + float(os.environ.get("TP_SHUTDOWN_TIMEOUT", 30))
+
+        self.shutdown_event.set()
+
+        # The sentinels are queued after the pending jobs, so those are still computed
+        for _ in self.threads:
+            self.task_queue.put(None)
+        for process in self.threads:
+            process.join(max(deadline - time.monotonic(), 0))
+
+        alive = sum(process.is_alive() for process in self.threads)
+        for process in self.threads:
+            if process.is_alive():
+                process.terminate()
+
+        self.done_queue.put(None)
+        self.collector.join()
+        self.close_job_store()
+
+        for shared_memory, _ in self.segments.values():
+            shared_memory.close()
+            shared_memory.unlink()
+
+        elapsed = time.monotonic() - start
+        if alive:
+            log.logger.warning(f"Process pool shutdown timed out after {elapsed:.3f}s, "
+                               f"{alive} workers terminated")
+        else:
+            log.logger.info(f"Process pool drained and stopped in {elapsed:.3f}s")
+
+        return elapsed
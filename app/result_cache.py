@@ -0,0 +1,93 @@
+from collections import OrderedDict
+from threading import Lock
+
+# Job types whose result depends on the requested state
+STATE_JOB_TYPES = {"state_mean", "state_diff_from_mean", "state_mean_by_category"}
+
+# Outcomes of ResultCache.acquire
+CACHE_HIT = "hit"
+CACHE_JOINED = "joined"
+CACHE_LEADER = "leader"
+
+class ResultCache:
+    '''Bounded LRU cache of job results, with single-flight de-duplication of identical jobs
+    that are still being computed.'''
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def make_key(job_type, question, state, version=None, options=None):
+        '''Build the cache key of a job, keeping only the parameters its job type uses,
+        together with the dataset version it was submitted against and the options of the
+        job types taking some (a dict).'''
+        if job_type not in STATE_JOB_TYPES:
+            state = None
+        if options is not None:
+            options = tuple(sorted(options.items()))
+        return (job_type, question, state, version, options)
+
+    @staticmethod
+    def job_key(job_type, job_data):
+        '''Build the cache key of a job from its data.'''
+        return ResultCache.make_key(job_type, job_data["question"], job_data["state"],
+                                    job_data.get("version"), job_data.get("options"))
+
+    def acquire(self, key, job_id):
+        '''Look up a job in the cache. Returns (CACHE_HIT, result) if the result is known,
+        (CACHE_JOINED, None) if the job was attached to an identical running job and
+        (CACHE_LEADER, None) if the caller has to run the job itself.'''
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return CACHE_HIT, self.entries[key]
+
+            if key in self.in_flight:
+                self.in_flight[key].append(job_id)
+                return CACHE_JOINED, None
+
+            self.in_flight[key] = []
+            return CACHE_LEADER, None
+
+    def lookup(self, key):
+        '''Look up a result without attaching to a running job. Returns (True, result) if the
+        result is known and (False, None) otherwise.'''
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return True, self.entries[key]
+            return False, None
+
+    def resolve(self, key, result):
+        '''Store the result of a finished job and return the ids of the jobs attached to it.'''
+        with self.lock:
+            followers = self.in_flight.pop(key, [])
+            self.store(key, result)
+            return followers
+
+    def fail(self, key):
+        '''Drop the running job of a key that failed, so that the next identical job is
+        computed again, and return the ids of the jobs attached to it.'''
+        with self.lock:
+            return self.in_flight.pop(key, [])
+
+    def put(self, key, result):
+        '''Store a result computed outside of the single-flight tracking.'''
+        with self.lock:
+            self.store(key, result)
+
+    def store(self, key, result):
+        '''Store a result, evicting the least recently used ones over the bound.
+        Must be called with the lock held.'''
+        if self.max_entries > 0:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        '''Drop every cached result, keeping the running jobs.'''
+        with self.lock:
+            self.entries.clear()
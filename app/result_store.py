@@ -0,0 +1,141 @@
+from collections import OrderedDict
+from threading import Lock
+import os
+import json
+import time
+
+def serialize_response(res, status="done"):
+    '''Serialize the get_results response of a finished job (or, with the "error" status, of a
+    failed job and its error), the same way jsonify does.'''
+    body = json.dumps({"status": status, "data": res}, sort_keys=True, separators=(",", ":"))
+    return (body + "\n").encode()
+
+class ResultStore:
+    '''Store of finished job results, kept as pre-serialized get_results responses.
+
+    The most recent results are kept in memory, up to memory_budget bytes, the older ones
+    are spilled to <directory>/<job_id>.json and every result is dropped ttl seconds after
+    it was stored (ttl = 0 keeps them forever).'''
+    def __init__(self, directory, memory_budget, ttl):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.ttl = ttl
+        self.gc_interval = min(ttl, 60) if ttl > 0 else 0
+
+        # job_id -> (body, stored_at), oldest first
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        # job_id -> stored_at, oldest first
+        self.on_disk = OrderedDict()
+        self.lock = Lock()
+        self.last_gc = time.monotonic()
+
+    def put(self, job_id, res, status="done"):
+        '''Store the result of a job, finished with the given status.'''
+        body = serialize_response(res, status)
+        now = time.monotonic()
+
+        with self.lock:
+            self.memory[job_id] = (body, now)
+            self.memory_size += len(body)
+
+            # Pick the oldest results over the budget, they stay readable from memory
+            # until they are written to disk
+            to_spill = []
+            spilled_size = 0
+            for spilled_id, (spilled_body, stored_at) in self.memory.items():
+                if self.memory_size - spilled_size <= self.memory_budget:
+                    break
+                to_spill.append((spilled_id, spilled_body, stored_at))
+                spilled_size += len(spilled_body)
+
+        if to_spill:
+            self.spill(to_spill)
+
+        if self.gc_interval and now - self.last_gc >= self.gc_interval:
+            self.collect_garbage()
+
+    def spill(self, entries):
+        '''Move results from memory to disk.'''
+        for job_id, body, _ in entries:
+            with open(self.result_path(job_id), "wb") as f:
+                f.write(body)
+
+        with self.lock:
+            for job_id, body, stored_at in entries:
+                if self.memory.pop(job_id, None) is not None:
+                    self.memory_size -= len(body)
+                    self.on_disk[job_id] = stored_at
+
+    def get(self, job_id):
+        '''Get the serialized get_results response of a job, or None if there is none.'''
+        with self.lock:
+            entry = self.memory.get(job_id)
+            if entry is not None:
+                if self.is_expired(entry[1]):
+                    return None
+                return entry[0]
+
+            stored_at = self.on_disk.get(job_id)
+
+        if stored_at is None or self.is_expired(stored_at):
+            return None
+
+        try:
+            with open(self.result_path(job_id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def discard(self, job_id):
+        '''Drop the result of a job.'''
+        with self.lock:
+            entry = self.memory.pop(job_id, None)
+            if entry is not None:
+                self.memory_size -= len(entry[0])
+            on_disk = self.on_disk.pop(job_id, None) is not None
+
+        if on_disk:
+            self.remove_file(job_id)
+
+    def collect_garbage(self):
+        '''Drop every expired result, from memory and from disk.'''
+        expired_on_disk = []
+
+        with self.lock:
+            self.last_gc = time.monotonic()
+            if not self.ttl:
+                return
+
+            # Both dicts are ordered by insertion time, so expired entries come first
+            while self.memory:
+                job_id, (body, stored_at) = next(iter(self.memory.items()))
+                if not self.is_expired(stored_at):
+                    break
+                del self.memory[job_id]
+                self.memory_size -= len(body)
+
+            while self.on_disk:
+                job_id, stored_at = next(iter(self.on_disk.items()))
+                if not self.is_expired(stored_at):
+                    break
+                del self.on_disk[job_id]
+                expired_on_disk.append(job_id)
+
+        for job_id in expired_on_disk:
+            self.remove_file(job_id)
+
+    def is_expired(self, stored_at):
+        '''Check if a result stored at the given time has expired.'''
+        return self.ttl > 0 and time.monotonic() - stored_at > self.ttl
+
+    def result_path(self, job_id):
+        '''Get the path of the file a result is spilled to.'''
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def remove_file(self, job_id):
+        '''Remove the spilled result of a job from disk.'''
+        try:
+            os.remove(self.result_path(job_id))
+        except FileNotFoundError:
+            pass
@@ -1,7 +1,13 @@
 from app import webserver, log
-from flask import request, jsonify, abort
+from app.task_runner import JOB_TYPES, TOPK_DIRECTIONS, TOPK_GROUPS
+from app.job_events import format_event
+from app.data_ingestor import DATASET_COLUMNS
+from app.aggregate_cube import MISSING
+from flask import request, jsonify, abort, Response, stream_with_context
 
+import os
 import json
+import math
 
 @webserver.before_request
 def before_request():
@@ -27,20 +33,41 @@ def post_endpoint():
 
     return jsonify({"error": "Method not allowed"}), 405
 
+# Default and maximum page sizes of /api/jobs
+JOBS_PAGE_SIZE = int(os.environ.get("TP_JOBS_PAGE_SIZE", 1000))
+MAX_JOBS_PAGE_SIZE = int(os.environ.get("TP_MAX_JOBS_PAGE_SIZE", 10000))
+
 @webserver.route('/api/jobs', methods=['GET'])
 def get_jobs():
-    '''Endpoint to get the list of jobs and their statuses.'''
-    job_list = [{str(job_id): status} for job_id, status
-                in webserver.tasks_runner.jobs_dict.items()]
+    '''Endpoint to get a page of the list of jobs and their statuses.
+
+    ?limit=<n> sets the page size, ?cursor=<next_cursor> resumes after the previous page and
+    ?since=<job_id> only lists the jobs submitted after that job (polling it with the returned
+    next_cursor gives the new jobs incrementally). ?status=<status> and ?job_type=<type>
+    filter the jobs.'''
+    limit = min(max(request.args.get("limit", JOBS_PAGE_SIZE, type=int), 1), MAX_JOBS_PAGE_SIZE)
+    after_id = request.args.get("cursor", request.args.get("since", 0, type=int), type=int)
+
+    jobs, next_cursor, has_more = webserver.tasks_runner.jobs_dict.page(
+        after_id, limit, request.args.get("status"), request.args.get("job_type"))
+
+    job_list = [{str(job_id): status} for job_id, status, _ in jobs]
     return jsonify({
         "status": "done",
-        "data": job_list
+        "data": job_list,
+        "next_cursor": next_cursor,
+        "has_more": has_more
     })
 
 @webserver.route('/api/num_jobs', methods=['GET'])
 def get_num_jobs():
     '''Endpoint to get the number of jobs in the queue.'''
-    return jsonify({"status": "done", "data": len(webserver.tasks_runner.task_queue.qsize())})
+    return jsonify({"status": "done", "data": webserver.tasks_runner.task_queue.qsize()})
+
+@webserver.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    '''Endpoint exposing the thread pool metrics in the Prometheus text format.'''
+    return Response(webserver.tasks_runner.metrics.render(), mimetype="text/plain; version=0.0.4")
 
 @webserver.route('/api/graceful_shutdown', methods=['GET'])
 def graceful_shutdown():
@@ -53,55 +80,189 @@ def graceful_shutdown():
         return jsonify({"status": "done"})
     return jsonify({"status": "error", "data": "shutting own"})
 
+# Columns every appended row has to hold
+REQUIRED_ROW_COLUMNS = ["Question", "LocationDesc", "Data_Value"]
+
+@webserver.route('/api/dataset', methods=['GET'])
+def get_dataset():
+    '''Endpoint to get the current dataset version and its number of rows. With ?memory=1, the
+    bytes used by its compact columns are compared with the estimated bytes of the same rows as
+    row dicts, which takes a scan of every row.'''
+    version = webserver.data_ingestor.current
+    info = dataset_info(version)
+    if request.args.get("memory", "0") not in ("", "0", "false"):
+        info["memory_usage"] = webserver.data_ingestor.memory_usage(version.dataset)
+    return jsonify({"status": "done", "data": info})
+
+@webserver.route('/api/dataset/reload', methods=['POST'])
+def reload_dataset():
+    '''Endpoint to load the CSV again and swap it in as a new dataset version, without
+    restarting the server. The running jobs finish against the previous version.'''
+    log.logger.info("Received request to reload the dataset")
+
+    version = webserver.tasks_runner.reload_dataset()
+
+    return jsonify({"status": "done", "data": dataset_info(version)})
+
+@webserver.route('/api/dataset/append', methods=['POST'])
+def append_dataset():
+    '''Endpoint to append rows to the dataset as a new version. The body holds the rows under
+    "rows", each with a Question, LocationDesc and Data_Value and optionally a
+    StratificationCategory1 and Stratification1.'''
+    data = request.json
+    rows = data.get("rows") if isinstance(data, dict) else None
+
+    if not isinstance(rows, list):
+        abort(400, description="Expected a list of rows under \"rows\"")
+
+    columns = {column: [] for column in DATASET_COLUMNS}
+    for row in rows:
+        if not isinstance(row, dict) or not all(column in row for column in REQUIRED_ROW_COLUMNS):
+            abort(400, description=f"Rows need the columns {', '.join(REQUIRED_ROW_COLUMNS)}")
+        if not isinstance(row["Data_Value"], (int, float)) and row["Data_Value"] is not None:
+            abort(400, description=f"Invalid Data_Value: {row['Data_Value']}")
+
+        for column in DATASET_COLUMNS:
+            value = row.get(column)
+            # Missing values are NaN, as when they are read from the CSV
+            columns[column].append(MISSING if value is None else value)
+
+    log.logger.info(f"Received request to append {len(rows)} rows to the dataset")
+
+    version = webserver.tasks_runner.append_rows(columns)
+
+    return jsonify({"status": "done", "data": dataset_info(version)})
+
+def dataset_info(version):
+    '''Describe a dataset version.'''
+    # Counted from the aggregates, as the rows are not kept when the CSV is streamed
+    rows = sum(totals[1] for totals in version.cube.questions.values())
+    return {"version": version.number, "rows": rows}
+
+# Upper bound of the wait parameter of get_results, in seconds
+MAX_RESULT_WAIT = float(os.environ.get("TP_MAX_RESULT_WAIT", 30))
+
 @webserver.route('/api/get_results/<job_id>', methods=['GET'])
 def get_response(job_id):
-    '''Endpoint to get the results of a job.'''
-
-    log.logger.info(f"Received results request for job ID: {job_id}")
+    '''Endpoint to get the results of a job. With ?wait=<seconds>, a running job is waited
+    for until it completes or the timeout expires.'''
 
-    print(f"JobID is {job_id}")
+    log.request_logger.info("Received results request for job ID: %s", job_id)
 
     job_id = int(job_id)
 
     if job_id not in webserver.tasks_runner.jobs_dict:
         return jsonify({"status": "error", 'reason': "Job ID not found"})
 
+    wait = request.args.get("wait", type=float)
+    if wait and webserver.tasks_runner.jobs_dict[job_id] == "running":
+        webserver.tasks_runner.wait_for_job(job_id, min(wait, MAX_RESULT_WAIT))
+
     if webserver.tasks_runner.jobs_dict[job_id] == "running":
         return jsonify({"status": "running"})
 
-    with open (f"results/{job_id}.json", "r") as f:
-        res = json.load(f)
-        return jsonify({"status": "done", "data": res})
-
-    # If not, return running status
-    return jsonify({"status": 'NotImplemented'})
+    # The stored result is already the serialized response
+    body = webserver.tasks_runner.result_store.get(job_id)
+    if body is None:
+        return jsonify({"status": "error", "reason": "Job result expired"})
+
+    return Response(body, mimetype="application/json")
+
+# Number of events buffered for a subscriber of /api/events before dropping them
+EVENTS_BUFFER = int(os.environ.get("TP_EVENTS_BUFFER", 1024))
+# Seconds between two keep-alive comments on an idle event stream
+EVENTS_KEEPALIVE = float(os.environ.get("TP_EVENTS_KEEPALIVE", 15))
+
+@webserver.route('/api/events', methods=['GET'])
+def events_stream():
+    '''Endpoint streaming the job completions as server-sent events. With ?job_ids=<id>,<id>...
+    or ?batch_id=<id>, only those jobs are streamed and the stream ends once all are done.'''
+    job_ids = None
+
+    if "job_ids" in request.args:
+        job_ids = {parse_id(job_id, "job id") for job_id in request.args["job_ids"].split(",") if job_id}
+
+    if "batch_id" in request.args:
+        batch_jobs = webserver.tasks_runner.batch_jobs(parse_id(request.args["batch_id"], "batch id"))
+        if batch_jobs is None:
+            return jsonify({"status": "error", "reason": "Batch ID not found"})
+        job_ids = (job_ids or set()) | set(batch_jobs)
+
+    log.logger.info(f"Got events subscription for {len(job_ids) if job_ids is not None else 'all'} jobs")
+
+    subscriber = webserver.tasks_runner.job_events.subscribe(job_ids, EVENTS_BUFFER)
+
+    def generate():
+        pending = set(job_ids) if job_ids is not None else None
+        try:
+            # Subscribed first, so the jobs done before now are caught up here
+            if pending is not None:
+                yield from finished_job_events(pending)
+
+            while pending is None or pending:
+                events, dropped = subscriber.pop_all(EVENTS_KEEPALIVE)
+
+                if not events and not dropped:
+                    yield ": keep-alive\n\n"
+
+                for job_id, event in events:
+                    if pending is None or job_id in pending:
+                        if pending is not None:
+                            pending.discard(job_id)
+                        yield event
+
+                if dropped:
+                    yield f"event: dropped\ndata: {json.dumps({'dropped': dropped})}\n\n"
+                    if pending is not None:
+                        yield from finished_job_events(pending)
+        finally:
+            webserver.tasks_runner.job_events.unsubscribe(subscriber)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream")
+
+def parse_id(text, name):
+    '''Parse a job or batch id of a query argument, aborting with 400 if it is not a number.'''
+    try:
+        return int(text)
+    except ValueError:
+        abort(400, description=f"Invalid {name}: {text}")
+
+def finished_job_events(pending):
+    '''Generate the events of the pending jobs that are already done (or unknown),
+    removing them from pending.'''
+    for job_id in sorted(pending):
+        status = webserver.tasks_runner.jobs_dict.get(job_id)
+
+        if status is None:
+            pending.discard(job_id)
+            yield format_event(job_id, "error", None)
+        elif status != "running":
+            pending.discard(job_id)
+            body = webserver.tasks_runner.result_store.get(job_id)
+            yield format_event(job_id, status, json.loads(body)["data"] if body else None)
 
 @webserver.route('/api/states_mean', methods=['POST'])
 def states_mean_request():
     '''Endpoint to handle requests for states mean.'''
     data = request.json
     
-    log.logger.info(f"Got request for states mean: {data}")
+    log.request_logger.info("Got request for states mean: %s", data)
 
     question = data["question"]
 
-    submit_job_to_thread_pool("states_mean", question = question)
-
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return job_response("states_mean", question = question, priority = job_priority(data))
 
 @webserver.route('/api/state_mean', methods=['POST'])
 def state_mean_request():
     '''Endpoint to handle requests for state mean.'''
     data = request.json
     
-    log.logger.info(f"Got request for state mean: {data}")
+    log.request_logger.info("Got request for state mean: %s", data)
 
     question = data["question"]
     state = data["state"]
 
-    submit_job_to_thread_pool("state_mean", state, question)
-
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return job_response("state_mean", state, question, priority = job_priority(data))
 
 
 @webserver.route('/api/best5', methods=['POST'])
@@ -110,11 +271,9 @@ def best5_request():
     data = request.json
     question = data["question"]
 
-    log.logger.info(f"Got request for best 5 states: {data}")
-
-    submit_job_to_thread_pool("best5", question = question)
+    log.request_logger.info("Got request for best 5 states: %s", data)
 
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return job_response("best5", question = question, priority = job_priority(data))
 
 @webserver.route('/api/worst5', methods=['POST'])
 def worst5_request():
@@ -122,11 +281,9 @@ def worst5_request():
     data = request.json
     question = data["question"]
 
-    log.logger.info(f"Got request for worst 5 states: {data}")
+    log.request_logger.info("Got request for worst 5 states: %s", data)
 
-    submit_job_to_thread_pool("worst5", question = question)
-
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return job_response("worst5", question = question, priority = job_priority(data))
 
 @webserver.route('/api/global_mean', methods=['POST'])
 def global_mean_request():
@@ -134,11 +291,9 @@ def global_mean_request():
     data = request.json
     question = data["question"]
 
-    log.logger.info(f"Got request for global mean: {data}")
-
-    submit_job_to_thread_pool("global_mean", question = question)
+    log.request_logger.info("Got request for global mean: %s", data)
 
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return job_response("global_mean", question = question, priority = job_priority(data))
 
 @webserver.route('/api/diff_from_mean', methods=['POST'])
 def diff_from_mean_request():
@@ -146,11 +301,9 @@ def diff_from_mean_request():
     data = request.json
     question = data["question"]
 
-    log.logger.info(f"Got request for difference from mean: {data}")
+    log.request_logger.info("Got request for difference from mean: %s", data)
 
-    submit_job_to_thread_pool("diff_from_mean", question = question)
-
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return job_response("diff_from_mean", question = question, priority = job_priority(data))
 
 @webserver.route('/api/state_diff_from_mean', methods=['POST'])
 def state_diff_from_mean_request():
@@ -159,11 +312,9 @@ def state_diff_from_mean_request():
     question = data["question"]
     state = data["state"]
 
-    log.logger.info(f"Got request for state difference from mean: {data}")
-
-    submit_job_to_thread_pool("state_diff_from_mean", state, question)
+    log.request_logger.info("Got request for state difference from mean: %s", data)
 
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return job_response("state_diff_from_mean", state, question, priority = job_priority(data))
 
 @webserver.route('/api/mean_by_category', methods=['POST'])
 def mean_by_category_request():
@@ -171,11 +322,9 @@ def mean_by_category_request():
     data = request.json
     question = data["question"]
 
-    log.logger.info(f"Got request for mean by category: {data}")
+    log.request_logger.info("Got request for mean by category: %s", data)
 
-    submit_job_to_thread_pool("mean_by_category", question = question)
-
-    return jsonify({"job_id": webserver.job_counter - 1})
+    return job_response("mean_by_category", question = question, priority = job_priority(data))
 
 @webserver.route('/api/state_mean_by_category', methods=['POST'])
 def state_mean_by_category_request():
@@ -184,11 +333,75 @@ def state_mean_by_category_request():
     question = data["question"]
     state = data["state"]
 
-    log.logger.info(f"Got request for state mean by category: {data}")
+    log.request_logger.info("Got request for state mean by category: %s", data)
+
+    return job_response("state_mean_by_category", state, question, priority = job_priority(data))
+
+@webserver.route('/api/topk', methods=['POST'])
+def topk_request():
+    '''Endpoint to handle requests for the k best or worst states (or state and stratification
+    groups, with "group": "stratification") by mean.'''
+    data = request.json
+    question = data["question"]
+
+    log.request_logger.info("Got request for top k: %s", data)
+
+    return job_response("topk", question = question, priority = job_priority(data),
+                        options = topk_options(data))
+
+def job_priority(data):
+    '''Validate the priority of a request, a number (0 by default).'''
+    priority = data.get("priority", 0)
+
+    if not isinstance(priority, (int, float)) or isinstance(priority, bool) or not math.isfinite(priority):
+        abort(400, description=f"Invalid priority: {priority}")
+
+    return priority
+
+def topk_options(data):
+    '''Validate the k, direction and group of a topk request, 5 best states by default.'''
+    options = {
+        "k": data.get("k", 5),
+        "direction": data.get("direction", "best"),
+        "group": data.get("group", "state")
+    }
+
+    if not isinstance(options["k"], int) or isinstance(options["k"], bool) or options["k"] < 0:
+        abort(400, description=f"Invalid k: {options['k']}")
+    if options["direction"] not in TOPK_DIRECTIONS:
+        abort(400, description=f"Unknown direction: {options['direction']}")
+    if options["group"] not in TOPK_GROUPS:
+        abort(400, description=f"Unknown group: {options['group']}")
+
+    return options
+
+@webserver.route('/api/batch', methods=['POST'])
+def batch_request():
+    '''Endpoint to handle a batch of requests, computed together in a single task. In the
+    synchronous mode, the results of the jobs are returned in order if they fit in the budget.'''
+    data = request.json
+    # Either a list of jobs, or an object holding it under "jobs"
+    items = data.get("jobs") if isinstance(data, dict) else data
+
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        abort(400, description="Expected a list of jobs, or an object holding it under \"jobs\"")
 
-    submit_job_to_thread_pool("state_mean_by_category", state, question)
+    log.request_logger.info("Got batch request for %d jobs", len(items))
 
-    return jsonify({"job_id": webserver.job_counter - 1})
+    for item in items:
+        if item.get("job_type") not in JOB_TYPES:
+            abort(400, description=f"Unknown job type: {item.get('job_type')}")
+    priority = job_priority(data) if isinstance(data, dict) else 0
+
+    if sync_requested():
+        jobs = [[item["job_type"], job_parameters(item)] for item in items]
+        results = webserver.tasks_runner.execute_sync(jobs, SYNC_BUDGET)
+        if results is not None:
+            return jsonify({"status": "done", "data": results})
+
+    batch_id, job_ids = submit_batch_to_thread_pool(items, priority)
+
+    return jsonify({"batch_id": batch_id, "job_ids": job_ids})
 
 # You can check localhost in your browser to see what this displays
 @webserver.route('/')
@@ -212,17 +425,63 @@ def get_defined_routes():
         routes.append(f"Endpoint: \"{rule}\" Methods: \"{methods}\"")
     return routes
 
-def submit_job_to_thread_pool(job_type, state = None, question = None):
-    '''Function to submit a job to the thread pool.'''
-    webserver.tasks_runner.jobs_dict[webserver.job_counter] = "running"
+# Seconds a synchronous request may spend computing inline, by the expected run times
+SYNC_BUDGET = float(os.environ.get("TP_SYNC_BUDGET", 0.005))
+
+def sync_requested():
+    '''Check if the client asked for the synchronous mode, with ?sync=1 or X-Sync: 1.'''
+    return request.args.get("sync", request.headers.get("X-Sync", "0")) not in ("", "0", "false")
+
+def job_response(job_type, state = None, question = None, priority = 0, options = None):
+    '''Answer a job request. In the synchronous mode, a job expected to fit in SYNC_BUDGET is
+    computed inline and its result returned like get_results would, otherwise the job is
+    submitted and its id returned.'''
+    if sync_requested():
+        data = {"question": question, "state": state, "options": options}
+        results = webserver.tasks_runner.execute_sync([[job_type, data]], SYNC_BUDGET)
+        if results is not None:
+            return jsonify({"status": "done", "data": results[0]})
+
+    job_id = submit_job_to_thread_pool(job_type, state, question, priority, options)
+
+    return jsonify({"job_id": job_id})
 
+def submit_job_to_thread_pool(job_type, state = None, question = None, priority = 0, options = None):
+    '''Function to submit a job to the thread pool, returning its id.'''
     data = {
         "question": question,
-        "state": state
+        "state": state,
+        "priority": priority,
+        "options": options
     }
-    job = [webserver.job_counter, job_type, data]
+    job_id = webserver.tasks_runner.jobs_dict.allocate(job_type, data)
+    job = [job_id, job_type, data]
 
-    webserver.tasks_runner.add_task(job)
+    webserver.tasks_runner.submit_job(job)
 
-    webserver.job_counter += 1
+    return job_id
 
+
+def submit_batch_to_thread_pool(items, priority = 0):
+    '''Function to submit a batch of jobs to the thread pool as a single task.'''
+    jobs_dict = webserver.tasks_runner.jobs_dict
+    parameters = [job_parameters(item) for item in items]
+    job_ids = jobs_dict.allocate_many([item["job_type"] for item in items], parameters)
+    jobs = []
+
+    for job_id, item, data in zip(job_ids, items, parameters):
+        jobs.append([job_id, item["job_type"], data])
+
+    batch_id = jobs_dict.allocate_batch_id(job_ids)
+
+    webserver.tasks_runner.submit_batch(batch_id, jobs, priority)
+
+    return batch_id, job_ids
+
+def job_parameters(item):
+    '''Get the data of a job of a batch.'''
+    return {
+        "question": item.get("question"),
+        "state": item.get("state"),
+        "options": topk_options(item) if item["job_type"] == "topk" else None
+    }
@@ -0,0 +1,119 @@
+from queue import Queue, Empty
+from threading import Condition
+import heapq
+import itertools
+import math
+import time
+
+class CostModel:
+    '''Expected run time of every job type, learned from the observed run times as an
+    exponential moving average, and default_cost for the job types not seen yet.'''
+    def __init__(self, default_cost=0.001, smoothing=0.2):
+        self.default_cost = default_cost
+        self.smoothing = smoothing
+
+        # job_type -> expected run time in seconds
+        self.costs = {}
+
+    def expected_cost(self, task):
+        '''Estimate the run time of a task, from the run times of its job types.'''
+        if task[1] == "batch":
+            return sum(self.costs.get(job[1], self.default_cost) for job in task[2]["jobs"])
+        return self.costs.get(task[1], self.default_cost)
+
+    def record(self, job_type, seconds):
+        '''Update the expected run time of a job type with an observed run time.'''
+        previous = self.costs.get(job_type)
+        if previous is None:
+            self.costs[job_type] = seconds
+        else:
+            self.costs[job_type] = previous + self.smoothing * (seconds - previous)
+
+class FifoScheduler(Queue):
+    '''First come, first served scheduler: the plain task queue.'''
+    def record(self, job_type, seconds):
+        '''Run times are not used by the FIFO order.'''
+
+class CostAwareScheduler:
+    '''Scheduler running the tasks with the shortest expected run time first, with aging.
+
+    The expected run time of a job type is learned from the observed run times, by a CostModel
+    that can be shared with the pool. A task is ranked by its enqueue time plus stretch times
+    its expected run time, minus priority_step seconds for every level of client priority,
+    and the lowest rank runs first. A cheap job thus overtakes the expensive ones queued
+    before it, but an expensive job is overtaken for a bounded time only, since the jobs
+    queued after it get later ranks (aging).
+
+    It has the same put/get/qsize/empty interface as queue.Queue, and blocking gets wait on
+    a condition, so idle workers are only woken up by new tasks.'''
+    def __init__(self, stretch, priority_step, cost_model=None):
+        self.stretch = stretch
+        self.priority_step = priority_step
+        self.cost_model = cost_model or CostModel()
+
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = Condition()
+
+    @property
+    def costs(self):
+        '''Get the expected run time of every job type seen.'''
+        return self.cost_model.costs
+
+    def expected_cost(self, task):
+        '''Estimate the run time of a task, from the run times of its job types.'''
+        return self.cost_model.expected_cost(task)
+
+    def record(self, job_type, seconds):
+        '''Update the expected run time of a job type with an observed run time.'''
+        self.cost_model.record(job_type, seconds)
+
+    def put(self, task):
+        '''Queue a task. A None sentinel is ranked after every task.'''
+        if task is None:
+            rank = math.inf
+        else:
+            priority = task[2].get("priority") or 0
+            rank = (time.monotonic() + self.stretch * self.expected_cost(task)
+                    - self.priority_step * priority)
+
+        with self.condition:
+            # The counter keeps equal ranks in FIFO order and avoids comparing the tasks
+            heapq.heappush(self.heap, (rank, next(self.counter), task))
+            self.condition.notify()
+
+    def get(self, block=True, timeout=None):
+        '''Remove and return the task with the lowest rank, raising Empty like Queue.get.'''
+        with self.condition:
+            if not block:
+                if not self.heap:
+                    raise Empty
+            elif timeout is None:
+                while not self.heap:
+                    self.condition.wait()
+            else:
+                deadline = time.monotonic() + timeout
+                while not self.heap:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Empty
+                    self.condition.wait(remaining)
+
+            return heapq.heappop(self.heap)[2]
+
+    def qsize(self):
+        '''Get the number of queued tasks.'''
+        return len(self.heap)
+
+    def empty(self):
+        '''Check if there are no queued tasks.'''
+        return not self.heap
+
+def create_scheduler(name, stretch, priority_step, cost_model=None):
+    '''Create the scheduler with the given name ("cost" or "fifo"), ranking the tasks with
+    cost_model if it uses run time estimates.'''
+    if name == "fifo":
+        return FifoScheduler()
+    if name == "cost":
+        return CostAwareScheduler(stretch, priority_step, cost_model)
+    raise ValueError(f"Unknown scheduler: {name}")
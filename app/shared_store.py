@@ -0,0 +1,431 @@
+from threading import Event, Thread, local
+import fcntl
+import json
+import os
+import queue
+import sqlite3
+import time
+
+from app.job_registry import STATUSES, STATUS_CODES
+from app.result_store import serialize_response
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_type TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    created REAL NOT NULL,
+    parameters TEXT,
+    owner INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_running ON jobs (job_id) WHERE status = 0;
+CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created);
+CREATE TABLE IF NOT EXISTS batches (batch_id INTEGER PRIMARY KEY AUTOINCREMENT);
+CREATE TABLE IF NOT EXISTS batch_jobs (
+    batch_id INTEGER PRIMARY KEY,
+    first_job_id INTEGER NOT NULL,
+    last_job_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS batch_jobs_last_job_id ON batch_jobs (last_job_id);
+CREATE TABLE IF NOT EXISTS owners (owner INTEGER PRIMARY KEY AUTOINCREMENT);
+CREATE TABLE IF NOT EXISTS results (
+    job_id INTEGER PRIMARY KEY,
+    body BLOB NOT NULL,
+    stored_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_stored_at ON results (stored_at);
+"""
+
+class SharedDatabase:
+    '''SQLite database in WAL mode shared by several server processes, so that readers never
+    block the writer. Every thread gets its own connection, opened on first use, so the
+    database can be created before the server processes are forked.
+
+    With synchronous="NORMAL", the WAL is only synced at checkpoints: a crash of the process
+    loses nothing, a crash of the machine can lose the last transactions but never corrupts
+    the database. "FULL" also syncs it at every commit.'''
+    def __init__(self, path, synchronous="NORMAL", timeout=30):
+        self.path = path
+        self.synchronous = synchronous
+        self.timeout = timeout
+        self.connections = local()
+
+        connection = self.connect()
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+
+    def connect(self):
+        '''Open a new connection, committing every statement outside explicit transactions.'''
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                     check_same_thread=False)
+        connection.execute(f"PRAGMA synchronous={self.synchronous}")
+        return connection
+
+    @property
+    def connection(self):
+        '''Get the connection of the calling thread.'''
+        connection = getattr(self.connections, "connection", None)
+        if connection is None:
+            connection = self.connections.connection = self.connect()
+        return connection
+
+    def write(self, function):
+        '''Run function(connection) in a write transaction and return its result.'''
+        connection = self.connection
+        # Take the write lock upfront, so that the transaction never fails to upgrade it
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = function(connection)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
+
+    def read(self, function):
+        '''Run function(connection) in a read transaction, seeing a single snapshot of the
+        database, and return its result.'''
+        connection = self.connection
+        connection.execute("BEGIN")
+        try:
+            return function(connection)
+        finally:
+            connection.execute("COMMIT")
+
+class SharedJobRegistry:
+    '''JobRegistry kept in a SharedDatabase, so that the job ids are unique across the server
+    processes using it and any of them can report the status of any job.
+
+    The eviction is the one of JobRegistry: the oldest completed jobs are dropped once they are
+    older than the last max_jobs jobs or older than max_age seconds (0 disables the age limit),
+    and on_evict is called with the evicted ids. Their results are deleted with them, and the
+    running jobs are kept however old they are.
+
+    The parameters of the jobs are kept with them, together with the owner (the registry that
+    allocated them), which holds a lock on <path>.owners/<owner>.lock while it is open. The
+    running jobs of an owner whose lock is free were lost when its process stopped, so they
+    can be recovered and queued again.'''
+    def __init__(self, database, max_jobs, max_age, on_evict=None):
+        self.database = database
+        self.max_jobs = max_jobs
+        self.max_age = max_age
+        self.on_evict = on_evict
+        self.evict_chunk = max(1, max_jobs // 16)
+        self.last_age_check = 0
+
+        self.owner = self.database.write(
+            lambda connection: connection.execute("INSERT INTO owners DEFAULT VALUES").lastrowid)
+        os.makedirs(self.owners_directory(), exist_ok=True)
+        self.owner_lock = open(self.owner_lock_path(self.owner), "w")
+        fcntl.flock(self.owner_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def owners_directory(self):
+        '''Get the directory of the owner lock files.'''
+        return self.database.path + ".owners"
+
+    def owner_lock_path(self, owner):
+        '''Get the path of the lock file of an owner.'''
+        return os.path.join(self.owners_directory(), f"{owner}.lock")
+
+    def is_owner_alive(self, owner):
+        '''Check if the registry of an owner is still open, in any process.'''
+        try:
+            lock = open(self.owner_lock_path(owner), "r")
+        except FileNotFoundError:
+            return False
+
+        with lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+
+        os.remove(self.owner_lock_path(owner))
+        return False
+
+    def recover(self):
+        '''Take over the running jobs of the owners that stopped, returning their
+        (job_id, job_type, parameters) triples to be queued again.'''
+        running = STATUS_CODES["running"]
+
+        def claim(connection):
+            owners = [owner for owner, in connection.execute(
+                "SELECT DISTINCT owner FROM jobs WHERE status = ? AND parameters IS NOT NULL",
+                (running,))]
+            stopped = [owner for owner in owners if owner != self.owner and not self.is_owner_alive(owner)]
+
+            jobs = []
+            for owner in stopped:
+                rows = connection.execute(
+                    "UPDATE jobs SET owner = ? WHERE owner = ? AND status = ? AND parameters IS NOT NULL "
+                    "RETURNING job_id, job_type, parameters", (self.owner, owner, running)).fetchall()
+                jobs += [(job_id, job_type, json.loads(parameters)) for job_id, job_type, parameters in rows]
+            return sorted(jobs)
+
+        return self.database.write(claim)
+
+    def close(self):
+        '''Release the lock of the owner, so that its running jobs can be recovered.'''
+        os.remove(self.owner_lock_path(self.owner))
+        self.owner_lock.close()
+
+    def allocate(self, job_type, parameters=None):
+        '''Register a new running job and return its id. The parameters (a JSON serializable
+        dict) are kept to queue the job again if it is recovered.'''
+        return self.allocate_many([job_type], None if parameters is None else [parameters])[0]
+
+    def allocate_many(self, job_types, parameters=None):
+        '''Register new running jobs, one per job type (with the parameters at the same
+        index), and return their consecutive ids.'''
+        now = time.time()
+        running = STATUS_CODES["running"]
+        if parameters is None:
+            parameters = [None] * len(job_types)
+
+        def insert(connection):
+            connection.executemany(
+                "INSERT INTO jobs (job_type, status, created, parameters, owner) VALUES (?, ?, ?, ?, ?)",
+                [(job_type, running, now, None if job_parameters is None else json.dumps(job_parameters),
+                  self.owner) for job_type, job_parameters in zip(job_types, parameters)])
+            # The write lock is held, so the ids of the transaction are consecutive
+            last_id = connection.execute("SELECT last_insert_rowid()").fetchone()[0]
+            return last_id, self.evict(connection, now)
+
+        last_id, evicted = self.database.write(insert)
+
+        if evicted and self.on_evict is not None:
+            self.on_evict(evicted)
+
+        return list(range(last_id - len(job_types) + 1, last_id + 1))
+
+    def allocate_batch_id(self, job_ids=None):
+        '''Allocate the id of a new batch of the given consecutive job ids (as allocated by
+        allocate_many), which any process can then look up with get_batch.'''
+        def insert(connection):
+            batch_id = connection.execute("INSERT INTO batches DEFAULT VALUES").lastrowid
+            if job_ids:
+                connection.execute("INSERT INTO batch_jobs VALUES (?, ?, ?)",
+                                   (batch_id, min(job_ids), max(job_ids)))
+            return batch_id
+
+        return self.database.write(insert)
+
+    def get_batch(self, batch_id):
+        '''Get the job ids of a batch, or None if it is unknown or was evicted.'''
+        row = self.database.connection.execute(
+            "SELECT first_job_id, last_job_id FROM batch_jobs WHERE batch_id = ?", (batch_id,)).fetchone()
+        return None if row is None else list(range(row[0], row[1] + 1))
+
+    def evict(self, connection, now):
+        '''Evict the oldest completed jobs over the limits, together with their results,
+        returning the evicted ids. Must be called in a write transaction.'''
+        running = STATUS_CODES["running"]
+        # Only the leading running jobs are scanned to find the oldest completed one
+        row = connection.execute("SELECT job_id FROM jobs WHERE status != ? ORDER BY job_id LIMIT 1",
+                                 (running,)).fetchone()
+        if row is None:
+            return []
+        first_done = row[0]
+
+        # The jobs older than the last max_jobs ids are too many. The running jobs are never
+        # evicted, so a stuck one is kept without blocking the eviction of the jobs after it
+        last_id = connection.execute("SELECT MAX(job_id) FROM jobs").fetchone()[0]
+        max_id = last_id - self.max_jobs
+        check_age = self.max_age and now - self.last_age_check >= 1
+
+        if max_id - first_done + 1 < self.evict_chunk and not check_age:
+            return []
+
+        if check_age:
+            self.last_age_check = now
+
+        max_created = now - self.max_age if check_age else float("-inf")
+
+        predicate = "status != ? AND (job_id <= ? OR created < ?)"
+        bounds = (running, max_id, max_created)
+        # Their results go in the same transaction, instead of one statement per id afterwards
+        connection.execute(f"DELETE FROM results WHERE job_id IN (SELECT job_id FROM jobs WHERE {predicate})",
+                           bounds)
+        rows = connection.execute(f"DELETE FROM jobs WHERE {predicate} RETURNING job_id", bounds).fetchall()
+        # A batch is dropped once its last job is past the max_jobs limit, even if some of its
+        # jobs are still running
+        connection.execute("DELETE FROM batch_jobs WHERE last_job_id <= ?", (max_id,))
+        return sorted(job_id for job_id, in rows)
+
+    def get(self, job_id, default=None):
+        '''Get the status of a job, or default if it is unknown or evicted.'''
+        row = self.database.connection.execute("SELECT status FROM jobs WHERE job_id = ?",
+                                               (job_id,)).fetchone()
+        return default if row is None else STATUSES[row[0]]
+
+    def get_type(self, job_id):
+        '''Get the type of a job, or None if it is unknown or evicted.'''
+        row = self.database.connection.execute("SELECT job_type FROM jobs WHERE job_id = ?",
+                                               (job_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def __contains__(self, job_id):
+        return self.get(job_id) is not None
+
+    def __getitem__(self, job_id):
+        status = self.get(job_id)
+        if status is None:
+            raise KeyError(job_id)
+        return status
+
+    def __setitem__(self, job_id, status):
+        self.database.connection.execute("UPDATE jobs SET status = ? WHERE job_id = ?",
+                                         (STATUS_CODES[status], job_id))
+
+    def __len__(self):
+        return self.database.connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def items(self):
+        '''Get the (job_id, status) pairs of the retained jobs.'''
+        rows = self.database.connection.execute("SELECT job_id, status FROM jobs ORDER BY job_id")
+        return [(job_id, STATUSES[code]) for job_id, code in rows]
+
+    def page(self, after_id, limit, status=None, job_type=None):
+        '''Get up to limit (job_id, status, job_type) triples of the retained jobs with ids greater
+        than after_id, optionally filtered by status and job type. Returns the triples, the id
+        to resume from and whether there are more jobs.'''
+        if status is not None and status not in STATUS_CODES:
+            return [], after_id, False
+
+        query = "SELECT job_id, status, job_type FROM jobs WHERE job_id > ?"
+        parameters = [after_id]
+        if status is not None:
+            query += " AND status = ?"
+            parameters.append(STATUS_CODES[status])
+        if job_type is not None:
+            query += " AND job_type = ?"
+            parameters.append(job_type)
+        query += " ORDER BY job_id LIMIT ?"
+        parameters.append(limit + 1)
+
+        def select(connection):
+            rows = connection.execute(query, parameters).fetchall()
+            last_id = connection.execute("SELECT MAX(job_id) FROM jobs").fetchone()[0]
+            return rows, last_id
+
+        rows, last_id = self.database.read(select)
+        jobs = [(job_id, STATUSES[code], name) for job_id, code, name in rows[:limit]]
+
+        if len(rows) > limit:
+            return jobs, jobs[-1][0], True
+        # Every job of the snapshot was scanned
+        return jobs, max(last_id or 0, after_id), False
+
+    def values(self):
+        '''Get the statuses of the retained jobs.'''
+        return [status for _, status in self.items()]
+
+class GroupCommitWriter(Thread):
+    '''Background thread writing the results of the jobs to a SharedDatabase and marking them
+    done (or failed), committing all the results queued meanwhile (at most batch_size) in one transaction,
+    so that the workers completing jobs concurrently share the commits. A None entry stops it.'''
+    def __init__(self, database, batch_size):
+        super().__init__(name="job-store-writer", daemon=True)
+        self.database = database
+        self.queue = queue.Queue()
+        self.batch_size = batch_size
+
+    def write(self, job_id, body, stored_at, status="done"):
+        '''Queue the result of a job, finished with the given status, and block until it is
+        committed.'''
+        # [job_id, body, stored_at, status code, committed, error]
+        entry = [job_id, body, stored_at, STATUS_CODES[status], Event(), None]
+        self.queue.put(entry)
+        while not entry[4].wait(1):
+            if not self.is_alive():
+                raise RuntimeError("The job store writer is stopped")
+
+        if entry[5] is not None:
+            raise entry[5]
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            entries = [entry for entry in batch if entry is not None]
+            if entries:
+                self.commit(entries)
+
+            if len(entries) < len(batch):
+                break
+
+    def commit(self, entries):
+        '''Write a batch of results in one transaction and wake up their writers.'''
+        def insert(connection):
+            connection.executemany(
+                "INSERT OR REPLACE INTO results (job_id, body, stored_at) VALUES (?, ?, ?)",
+                [(job_id, body, stored_at) for job_id, body, stored_at, _, _, _ in entries])
+            connection.executemany("UPDATE jobs SET status = ? WHERE job_id = ?",
+                                   [(entry[3], entry[0]) for entry in entries])
+
+        try:
+            self.database.write(insert)
+        except Exception as error:
+            for entry in entries:
+                entry[5] = error
+
+        for entry in entries:
+            entry[4].set()
+
+    def stop(self, timeout=5):
+        '''Write the queued results and stop the thread.'''
+        self.queue.put(None)
+        self.join(timeout)
+
+class SharedResultStore:
+    '''ResultStore kept in a SharedDatabase, so that any of the server processes using it can
+    serve the result of any job, and the results outlive the processes. Storing a result also
+    marks its job done, in a group commit with the results stored concurrently (see
+    GroupCommitWriter). Every result is dropped ttl seconds after it was stored (ttl = 0 keeps
+    them forever).'''
+    def __init__(self, database, ttl, batch_size=256):
+        self.database = database
+        self.ttl = ttl
+        self.gc_interval = min(ttl, 60) if ttl > 0 else 0
+        self.last_gc = time.time()
+        self.writer = GroupCommitWriter(database, batch_size)
+        self.writer.start()
+
+    def put(self, job_id, res, status="done"):
+        '''Store the result of a job and mark the job with the given status, once committed.'''
+        now = time.time()
+        self.writer.write(job_id, serialize_response(res, status), now, status)
+
+        if self.gc_interval and now - self.last_gc >= self.gc_interval:
+            self.collect_garbage()
+
+    def get(self, job_id):
+        '''Get the serialized get_results response of a job, or None if there is none.'''
+        row = self.database.connection.execute(
+            "SELECT body, stored_at FROM results WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None or self.is_expired(row[1]):
+            return None
+        return row[0]
+
+    def collect_garbage(self):
+        '''Drop every expired result.'''
+        self.last_gc = time.time()
+        if self.ttl:
+            self.database.connection.execute("DELETE FROM results WHERE stored_at < ?",
+                                             (self.last_gc - self.ttl,))
+
+    def is_expired(self, stored_at):
+        '''Check if a result stored at the given time has expired.'''
+        return self.ttl > 0 and time.time() - stored_at > self.ttl
+
+    def close(self):
+        '''Write the queued results and stop the writer.'''
+        self.writer.stop()
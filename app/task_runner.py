@@ -1,8 +1,38 @@
-from queue import Queue, Empty
-from threading import Thread, Event
+from collections import OrderedDict
+from threading import Thread, Event, local
+import heapq
 import os
-import json
-import math
+import time
+
+from app import log
+from app.result_cache import ResultCache, CACHE_HIT, CACHE_LEADER
+from app.result_store import ResultStore
+from app.job_events import JobEvents
+from app.scheduler import CostModel, create_scheduler
+from app.job_registry import JobRegistry
+from app.shared_store import SharedDatabase, SharedJobRegistry, SharedResultStore
+from app.metrics import Metrics
+
+JOB_TYPES = ["state_mean", "states_mean", "best5", "worst5", "global_mean", "diff_from_mean",
+             "state_diff_from_mean", "mean_by_category", "state_mean_by_category", "topk"]
+
+# Directions and grouping levels of the topk jobs
+TOPK_DIRECTIONS = {"best", "worst"}
+TOPK_GROUPS = {"state", "stratification"}
+
+class JobError:
+    '''Result of a job that raised an exception, completing it with the "error" status.'''
+    def __init__(self, reason):
+        self.reason = reason
+
+    @classmethod
+    def from_exception(cls, error):
+        '''Describe the exception raised by a job.'''
+        return cls(f"{type(error).__name__}: {error}")
+
+def task_jobs(task):
+    '''Get the jobs of a queued task, either a single job or a batch of jobs.'''
+    return task[2]["jobs"] if task[1] == "batch" else [task]
 
 class ThreadPool:
     '''ThreadPool class to manage a pool of threads for executing tasks concurrently.'''
@@ -12,198 +42,586 @@ class ThreadPool:
         else:
             self.num_threads = os.cpu_count()
 
-        self.task_queue = Queue()
+        # Expected run time of every job type, learned from the computed jobs
+        self.cost_model = CostModel()
+        # TP_SCHEDULER=fifo keeps the plain first come, first served queue
+        self.task_queue = create_scheduler(os.environ.get("TP_SCHEDULER", "cost"),
+                                           float(os.environ.get("TP_SCHED_STRETCH", 10)),
+                                           float(os.environ.get("TP_SCHED_PRIORITY_STEP", 1)),
+                                           self.cost_model)
         self.threads = []
         self.shutdown_event = Event()
-        self.jobs_dict = {}
-        self.res_dict = {}
+        self.create_job_store()
         self.data = data
         self.dataIngestor = dataIngestor
-
+        self.result_cache = ResultCache(int(os.environ.get("TP_RESULT_CACHE_SIZE", 1024)))
+        self.job_events = JobEvents()
+        # batch_id -> job ids of the batch, for the most recent batches
+        self.batches = OrderedDict()
+        self.max_batches = int(os.environ.get("TP_MAX_BATCHES", 10000))
+        self.metrics = self.create_metrics()
+        # TaskRunner of every request thread computing synchronous jobs
+        self.sync_runners = local()
+
+        self.start_workers()
+
+        if self.shared_database is not None:
+            self.recover_jobs()
+
+    def create_job_store(self):
+        '''Create the registry of the jobs and the store of their results. TP_JOB_STORE=<path>
+        keeps both in a SQLite database shared by all the server processes using that path, so
+        that any of them can report on any job, and which outlives them, instead of in this
+        process. TP_JOB_STORE_SYNC=FULL syncs it at every commit.'''
+        max_jobs = int(os.environ.get("TP_MAX_JOBS", 1000000))
+        max_age = float(os.environ.get("TP_MAX_JOB_AGE", 24 * 60 * 60))
+        ttl = float(os.environ.get("TP_RESULT_TTL", 24 * 60 * 60))
+
+        self.shared_database = None
+        if os.environ.get("TP_JOB_STORE"):
+            self.shared_database = SharedDatabase(os.environ["TP_JOB_STORE"],
+                                                  os.environ.get("TP_JOB_STORE_SYNC", "NORMAL"))
+            # The registry deletes the results of the jobs it evicts itself
+            self.jobs_dict = SharedJobRegistry(self.shared_database, max_jobs, max_age)
+            self.result_store = SharedResultStore(self.shared_database, ttl,
+                                                  int(os.environ.get("TP_JOB_STORE_BATCH_SIZE", 256)))
+        else:
+            self.jobs_dict = JobRegistry(max_jobs, max_age, on_evict=self.discard_results)
+            self.result_store = ResultStore("results",
+                                            int(os.environ.get("TP_RESULT_MEMORY_BYTES", 64 * 1024 * 1024)),
+                                            ttl)
+
+    def recover_jobs(self):
+        '''Queue again the jobs left running by the server processes that stopped before
+        completing them.'''
+        jobs = self.jobs_dict.recover()
+
+        for job_id, job_type, parameters in jobs:
+            self.submit_job([job_id, job_type, parameters])
+
+        if jobs:
+            log.logger.info(f"Recovered {len(jobs)} jobs left running by stopped servers")
+
+    def create_metrics(self):
+        '''Create the instrumentation of the pool.'''
+        metrics = Metrics()
+
+        # Looked up at scrape time, ProcessPool replaces the queue when it starts its workers
+        metrics.add_gauge("tp_queue_depth", "Number of queued tasks", lambda: self.task_queue.qsize())
+        metrics.add_gauge("tp_busy_workers", "Number of workers running a task", self.busy_workers)
+        metrics.add_gauge("tp_workers", "Number of workers", lambda: self.num_threads)
+        metrics.add_gauge("tp_log_dropped_records", "Log records dropped because the log queue was full",
+                          log.dropped_records)
+        metrics.add_gauge("tp_dataset_bytes", "Bytes used by the compact dataset",
+                          lambda: self.dataIngestor.dataset.memory_usage()["total"])
+        metrics.describe("tp_jobs_submitted_total", "Jobs submitted")
+        metrics.describe("tp_cache_hits_total", "Jobs answered from the result cache")
+        metrics.describe("tp_tasks_enqueued_total", "Tasks (jobs or batches) queued")
+        metrics.describe("tp_jobs_completed_total", "Jobs completed")
+        metrics.describe("tp_jobs_failed_total", "Jobs completed with an error")
+        metrics.describe("tp_queue_wait_seconds", "Time tasks spent in the queue")
+        metrics.describe("tp_compute_seconds", "Time spent computing jobs")
+        metrics.describe("tp_result_write_seconds", "Time spent storing and publishing results")
+        metrics.describe("tp_sync_jobs_total", "Jobs answered inline by the synchronous mode")
+        metrics.describe("tp_sync_fallbacks_total",
+                         "Synchronous jobs over the time budget, submitted as jobs instead")
+
+        return metrics
+
+    def busy_workers(self):
+        '''Get the number of workers running a task.'''
+        return sum(thread.busy for thread in self.threads)
+
+    def start_workers(self):
+        '''Start the TaskRunner threads.'''
         for i in range(self.num_threads):
             self.threads.append(TaskRunner(self.task_queue, self.shutdown_event, self.jobs_dict,
-                                           self.res_dict, self.data, self.dataIngestor))
+                                           self.result_store, self.data, self.dataIngestor,
+                                           thread_pool=self))
             self.threads[i].start()
 
     def add_task(self, task):
         '''Add task to the thread pool queue'''
+        task[2]["enqueued_at"] = time.monotonic()
+        self.metrics.inc("tp_tasks_enqueued_total", task[1])
+
         self.task_queue.put(task)
 
+    def submit_job(self, job):
+        '''Submit a job, answering it from the result cache or attaching it to an identical
+        running job when possible, and queueing it otherwise.'''
+        job_id, job_type, job_data = job
+        job_data["version"] = self.dataIngestor.version
+        key = ResultCache.job_key(job_type, job_data)
+        self.metrics.inc("tp_jobs_submitted_total", job_type)
+
+        outcome, res = self.result_cache.acquire(key, job_id)
+
+        if outcome == CACHE_HIT:
+            self.metrics.inc("tp_cache_hits_total", job_type)
+            self.metrics.inc("tp_jobs_completed_total", job_type)
+            self.complete_job(job_id, res)
+        elif outcome == CACHE_LEADER:
+            self.add_task(job)
+
+    def batch_jobs(self, batch_id):
+        '''Get the job ids of a batch, or None if it is unknown or was evicted. The shared
+        registry keeps the batches of every server process using it.'''
+        if self.shared_database is not None:
+            return self.jobs_dict.get_batch(batch_id)
+        return self.batches.get(batch_id)
+
+    def submit_batch(self, batch_id, jobs, priority=0):
+        '''Submit a batch of jobs, queueing the ones that have to be computed as a single task.'''
+        self.batches[batch_id] = [job[0] for job in jobs]
+        while len(self.batches) > self.max_batches:
+            self.batches.popitem(last=False)
+
+        to_compute = []
+
+        for job in jobs:
+            job_id, job_type, job_data = job
+            job_data["version"] = self.dataIngestor.version
+            key = ResultCache.job_key(job_type, job_data)
+            self.metrics.inc("tp_jobs_submitted_total", job_type)
+
+            outcome, res = self.result_cache.acquire(key, job_id)
+
+            if outcome == CACHE_HIT:
+                self.metrics.inc("tp_cache_hits_total", job_type)
+                self.metrics.inc("tp_jobs_completed_total", job_type)
+                self.complete_job(job_id, res)
+            elif outcome == CACHE_LEADER:
+                to_compute.append(job)
+
+        if to_compute:
+            self.add_task([batch_id, "batch", {"jobs": to_compute, "priority": priority}])
+
+    def finish_jobs(self, results):
+        '''Finish the (job, result, run time in seconds) triples computed for a task. A job that
+        cannot be finished is failed instead, so that neither it nor the identical jobs attached
+        to it stay running, and the other jobs of the task are still finished.'''
+        for job, res, seconds in results:
+            try:
+                self.finish_job(job, res, seconds)
+            except Exception as e:
+                log.logger.exception(f"Failed to finish job {job[0]}")
+                try:
+                    self.fail_job(job, ResultCache.job_key(job[1], job[2]), JobError.from_exception(e))
+                except Exception:
+                    log.logger.exception(f"Failed to fail job {job[0]}")
+
+    def finish_job(self, job, res, seconds=None):
+        '''Complete a computed job together with the identical jobs attached to it, recording
+        the time it took to compute (if known) and to store the results.'''
+        start = time.perf_counter()
+        job_id, job_type, job_data = job
+        key = ResultCache.job_key(job_type, job_data)
+
+        if isinstance(res, JobError):
+            self.fail_job(job, key, res)
+            return
+
+        # Recorded before the waiters of the jobs are woken up
+        if seconds is not None:
+            self.cost_model.record(job_type, seconds)
+            self.metrics.observe("tp_compute_seconds", job_type, seconds)
+
+        # Once the followers are taken from the cache, nothing else can complete them
+        followers = self.result_cache.resolve(key, res)
+        self.metrics.inc("tp_jobs_completed_total", job_type, 1 + len(followers))
+        self.complete_jobs([job_id] + followers, res)
+
+        self.metrics.observe("tp_result_write_seconds", job_type, time.perf_counter() - start)
+
+    def fail_job(self, job, key, error):
+        '''Complete a failed job together with the identical jobs attached to it with the
+        "error" status, without caching the error.'''
+        job_id, job_type, _ = job
+        followers = self.result_cache.fail(key)
+
+        self.metrics.inc("tp_jobs_failed_total", job_type, 1 + len(followers))
+        self.metrics.inc("tp_jobs_completed_total", job_type, 1 + len(followers))
+
+        self.complete_jobs([job_id] + followers, error.reason, "error")
+
+    def execute_sync(self, jobs, budget):
+        '''Compute jobs ([job_type, job_data] pairs) inline on the calling thread, skipping the
+        queue, the registry and the result store, if they are expected to take at most budget
+        seconds in total (the cached results are free). Returns their results in order, or
+        None if they have to be submitted as jobs instead, which is also how a failed job gets
+        its error reported.'''
+        results = [None] * len(jobs)
+        to_compute = []
+
+        for i, (job_type, job_data) in enumerate(jobs):
+            job_data["version"] = self.dataIngestor.version
+            key = ResultCache.job_key(job_type, job_data)
+            found, res = self.result_cache.lookup(key)
+            if found:
+                results[i] = res
+            else:
+                to_compute.append([i, job_type, job_data])
+
+        task = [None, "batch", {"jobs": to_compute}]
+        if self.cost_model.expected_cost(task) > budget:
+            for job_type, _ in jobs:
+                self.metrics.inc("tp_sync_fallbacks_total", job_type)
+            return None
+
+        if to_compute:
+            if len(to_compute) == 1:
+                task = to_compute[0]
+
+            computed = self.sync_runner().execute_task(task)
+            if any(isinstance(res, JobError) for _, res, _ in computed):
+                for job_type, _ in jobs:
+                    self.metrics.inc("tp_sync_fallbacks_total", job_type)
+                return None
+
+            for job, res, seconds in computed:
+                i, job_type, job_data = job
+                results[i] = res
+                self.cost_model.record(job_type, seconds)
+                self.metrics.observe("tp_compute_seconds", job_type, seconds)
+                self.result_cache.put(ResultCache.job_key(job_type, job_data), res)
+
+        for job_type, _ in jobs:
+            self.metrics.inc("tp_sync_jobs_total", job_type)
+
+        return results
+
+    def sync_runner(self):
+        '''Get the TaskRunner computing the synchronous jobs of the calling thread.'''
+        runner = getattr(self.sync_runners, "runner", None)
+        if runner is None:
+            runner = TaskRunner(None, None, self.jobs_dict, self.result_store, self.data,
+                                self.dataIngestor, thread_pool=self)
+            self.sync_runners.runner = runner
+        return runner
+
+    def complete_jobs(self, job_ids, res, status="done"):
+        '''Complete jobs with the same result. A job whose result cannot be stored (e.g. the
+        store failed to write it) is completed with an error instead.'''
+        for job_id in job_ids:
+            try:
+                self.complete_job(job_id, res, status)
+            except Exception as e:
+                log.logger.exception(f"Failed to complete job {job_id}")
+                try:
+                    self.complete_job(job_id, JobError.from_exception(e).reason, "error")
+                except Exception:
+                    log.logger.exception(f"Failed to complete job {job_id} with an error")
+
+    def complete_job(self, job_id, res, status="done"):
+        '''Save the result of a job and mark it as done (or with the "error" status).'''
+        self.result_store.put(job_id, res, status)
+
+        # The shared store sets the status of the job in the transaction storing its result
+        if self.shared_database is None:
+            self.jobs_dict[job_id] = status
+        self.job_events.notify(job_id)
+        self.job_events.publish(job_id, status, res)
+
+    def reload_dataset(self):
+        '''Load the CSV again and swap it in as a new dataset version, returning the version.'''
+        return self.swap_dataset(self.dataIngestor.reload())
+
+    def append_rows(self, columns):
+        '''Append rows (column -> list of values) to the dataset as a new version, returning
+        the version.'''
+        return self.swap_dataset(self.dataIngestor.append_rows(columns))
+
+    def swap_dataset(self, version):
+        '''Drop the results cached for the previous dataset versions once a new version is
+        swapped in. The running tasks finish against the version they started with.'''
+        self.result_cache.clear()
+        log.logger.info(f"Swapped in dataset version {version.number} "
+                        f"with {len(version.dataset)} rows")
+        return version
+
+    def discard_results(self, job_ids):
+        '''Drop the results of the jobs evicted from the registry.'''
+        for job_id in job_ids:
+            self.result_store.discard(job_id)
+
+    def wait_for_job(self, job_id, timeout):
+        '''Block until a job is done, for at most timeout seconds. Returns True if it is done.'''
+        is_done = lambda: self.jobs_dict.get(job_id) != "running"
+        if self.shared_database is None:
+            return self.job_events.wait(job_id, is_done, timeout)
+
+        # The jobs run by the other server processes are not notified here, so the shared
+        # store is polled every TP_JOB_STORE_POLL seconds meanwhile
+        interval = float(os.environ.get("TP_JOB_STORE_POLL", 0.05))
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if self.job_events.wait(job_id, is_done, min(remaining, interval)):
+                return True
+            if remaining <= interval:
+                return is_done()
+
     def shutdown(self):
-        '''Shutdown the thread pool by setting the shutdown event and joining all threads.'''
+        '''Shutdown the thread pool: set the shutdown event, queue one sentinel per thread after
+        the pending tasks and join the threads, waiting at most TP_SHUTDOWN_TIMEOUT seconds.
+        Returns the number of seconds it took to drain the queue and stop the threads.'''
+        start = time.monotonic()
+        deadline = start + float(os.environ.get("TP_SHUTDOWN_TIMEOUT", 30))
+
         self.shutdown_event.set()
-        print(self.num_threads)
+        for _ in self.threads:
+            self.task_queue.put(None)
+
         for thread in self.threads:
-            print("Shutdown thread")
+            thread.join(max(deadline - time.monotonic(), 0))
+
+        alive = [thread for thread in self.threads if thread.is_alive()]
+        if alive:
+            # Their jobs are still running, so they must not be recovered by another server
+            # before the threads stop
+            Thread(target=self.close_job_store, args=(alive,), name="job-store-closer", daemon=True).start()
+        else:
+            self.close_job_store()
+
+        elapsed = time.monotonic() - start
+        if alive:
+            log.logger.warning(f"Thread pool shutdown timed out after {elapsed:.3f}s, "
+                               f"{len(alive)} threads still running")
+        else:
+            log.logger.info(f"Thread pool drained and stopped in {elapsed:.3f}s")
+
+        return elapsed
+
+    def close_job_store(self, threads=()):
+        '''Once the given threads have stopped, write the pending results to the shared store
+        and release the jobs still running, to be recovered by the next server.'''
+        for thread in threads:
             thread.join()
 
+        if self.shared_database is not None:
+            self.result_store.close()
+            self.jobs_dict.close()
+
     def is_queue_empty(self):
         '''Check if the task queue is empty.'''
         return self.task_queue.empty()
 
 class TaskRunner(Thread):
     '''TaskRunner class to execute tasks from the task queue.'''
-    def __init__(self, task_queue, shutdown_event, jobs_dict, res_dict, data, dataIngestor):
+    def __init__(self, task_queue, shutdown_event, jobs_dict, result_store, data, dataIngestor,
+                 thread_pool=None):
         super().__init__()
 
         self.task_queue = task_queue
         self.shutdown_event = shutdown_event
         self.jobs_dict = jobs_dict
-        self.res_dict = res_dict
+        self.result_store = result_store
         self.data = data
         self.dataIngestor = dataIngestor
+        self.thread_pool = thread_pool
+        self.batch_memo = None
+        self.version = None
+        self.busy = False
 
     def run(self):
         while True:
-            if self.task_queue.empty() and self.shutdown_event.is_set():
+            # Blocks until there is a task, a None sentinel stops the thread
+            task = self.task_queue.get()
+            if task is None:
                 break
 
-            try:
-                task = self.task_queue.get(timeout=0.1)
-            except Empty:
-                continue
-
-            job_id = task[0]
-            job_type = task[1]
-            job_data = task[2]
-
-            self.jobs_dict[job_id] = "running"
-
-            res = None
-
-            # Execute the task based on the job_type
-            match job_type:
-                case "state_mean":
-                    state = job_data["state"]
-                    question = job_data["question"]
-                    res = self.find_state_mean(state, question)
-
-                case "states_mean":
-                    question = job_data["question"]
-                    res = self.find_states_mean(question)
-
-                case "best5":
-                    question = job_data["question"]
-                    res = self.find_best5(question)
-
-                case "worst5":
-                    question = job_data["question"]
-                    res = self.find_worst5(question)
-
-                case "global_mean":
-                    question = job_data["question"]
-                    res = self.find_global_mean(question)
+            self.busy = True
+            self.thread_pool.metrics.observe("tp_queue_wait_seconds", task[1],
+                                             time.monotonic() - task[2]["enqueued_at"])
 
-                case "diff_from_mean":
-                    question = job_data["question"]
-                    res = self.find_diff_from_mean(question)
-
-                case "state_diff_from_mean":
-                    question = job_data["question"]
-                    state = job_data["state"]
-                    res = self.find_state_diff_from_mean(state, question)
-
-                case "mean_by_category":
-                    question = job_data["question"]
-                    res = self.find_mean_by_category(question)
-
-                case "state_mean_by_category":
-                    question = job_data["question"]
-                    state = job_data["state"]
-                    res = self.find_state_mean_by_category(state, question)
-
-                case _:
-                    res = None
-
-            # Save the result to the file corresponding to the job_id
-            if res:
-                with open(f"results/{job_id}.json", "w") as f:
-                    json.dump(res, f)
+            # The failing jobs are completed with an error by execute_task and finish_jobs,
+            # this only keeps the thread alive if anything else fails
+            try:
+                self.thread_pool.finish_jobs(self.execute_task(task))
+            except Exception:
+                log.logger.exception(f"Failed to complete task {task[0]}")
+            finally:
+                self.busy = False
+
+    def execute_task(self, task):
+        '''Compute a queued task, either a single job or a batch of jobs, and return the
+        (job, result, run time in seconds) triples of its jobs. A job raising an exception
+        gets a JobError result, and the other jobs of its batch are still computed.'''
+        try:
+            # The task runs against the dataset version current when it starts, even if a new
+            # version is swapped in meanwhile
+            self.version = self.dataIngestor.current
+            if task[1] != "batch":
+                return [self.execute_timed_job(task)]
+
+            # The jobs of a batch share the per-question aggregations they need, and are
+            # grouped by question so that consecutive jobs reuse the same cube slices
+            jobs = sorted(task[2]["jobs"], key=lambda job: str(job[2]["question"]))
+            self.batch_memo = {}
+            return [self.execute_timed_job(job) for job in jobs]
+        except Exception as error:
+            # Only failures outside of the jobs themselves get here
+            log.logger.exception(f"Failed to compute task {task[0]}")
+            return [(job, JobError.from_exception(error), None) for job in task_jobs(task)]
+        finally:
+            self.batch_memo = None
+            self.version = None
+
+    def dataset_version(self):
+        '''Get the dataset version the running task is pinned to (or the current one).'''
+        return self.version or self.dataIngestor.current
+
+    def execute_timed_job(self, job):
+        '''Compute a job and return its (job, result, run time in seconds) triple. A job raising
+        an exception gets a JobError result instead.'''
+        start = time.perf_counter()
+        try:
+            res = self.execute_job(job[1], job[2])
+        except Exception as error:
+            log.logger.exception(f"Job {job[0]} ({job[1]}) failed")
+            res = JobError.from_exception(error)
+        return job, res, time.perf_counter() - start
+
+    def execute_job(self, job_type, job_data):
+        '''Compute the result of a job.'''
+        # Execute the task based on the job_type
+        match job_type:
+            case "state_mean":
+                state = job_data["state"]
+                question = job_data["question"]
+                res = self.find_state_mean(state, question)
+
+            case "states_mean":
+                question = job_data["question"]
+                res = self.find_states_mean(question)
+
+            case "best5":
+                question = job_data["question"]
+                res = self.find_best5(question)
+
+            case "worst5":
+                question = job_data["question"]
+                res = self.find_worst5(question)
+
+            case "global_mean":
+                question = job_data["question"]
+                res = self.find_global_mean(question)
+
+            case "diff_from_mean":
+                question = job_data["question"]
+                res = self.find_diff_from_mean(question)
+
+            case "state_diff_from_mean":
+                question = job_data["question"]
+                state = job_data["state"]
+                res = self.find_state_diff_from_mean(state, question)
+
+            case "mean_by_category":
+                question = job_data["question"]
+                res = self.find_mean_by_category(question)
+
+            case "state_mean_by_category":
+                question = job_data["question"]
+                state = job_data["state"]
+                res = self.find_state_mean_by_category(state, question)
+
+            case "topk":
+                question = job_data["question"]
+                res = self.find_topk(question, **job_data["options"])
+
+            case _:
+                res = None
 
-            self.jobs_dict[job_id] = "done"
+        return res
 
     def find_state_mean(self, state, question):
         '''Find the mean of a specific state for a given question.'''
-        sum = 0
-        count = 0
+        totals = self.dataset_version().cube.state_totals(question).get(state)
 
-        dict_list = self.find_rows_for_question(question)
-
-        for row in dict_list:
-            if row["LocationDesc"] == state:
-                sum += row["Data_Value"]
-                count += 1
-        if count == 0:
+        if totals is None:
             return 0
 
-        return {state: sum / count}
+        return {state: totals[0] / totals[1]}
 
     def find_states_mean(self, question):
         '''Find the mean of all states for a given question.'''
-        dict_list = self.find_rows_for_question(question)
-        res = {}
+        if self.batch_memo is not None:
+            key = ("states_mean", question)
+            if key not in self.batch_memo:
+                self.batch_memo[key] = self.compute_states_mean(question)
+            return self.batch_memo[key]
 
-        for row in dict_list:
-            if row["LocationDesc"] not in res:
-                res[row["LocationDesc"]] = {"sum": 0, "count": 0}
-            res[row["LocationDesc"]]["sum"] += row["Data_Value"]
-            res[row["LocationDesc"]]["count"] += 1
+        return self.compute_states_mean(question)
 
+    def compute_states_mean(self, question):
+        '''Compute the sorted means of all states for a given question.'''
         new_res = {}
 
-        for location in res:
-            res[location]["mean"] = res[location]["sum"] / res[location]["count"]
-            new_res[location] = res[location]["mean"]
+        for location, totals in self.dataset_version().cube.state_totals(question).items():
+            new_res[location] = totals[0] / totals[1]
 
         sorted_res = dict(sorted(new_res.items(), key=lambda x: x[1]))
 
         return sorted_res
 
     def find_rows_for_question(self, question):
-        '''Find rows in data dictionary for a specific question.'''
-        dict_list = []
-
-        for row in self.data:
-            if row["Question"] == question:
-                dict_list.append(row)
-        return dict_list
+        '''Find the columnar partition holding the rows of a specific question.'''
+        return self.dataset_version().dataset.partition(question)
 
     def find_best5(self, question):
         '''Find the best 5 states for a given question.'''
-        mean_states = self.find_states_mean(question)
-
-        mean_states_list = list(mean_states.items())
-
-        if question in self.dataIngestor.questions_best_is_min:
-            return dict(mean_states_list[:5])
-
-        return dict(mean_states_list[-5:])
+        return self.find_topk(question, 5, "best")
 
     def find_worst5(self, question):
         '''Find the worst 5 states for a given question.'''
-        mean_states = self.find_states_mean(question)
-
-        mean_states_list = list(mean_states.items())
+        return self.find_topk(question, 5, "worst")
+
+    def find_topk(self, question, k=5, direction="best", group="state"):
+        '''Find the k best or worst groups (states, or (state, category, stratification)
+        triples) of a question by mean. The best are listed by increasing mean and the worst by
+        decreasing mean, the ties in order of appearance, as if the means were fully sorted.
+
+        Only the k extreme means are selected with a heap, in O(n log k). Whether the lowest or
+        the highest means are the best is looked up in a set of the questions.'''
+        means = self.dataset_version().cube.means(question, group)
+        if k <= 0:
+            return {}
+
+        # Ranked by (mean, position), the order of a stable sort by mean
+        rank = lambda item: (item[1][1], item[0])
+        lowest = (question in self.dataIngestor.best_is_min) == (direction == "best")
+        if lowest:
+            top = heapq.nsmallest(k, enumerate(means), key=rank)
+        else:
+            top = heapq.nlargest(k, enumerate(means), key=rank)
 
-        if question in self.dataIngestor.questions_best_is_min:
-            return dict(reversed(mean_states_list[-5:]))
+        # The selection is by increasing rank for the lowest and decreasing rank for the highest
+        if lowest != (direction == "best"):
+            top.reverse()
 
-        return dict(reversed(mean_states_list[:5]))
+        if group == "state":
+            return {state: mean for _, (state, mean) in top}
+        return {str(key): mean for _, (key, mean) in top}
 
     def find_global_mean(self, question):
         '''Find the global mean for a given question.'''
-        dict_list = self.find_rows_for_question(question)
-        sum = 0
-        count = 0
+        if self.batch_memo is not None:
+            key = ("global_mean", question)
+            if key not in self.batch_memo:
+                self.batch_memo[key] = self.compute_global_mean(question)
+            return self.batch_memo[key]
+
+        return self.compute_global_mean(question)
 
-        for row in dict_list:
-            sum += row["Data_Value"]
-            count += 1
+    def compute_global_mean(self, question):
+        '''Compute the global mean for a given question.'''
+        totals = self.dataset_version().cube.question_totals(question)
 
-        if count == 0:
+        if totals is None:
             return 0
-        
-        return {"global_mean": sum / count}
+
+        return {"global_mean": totals[0] / totals[1]}
 
     def find_diff_from_mean(self, question):
         '''Find the difference from the mean for all states for a given question.'''
@@ -227,27 +645,9 @@ class TaskRunner(Thread):
 
     def find_mean_by_category(self, question):
         '''Find the mean by category for a given question.'''
-        dict_list = self.find_rows_for_question(question)
-        res = {}
-
-        for row in dict_list:
-            if any(
-                val is None or (isinstance(val, float) and math.isnan(val))
-                for val in [row["StratificationCategory1"], row["Stratification1"]]
-            ):
-                continue
-            new_key = [row["LocationDesc"], row["StratificationCategory1"], row["Stratification1"]]
-            new_key = tuple(new_key)
-            if new_key not in res:
-                res[new_key] = {"sum": 0, "count": 0}
-            res[new_key]["sum"] += row["Data_Value"]
-            res[new_key]["count"] += 1
-
-        new_res = {}
-
-        for key in res:
-            str_key = str(key)
-            new_res[str_key] = res[key]["sum"] / res[key]["count"]
+        # The groups with a missing category or stratification are already left out
+        means = self.dataset_version().cube.means(question, "stratification")
+        new_res = {str(key): mean for key, mean in means}
 
         sorted_res = dict(sorted(new_res.items(), key=lambda x: x[0]))
 
@@ -255,23 +655,11 @@ class TaskRunner(Thread):
 
     def find_state_mean_by_category(self, state, question):
         '''Find the mean by category for a specific state for a given question.'''
-        dict_list = self.find_rows_for_question(question)
-        res = {}
-
-        for row in dict_list:
-            if row["LocationDesc"] == state:
-                new_key = [row["StratificationCategory1"], row["Stratification1"]]
-                new_key = tuple(new_key)
-                if new_key not in res:
-                    res[new_key] = {"sum": 0, "count": 0}
-                res[new_key]["sum"] += row["Data_Value"]
-                res[new_key]["count"] += 1
-
         new_res = {}
 
-        for key in res:
+        for key, totals in self.dataset_version().cube.strata(question).get(state, {}).items():
             str_key = str(key)  # convert the tuple to a string
-            new_res[str_key] = res[key]["sum"] / res[key]["count"]
+            new_res[str_key] = totals[0] / totals[1]
 
         sorted_res = dict(sorted(new_res.items(), key=lambda x: x[0]))
 
@@ -0,0 +1,152 @@
+import unittest
+from unittest import mock
+import inspect
+import json
+import os
+import tempfile
+import time
+
+from app.data_ingestor import DataIngestor
+from app.task_runner import TaskRunner
+from app.client import QUESTIONS, generate_csv
+
+# Baselines of the benchmarks, keyed by benchmark name: the seconds per call divided by the
+# seconds of the calibration workload timed in the same run, so that they hold across machines
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baselines.json")
+
+# Dataset sizes (rows) and question cardinalities the benchmarks run on
+SIZES = [int(size) for size in os.environ.get("TP_BENCHMARK_SIZES", "1000,10000,100000").split(",")]
+CARDINALITIES = [int(count) for count in os.environ.get("TP_BENCHMARK_QUESTIONS", "9,90").split(",")]
+# Allowed slowdown over the baseline before a benchmark fails, 1 is twice as slow. The
+# sub-microsecond jobs vary by about that much from one run to the next
+TOLERANCE = float(os.environ.get("TP_BENCHMARK_TOLERANCE", 1))
+# Every benchmark keeps the fastest of this many rounds
+REPEAT = int(os.environ.get("TP_BENCHMARK_REPEAT", 5))
+# Every round repeats the benchmark until it lasts at least this many seconds
+MIN_ROUND = float(os.environ.get("TP_BENCHMARK_MIN_ROUND", 0.05))
+# States the state jobs are timed for, when the dataset has them
+STATES = ["California", "Ohio", "Texas", "Wyoming", "National"]
+
+def make_questions(count):
+    '''Get count question texts, the survey questions first.'''
+    return (QUESTIONS + [f"Synthetic question {i}" for i in range(len(QUESTIONS), count)])[:count]
+
+def best_time(function, calls):
+    '''Time REPEAT rounds of function and return the fastest, divided by calls. Every round
+    runs function as many times as the first call fits in MIN_ROUND seconds.'''
+    start = time.perf_counter()
+    function()
+    loops = max(int(MIN_ROUND / (time.perf_counter() - start)), 1)
+
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        best = min(best, (time.perf_counter() - start) / loops)
+    return best / calls
+
+def calibration_workload():
+    '''Fixed dict, string and float work like the one of the jobs, timed with the benchmarks
+    to express them relative to the speed of the machine running them.'''
+    totals = {}
+    for i in range(1000):
+        key = f"state {i % 50}"
+        totals[key] = totals.get(key, 0.0) + i / 3
+    return sorted(totals.items(), key=lambda item: item[1])[:5]
+
+@unittest.skipUnless(os.environ.get("TP_RUN_BENCHMARKS"), "set TP_RUN_BENCHMARKS=1 to run the benchmarks")
+class TestBenchmarks(unittest.TestCase):
+    '''Time DataIngestor construction and every TaskRunner.find_* method across dataset sizes
+    and question cardinalities, failing when one is slower than its baseline in
+    benchmark_baselines.json by more than TP_BENCHMARK_TOLERANCE. The times are compared as
+    ratios to the time of calibration_workload, so the baselines do not depend on the machine
+    as long as it is about as much faster at the benchmarks as at the calibration.
+
+    TP_UPDATE_BENCHMARKS=1 writes the measured ratios as the new baselines, and
+    TP_BENCHMARK_OUTPUT=<path> also writes them to another file.'''
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.results = {}
+        cls.calibration = best_time(calibration_workload, 1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def benchmark_ingestor(self, csv_path, label):
+        '''Time loading a CSV from scratch, from its snapshot and streamed.'''
+        with mock.patch.dict(os.environ, {"TP_DATA_SNAPSHOT": "0"}):
+            self.results[f"DataIngestor.csv[{label}]"] = best_time(lambda: DataIngestor(csv_path), 1)
+
+        with mock.patch.dict(os.environ, {"TP_DATA_SNAPSHOT": "1"}):
+            DataIngestor(csv_path)
+            self.results[f"DataIngestor.snapshot[{label}]"] = best_time(lambda: DataIngestor(csv_path), 1)
+
+        with mock.patch.dict(os.environ, {"TP_DATA_SNAPSHOT": "0", "TP_INGEST": "stream"}):
+            self.results[f"DataIngestor.stream[{label}]"] = best_time(lambda: DataIngestor(csv_path), 1)
+
+    def benchmark_runner(self, ingestor, questions, label):
+        '''Time every find_* method over all questions (and STATES for the state methods).'''
+        runner = TaskRunner(None, None, {}, {}, ingestor.data, ingestor)
+
+        for name, method in inspect.getmembers(runner, inspect.ismethod):
+            if not name.startswith("find_"):
+                continue
+
+            if "state" in inspect.signature(method).parameters:
+                # Only the states with rows, the state jobs fail for the others
+                calls = [(state, question) for question in questions for state in STATES
+                         if state in ingestor.cube.state_totals(question)]
+            else:
+                calls = [(question,) for question in questions]
+
+            def run_calls():
+                for args in calls:
+                    method(*args)
+
+            self.results[f"TaskRunner.{name}[{label}]"] = best_time(run_calls, len(calls))
+
+    def test_benchmarks(self):
+        '''Run the benchmarks and compare them with the baselines.'''
+        for rows in SIZES:
+            for count in CARDINALITIES:
+                label = f"rows={rows},questions={count}"
+                questions = make_questions(count)
+                csv_path = os.path.join(self.directory.name, f"benchmark_{rows}_{count}.csv")
+                generate_csv(csv_path, rows, questions=questions)
+
+                self.benchmark_ingestor(csv_path, label)
+                with mock.patch.dict(os.environ, {"TP_DATA_SNAPSHOT": "0"}):
+                    self.benchmark_runner(DataIngestor(csv_path), questions, label)
+
+        ratios = {name: seconds / self.calibration for name, seconds in self.results.items()}
+
+        if os.environ.get("TP_BENCHMARK_OUTPUT"):
+            with open(os.environ["TP_BENCHMARK_OUTPUT"], "w") as f:
+                json.dump(ratios, f, indent=2, sort_keys=True)
+
+        baselines = {}
+        if os.path.exists(BASELINES_PATH):
+            with open(BASELINES_PATH) as f:
+                baselines = json.load(f)
+
+        if os.environ.get("TP_UPDATE_BENCHMARKS"):
+            baselines.update(ratios)
+            with open(BASELINES_PATH, "w") as f:
+                json.dump(baselines, f, indent=2, sort_keys=True)
+                f.write("\n")
+            return
+
+        for name, ratio in sorted(ratios.items()):
+            baseline = baselines.get(name)
+            if baseline is None:
+                continue
+            with self.subTest(benchmark=name):
+                self.assertLessEqual(ratio, baseline * (1 + TOLERANCE),
+                                     f"{name} took {ratio:.3g} calibrations ({self.results[name]:.3g}s), "
+                                     f"baseline {baseline:.3g}")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,32 @@
 import unittest
+from unittest import mock
+import json
+import logging
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
 
 from app import webserver, DataIngestor, ThreadPool
 from app.task_runner import TaskRunner
+from app.result_cache import ResultCache, CACHE_HIT, CACHE_JOINED, CACHE_LEADER
+from app.result_store import ResultStore, serialize_response
+from app.columnar import CompactDataset, pack_dataset, unpack_dataset
+from app.aggregate_cube import AggregateCube, normalize_missing
+from app.groupby import add_rows, encode_column, factorize
+from app.job_events import JobEvents, Subscriber
+from app.scheduler import CostAwareScheduler
+from app.job_registry import JobRegistry
+from app.process_pool import ProcessPool
+from app import log
+from app.log import BatchWriter, DroppingQueueHandler
+from app.metrics import Metrics
+from app.client import LoadTest, FlaskClientTransport, generate_csv, parse_mix, percentile
 
 class TestServer(unittest.TestCase):
     def setUp(self):
@@ -198,6 +223,849 @@ class TestServer(unittest.TestCase):
         }
         self.assertEqual(result, expected)
 
+    def test_17_questions_index(self):
+        '''Test that the ingestor partitions the rows by question.'''
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+
+        partition = self.server.data_ingestor.get_question_partition(question)
+        self.assertEqual(partition["LocationDesc"], ["California", "California", "Nevada"])
+        self.assertEqual(partition["Data_Value"], [10, 20, 30])
+
+        partition = self.server.data_ingestor.get_question_partition("Unknown question")
+        self.assertEqual(partition["Data_Value"], [])
+
+    def test_18_aggregate_cube(self):
+        '''Test the (sum, count) aggregates built by the ingestor.'''
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        cube = self.server.data_ingestor.cube
+
+        self.assertEqual(cube.question_totals(question), [60, 3])
+        self.assertEqual(cube.state_totals(question), {"California": [30, 2], "Nevada": [30, 1]})
+        self.assertIsNone(cube.question_totals("Unknown question"))
+
+    def test_19_result_cache(self):
+        '''Test the single-flight de-duplication and LRU eviction of the result cache.'''
+        cache = ResultCache(1)
+        key = ResultCache.make_key("global_mean", "question", "California")
+        self.assertEqual(key, ResultCache.make_key("global_mean", "question", None))
+
+        self.assertEqual(cache.acquire(key, 1), (CACHE_LEADER, None))
+        self.assertEqual(cache.acquire(key, 2), (CACHE_JOINED, None))
+        self.assertEqual(cache.resolve(key, {"global_mean": 20.0}), [2])
+        self.assertEqual(cache.acquire(key, 3), (CACHE_HIT, {"global_mean": 20.0}))
+
+        other_key = ResultCache.make_key("state_mean", "question", "Nevada")
+        cache.acquire(other_key, 4)
+        cache.resolve(other_key, {"Nevada": 30.0})
+        self.assertEqual(cache.acquire(key, 5), (CACHE_LEADER, None))
+
+    def test_20_result_store(self):
+        '''Test that the result store spills to disk over its memory budget and expires results.'''
+        with tempfile.TemporaryDirectory() as directory:
+            store = ResultStore(directory, 64, 0)
+
+            store.put(1, {"California": 15.0})
+            store.put(2, {"Nevada": 30.0})
+
+            self.assertIn(1, store.on_disk)
+            self.assertIn(2, store.memory)
+            self.assertEqual(store.get(1), b'{"data":{"California":15.0},"status":"done"}\n')
+            self.assertEqual(store.get(2), b'{"data":{"Nevada":30.0},"status":"done"}\n')
+
+            store.ttl = 0.01
+            time.sleep(0.02)
+            store.collect_garbage()
+            self.assertIsNone(store.get(1))
+            self.assertIsNone(store.get(2))
+
+    def test_21_shared_partitions(self):
+        '''Test that the dataset mapped from the packed layout gives the same results.'''
+        shared_memory = self.server.data_ingestor.export_shared_memory()
+        try:
+            dataset = unpack_dataset(shared_memory.buf)
+        finally:
+            shared_memory.close()
+            shared_memory.unlink()
+
+        ingestor = DataIngestor("./test.csv", dataset)
+        runner = TaskRunner(None, None, {}, {}, ingestor.data, ingestor)
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+
+        self.assertEqual(runner.find_states_mean(question), self.runner.find_states_mean(question))
+        self.assertEqual(runner.find_state_mean_by_category("California", question),
+                         self.runner.find_state_mean_by_category("California", question))
+        self.assertEqual(len(unpack_dataset(pack_dataset(CompactDataset.from_rows([])))), 0)
+
+    def test_22_batch_route(self):
+        '''Test the /api/batch endpoint.'''
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        data = {
+            "jobs": [
+                {"job_type": "state_mean", "question": question, "state": "California"},
+                {"job_type": "global_mean", "question": question},
+                {"job_type": "best5", "question": question},
+            ]
+        }
+
+        response = self.client.post('/api/batch', json=data)
+        self.assertEqual(response.status_code, 200)
+        response_data = response.json
+        self.assertIn('batch_id', response_data)
+        self.assertEqual(len(response_data["job_ids"]), 3)
+
+        expected = [{"California": 15.0}, {"global_mean": 20.0}, {"California": 15.0, "Nevada": 30.0}]
+        for job_id, result in zip(response_data["job_ids"], expected):
+            for _ in range(100):
+                results = self.client.get(f'/api/get_results/{job_id}').json
+                if results["status"] != "running":
+                    break
+                time.sleep(0.01)
+            self.assertEqual(results, {"status": "done", "data": result})
+
+        response = self.client.post('/api/batch', json=[{"job_type": "unknown", "question": question}])
+        self.assertEqual(response.status_code, 400)
+
+    def test_23_get_results_wait(self):
+        '''Test the long-poll mode of the /api/get_results endpoint.'''
+        data = {
+            "question": "Percent of adults aged 18 years and older who have an overweight classification",
+            "state": "Nevada"
+        }
+
+        job_id = self.client.post('/api/state_mean', json=data).json["job_id"]
+
+        response = self.client.get(f'/api/get_results/{job_id}?wait=5')
+        self.assertEqual(response.json, {"status": "done", "data": {"Nevada": 30.0}})
+
+        events = JobEvents()
+        self.assertFalse(events.wait(1, lambda: False, 0.01))
+        self.assertTrue(events.wait(1, lambda: True, 0.01))
+        self.assertEqual(events.waiters, {})
+
+    def test_24_events_stream(self):
+        '''Test the /api/events endpoint and the bounded buffer of its subscribers.'''
+        data = {
+            "question": "Percent of adults aged 18 years and older who have an overweight classification",
+            "state": "California"
+        }
+
+        first_id = self.client.post('/api/state_mean', json=data).json["job_id"]
+        second_id = self.client.post('/api/global_mean', json=data).json["job_id"]
+
+        response = self.client.get(f'/api/events?job_ids={first_id},{second_id}')
+        self.assertEqual(response.status_code, 200)
+        body = response.get_data(as_text=True)
+        self.assertIn(f'"job_id": {first_id}, "status": "done", "result": {{"California": 15.0}}', body)
+        self.assertIn(f'"job_id": {second_id}, "status": "done", "result": {{"global_mean": 20.0}}', body)
+
+        for query in ["job_ids=1,abc", "batch_id=abc"]:
+            self.assertEqual(self.client.get(f'/api/events?{query}').status_code, 400)
+
+        subscriber = Subscriber(None, 1)
+        subscriber.push(1, "first")
+        subscriber.push(2, "second")
+        self.assertEqual(subscriber.pop_all(0), ([(1, "first")], 1))
+
+    def test_25_cost_aware_scheduler(self):
+        '''Test that the scheduler runs cheap and high priority jobs first.'''
+        scheduler = CostAwareScheduler(10, 1)
+        scheduler.record("mean_by_category", 1.0)
+        scheduler.record("state_mean", 0.001)
+
+        scheduler.put([1, "mean_by_category", {"question": "q", "state": None}])
+        scheduler.put([2, "state_mean", {"question": "q", "state": "Nevada"}])
+        scheduler.put([3, "mean_by_category", {"question": "q", "state": None, "priority": 100}])
+
+        self.assertEqual(scheduler.qsize(), 3)
+        self.assertEqual([scheduler.get()[0] for _ in range(3)], [3, 2, 1])
+        self.assertTrue(scheduler.empty())
+
+        scheduler.record("state_mean", 0.002)
+        self.assertAlmostEqual(scheduler.costs["state_mean"], 0.0012)
+
+    def test_26_shutdown_drains_queue(self):
+        '''Test that shutting down the thread pool runs the queued jobs, then stops the threads.'''
+        pool = ThreadPool(self.server.data_ingestor.data, self.server.data_ingestor)
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+
+        for _ in range(10):
+            job_id = pool.jobs_dict.allocate("states_mean")
+            pool.submit_job([job_id, "states_mean", {"question": question, "state": None}])
+
+        elapsed = pool.shutdown()
+
+        self.assertLess(elapsed, 5)
+        self.assertFalse(any(thread.is_alive() for thread in pool.threads))
+        self.assertTrue(all(status == "done" for status in pool.jobs_dict.values()))
+        self.assertTrue(pool.is_queue_empty())
+
+    def test_27_job_registry(self):
+        '''Test the id allocation and eviction of the job registry.'''
+        evicted = []
+        registry = JobRegistry(2, 0, on_evict=evicted.extend)
+
+        self.assertEqual(registry.allocate("state_mean"), 1)
+        self.assertEqual(registry.allocate_many(["best5", "worst5"]), [2, 3])
+        self.assertEqual(registry[1], "running")
+        self.assertEqual(registry.get_type(2), "best5")
+
+        # The running jobs are never evicted
+        registry.allocate("global_mean")
+        self.assertEqual(evicted, [])
+
+        registry[1] = "done"
+        registry[2] = "done"
+        registry.allocate("global_mean")
+        self.assertEqual(evicted, [1, 2])
+        self.assertNotIn(1, registry)
+        self.assertEqual(registry.items(), [(3, "running"), (4, "running"), (5, "running")])
+
+        # A running job at the head does not block the eviction of the completed jobs after it
+        for job_id in [4, 5]:
+            registry[job_id] = "done"
+        registry.allocate("global_mean")
+        self.assertEqual(evicted, [1, 2, 4, 5])
+        self.assertEqual(registry.items(), [(3, "running"), (6, "running")])
+        self.assertEqual(registry.get_type(3), "worst5")
+        self.assertEqual(registry.page(0, 10), ([(3, "running", "worst5"), (6, "running", "global_mean")],
+                                                6, False))
+        self.assertEqual(registry.page(3, 10), ([(6, "running", "global_mean")], 6, False))
+
+        registry[3] = "done"
+        registry.allocate("global_mean")
+        self.assertEqual(evicted, [1, 2, 4, 5, 3])
+        self.assertEqual(registry.items(), [(6, "running"), (7, "running")])
+
+    def test_28_jobs_pagination(self):
+        '''Test the pagination and filters of the /api/jobs endpoint.'''
+        data = {
+            "question": "Percent of adults aged 18 years and older who have an overweight classification",
+            "state": "California"
+        }
+
+        job_ids = [self.client.post('/api/state_mean', json=data).json["job_id"] for _ in range(3)]
+        job_ids.append(self.client.post('/api/global_mean', json=data).json["job_id"])
+        self.client.get(f'/api/get_results/{job_ids[-1]}?wait=5')
+
+        response = self.client.get('/api/jobs?limit=2').json
+        self.assertEqual([list(job)[0] for job in response["data"]], [str(job_ids[0]), str(job_ids[1])])
+        self.assertTrue(response["has_more"])
+
+        response = self.client.get(f'/api/jobs?limit=2&cursor={response["next_cursor"]}').json
+        self.assertEqual([list(job)[0] for job in response["data"]], [str(job_ids[2]), str(job_ids[3])])
+        self.assertFalse(response["has_more"])
+
+        response = self.client.get(f'/api/jobs?since={job_ids[0]}&job_type=global_mean').json
+        self.assertEqual(response["data"], [{str(job_ids[3]): "done"}])
+
+        response = self.client.get('/api/jobs?status=unknown').json
+        self.assertEqual(response["data"], [])
+
+    def test_29_metrics_route(self):
+        '''Test the /api/metrics and /api/num_jobs endpoints.'''
+        data = {
+            "question": "Percent of adults aged 18 years and older who have an overweight classification"
+        }
+
+        job_id = self.client.post('/api/global_mean', json=data).json["job_id"]
+        self.client.get(f'/api/get_results/{job_id}?wait=5')
+
+        response = self.client.get('/api/metrics')
+        self.assertEqual(response.status_code, 200)
+        body = response.get_data(as_text=True)
+        self.assertIn('tp_jobs_submitted_total{job_type="global_mean"} 1', body)
+        self.assertIn('tp_jobs_completed_total{job_type="global_mean"} 1', body)
+        self.assertIn('tp_compute_seconds_count{job_type="global_mean"} 1', body)
+        self.assertIn('tp_queue_wait_seconds_bucket{job_type="global_mean",le="+Inf"} 1', body)
+        self.assertIn('tp_busy_workers 0', body)
+
+        response = self.client.get('/api/num_jobs')
+        self.assertEqual(response.json, {"status": "done", "data": 0})
+
+    def test_30_log_queue_drops_when_full(self):
+        '''Test that the log queue handler drops and counts the records it cannot queue.'''
+        handler = DroppingQueueHandler(queue.Queue(1), 10)
+        test_logger = logging.getLogger("webserver-test")
+        test_logger.propagate = False
+        test_logger.addHandler(handler)
+        try:
+            test_logger.warning("Got request: %s", "x" * 100)
+            test_logger.warning("Dropped")
+        finally:
+            test_logger.removeHandler(handler)
+
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(handler.queue.get_nowait().getMessage(), "Got reques...")
+
+        # The traceback of an exception is kept whole
+        test_logger.addHandler(handler)
+        try:
+            try:
+                raise ValueError("y" * 100)
+            except ValueError:
+                test_logger.exception("Failed: %s", "x" * 100)
+        finally:
+            test_logger.removeHandler(handler)
+
+        message = handler.queue.get_nowait().getMessage()
+        self.assertTrue(message.startswith("Failed: xx...\nTraceback"))
+        self.assertTrue(message.endswith("ValueError: " + "y" * 100))
+
+        # Stopping the writer does not hang when the queue is full
+        writer = BatchWriter(queue.Queue(1), None, 1)
+        writer.queue.put_nowait("record")
+        start = time.monotonic()
+        writer.stop(timeout=0.1)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_31_data_snapshot(self):
+        '''Test that the snapshot gives the same partitions and is ignored once the CSV changes.'''
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "test.csv")
+            shutil.copy("./test.csv", csv_path)
+
+            ingestor = DataIngestor(csv_path)
+            self.assertTrue(os.path.exists(csv_path + ".snapshot"))
+            self.assertEqual(ingestor.source, "csv")
+
+            # The cube is loaded from the snapshot instead of being built, and the columns are
+            # views over the mapping
+            with mock.patch.object(DataIngestor, "build_aggregate_cube") as build_aggregate_cube:
+                mapped = DataIngestor(csv_path)
+            build_aggregate_cube.assert_not_called()
+            self.assertEqual(mapped.source, "snapshot")
+            self.assertIsInstance(mapped.dataset.values, memoryview)
+            self.assertEqual(mapped.dataset.questions, ingestor.dataset.questions)
+            self.assertEqual(json.dumps(mapped.cube.export()), json.dumps(ingestor.cube.export()))
+
+            # Touched without changes, the hash still matches
+            os.utime(csv_path, ns=(0, 0))
+            self.assertEqual(DataIngestor(csv_path).source, "snapshot")
+
+            with open(csv_path, "a") as f:
+                f.write("\n")
+            self.assertEqual(DataIngestor(csv_path).source, "csv")
+
+    def test_32_compact_dataset(self):
+        '''Test that the compact dataset encodes the strings once and keeps the row order.'''
+        dataset = CompactDataset.from_rows([
+            {"Question": "Q1", "LocationDesc": "Ohio", "Data_Value": 1.0,
+             "StratificationCategory1": "Age", "Stratification1": "18 - 24"},
+            {"Question": "Q2", "LocationDesc": "Utah", "Data_Value": 2.0,
+             "StratificationCategory1": "Age", "Stratification1": "18 - 24"},
+            {"Question": "Q1", "LocationDesc": "Utah", "Data_Value": 3.0,
+             "StratificationCategory1": float("nan"), "Stratification1": float("nan")},
+        ])
+
+        self.assertEqual(dataset.questions, ["Q1", "Q2"])
+        self.assertEqual(dataset.tables["LocationDesc"], ["Ohio", "Utah"])
+        self.assertEqual(list(dataset.codes["LocationDesc"]), [0, 1, 1])
+        self.assertEqual(dataset.partition("Q1")["Data_Value"], [1.0, 3.0])
+        self.assertEqual(list(dataset.rows("Q2")), [("Utah", 2.0, "Age", "18 - 24")])
+        self.assertEqual(dataset.partition("Q3")["LocationDesc"], [])
+
+        usage = self.server.data_ingestor.memory_usage()
+        self.assertLess(usage["compact"], usage["row_dicts"])
+        response = self.client.get('/api/dataset?memory=1')
+        self.assertEqual(response.json["data"]["memory_usage"], usage)
+        self.assertNotIn("memory_usage", self.client.get('/api/dataset').json["data"])
+
+    def test_33_dataset_append(self):
+        '''Test that appended rows are swapped in as a new version, updating the aggregates like
+        a full load would, while a pinned version is left unchanged.'''
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        rows = [
+            {"Question": question, "LocationDesc": "Nevada", "Data_Value": 50},
+            {"Question": "New question", "LocationDesc": "Ohio", "Data_Value": 7.5,
+             "StratificationCategory1": "Age (years)", "Stratification1": "18 - 24"},
+        ]
+        ingestor = self.server.data_ingestor
+        pinned = ingestor.current
+        self.runner.version = pinned
+
+        response = self.client.post('/api/dataset/append', json={"rows": rows})
+        self.assertEqual(response.json["data"]["version"], pinned.number + 1)
+        self.assertEqual(response.json["data"]["rows"], len(pinned.dataset) + 2)
+
+        self.assertEqual(self.runner.find_state_mean("Nevada", question), {"Nevada": 30})
+        self.runner.version = None
+        self.assertEqual(self.runner.find_state_mean("Nevada", question), {"Nevada": 40})
+        self.assertEqual(self.runner.find_global_mean("New question"), {"global_mean": 7.5})
+
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "test.csv")
+            shutil.copy("./test.csv", csv_path)
+            with open(csv_path, "a") as f:
+                f.write(f"2011,2011,NV,Nevada,BRFSS,{question},50,,\n")
+                f.write("2011,2011,OH,Ohio,BRFSS,New question,7.5,Age (years),18 - 24\n")
+
+            reloaded = DataIngestor(csv_path)
+            self.assertEqual(ingestor.cube.states, reloaded.cube.states)
+            self.assertEqual(ingestor.cube.questions, reloaded.cube.questions)
+
+        response = self.client.post('/api/dataset/append', json={"rows": [{"Question": question}]})
+        self.assertEqual(response.status_code, 400)
+
+    def test_34_streamed_ingest(self):
+        '''Test that streaming the CSV in chunks gives the same aggregates without the rows.'''
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "test.csv")
+            shutil.copy("./test.csv", csv_path)
+
+            with mock.patch.dict(os.environ, {"TP_INGEST": "stream", "TP_INGEST_CHUNK_ROWS": "2"}):
+                streamed = DataIngestor(csv_path)
+                mapped = DataIngestor(csv_path)
+
+            self.assertEqual(len(streamed.dataset), 0)
+            self.assertEqual(mapped.source, "snapshot")
+            for ingestor in [streamed, mapped]:
+                self.assertEqual(ingestor.cube.states, self.server.data_ingestor.cube.states)
+                self.assertEqual(ingestor.cube.questions, self.server.data_ingestor.cube.questions)
+
+            # The snapshot of the streamed CSV holds no rows, so it is not used to load them
+            self.assertEqual(DataIngestor(csv_path).source, "csv")
+
+    def test_35_load_test(self):
+        '''Test the load generator against the test client and its synthetic CSV generator.'''
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        load_test = LoadTest(FlaskClientTransport(self.server), parse_mix("state_mean=2,best5,batch"),
+                             clients=3, requests=30, batch_size=3, questions=[question],
+                             states=["California", "Nevada"], sample_interval=0.01)
+        report = load_test.run()
+
+        self.assertEqual(report["completed"], 30)
+        self.assertEqual(report["errors"], 0)
+        self.assertEqual(sum(summary["count"] for summary in report["by_kind"].values()), 30)
+        self.assertLessEqual(report["latency"]["p50"], report["latency"]["p99"])
+        self.assertEqual(percentile([1, 2, 3, 4], 0.5), 2)
+        with self.assertRaises(ValueError):
+            parse_mix("unknown=1")
+
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "synthetic.csv")
+            generate_csv(csv_path, 500)
+            self.assertEqual(len(DataIngestor(csv_path).dataset), 500)
+
+        class SlowTransport:
+            def post(self, path, body):
+                time.sleep(0.02)
+                return 200, {"job_id": 1}
+
+            def get(self, path):
+                return 200, {"status": "done", "data": 0}
+
+        # The 10 requests all arrive within about 10ms, the single client sends the last one
+        # after the 9 before it took 20ms each, and its latency counts that wait
+        report = LoadTest(SlowTransport(), parse_mix("global_mean"), clients=1, requests=10,
+                          rate=1000, sample_interval=0.01).run()
+        self.assertGreaterEqual(report["latency"]["max"], 0.15)
+
+    def test_36_shared_job_store(self):
+        '''Test that two pools sharing a job store, as two server processes would, allocate
+        distinct job ids and serve the results of each other's jobs.'''
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        ingestor = self.server.data_ingestor
+
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.dict(os.environ, {"TP_JOB_STORE": os.path.join(directory, "jobs.db"),
+                                              "TP_NUM_OF_THREADS": "1", "TP_MAX_JOBS": "4"}):
+                first = ThreadPool(ingestor.data, ingestor)
+                second = ThreadPool(ingestor.data, ingestor)
+
+            try:
+                job_id = first.jobs_dict.allocate("state_mean")
+                first.submit_job([job_id, "state_mean", {"question": question, "state": "Nevada"}])
+                self.assertEqual(second.jobs_dict.allocate_many(["best5", "worst5"]),
+                                 [job_id + 1, job_id + 2])
+                # The batches are shared too
+                batch_id = second.jobs_dict.allocate_batch_id([job_id + 1, job_id + 2])
+                self.assertEqual(first.batch_jobs(batch_id), [job_id + 1, job_id + 2])
+                self.assertIsNone(first.batch_jobs(batch_id + 1))
+
+                self.assertTrue(second.wait_for_job(job_id, 5))
+                self.assertEqual(second.result_store.get(job_id), b'{"data":{"Nevada":30.0},"status":"done"}\n')
+                self.assertEqual(second.jobs_dict.get_type(job_id), "state_mean")
+
+                jobs, next_cursor, has_more = second.jobs_dict.page(0, 2, status="running")
+                self.assertEqual(jobs, [(2, "running", "best5"), (3, "running", "worst5")])
+                self.assertEqual((next_cursor, has_more), (3, False))
+
+                # The done job is evicted with its result once over TP_MAX_JOBS
+                first.jobs_dict.allocate_many(["global_mean", "global_mean"])
+                self.assertNotIn(job_id, second.jobs_dict)
+                self.assertIsNone(second.result_store.get(job_id))
+
+                # The running jobs 2 and 3 do not block the eviction of the done jobs after them
+                for done_id in [4, 5]:
+                    first.complete_job(done_id, {"global_mean": 0})
+                self.assertTrue(first.wait_for_job(5, 5))
+                first.jobs_dict.allocate_many(["global_mean"] * 4)
+                self.assertEqual([second.jobs_dict.get(job_id) for job_id in range(2, 6)],
+                                 ["running", "running", None, None])
+            finally:
+                first.shutdown()
+                second.shutdown()
+
+    def test_37_job_store_recovery(self):
+        '''Test that a server restarted on a durable job store serves the results of the jobs
+        done before and runs again the jobs left running.'''
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        ingestor = self.server.data_ingestor
+
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.dict(os.environ, {"TP_JOB_STORE": os.path.join(directory, "jobs.db"),
+                                              "TP_NUM_OF_THREADS": "2"}):
+                first = ThreadPool(ingestor.data, ingestor)
+                data = {"question": question, "state": "Nevada", "priority": 0}
+                done_id = first.jobs_dict.allocate("state_mean", data)
+                first.submit_job([done_id, "state_mean", data])
+                self.assertTrue(first.wait_for_job(done_id, 5))
+
+                # Registered but never queued, as if the server stopped before running it
+                lost_id = first.jobs_dict.allocate("global_mean", {"question": question, "state": None})
+                self.assertEqual(first.jobs_dict.recover(), [])
+                first.shutdown()
+
+                second = ThreadPool(ingestor.data, ingestor)
+
+            try:
+                self.assertTrue(second.wait_for_job(lost_id, 5))
+                self.assertEqual(second.result_store.get(lost_id),
+                                 serialize_response(self.runner.find_global_mean(question)))
+                self.assertEqual(second.result_store.get(done_id), serialize_response({"Nevada": 30.0}))
+                self.assertEqual(second.jobs_dict.recover(), [])
+            finally:
+                second.shutdown()
+
+    def test_38_sync_mode(self):
+        '''Test that the synchronous mode answers the cheap jobs inline, without registering
+        them, and falls back to a job id for the jobs over the time budget.'''
+        data = {
+            "question": "Percent of adults aged 18 years and older who have an overweight classification",
+            "state": "Nevada"
+        }
+        pool = self.server.tasks_runner
+
+        response = self.client.post('/api/state_mean?sync=1', json=data)
+        self.assertEqual(response.json, {"status": "done", "data": {"Nevada": 30.0}})
+        response = self.client.post('/api/global_mean', json=data, headers={"X-Sync": "1"})
+        self.assertEqual(response.json, {"status": "done", "data": {"global_mean": 20.0}})
+        self.assertEqual(len(pool.jobs_dict), 0)
+
+        pool.cost_model.record("mean_by_category", 1.0)
+        job_id = self.client.post('/api/mean_by_category?sync=1', json=data).json["job_id"]
+        response = self.client.get(f'/api/get_results/{job_id}?wait=5')
+        self.assertEqual(response.json["status"], "done")
+
+        jobs = [{"job_type": "state_mean", "question": data["question"], "state": "California"},
+                {"job_type": "global_mean", "question": data["question"]}]
+        response = self.client.post('/api/batch?sync=1', json=jobs)
+        self.assertEqual(response.json["data"], [{"California": 15.0}, {"global_mean": 20.0}])
+
+    def test_39_topk(self):
+        '''Test that the heap selection of find_topk gives the slices of a full sort by mean,
+        ties included, and the /api/topk endpoint.'''
+        question = "Percent of adults aged 18 years and older who have obesity"
+        max_question = "Percent of adults who engage in muscle-strengthening activities on 2 or more days a week"
+        ingestor = DataIngestor("./test.csv", CompactDataset.from_columns({
+            "Question": [question] * 6 + [max_question] * 6,
+            "LocationDesc": ["Ohio", "Utah", "Iowa", "Ohio", "Guam", "Utah"] * 2,
+            "Data_Value": [10.0, 20.0, 20.0, 30.0, 5.0, 20.0] * 2,
+            "StratificationCategory1": ["Sex"] * 12,
+            "Stratification1": ["Male", "Male", "Female", "Female", "Male", "Female"] * 2,
+        }))
+        runner = TaskRunner(None, None, None, None, ingestor.data, ingestor)
+
+        for tested in [question, max_question]:
+            # The slices find_best5 and find_worst5 took of the fully sorted means
+            means = list(runner.find_states_mean(tested).items())
+            for k in range(6):
+                lowest, highest = means[:k], means[max(len(means) - k, 0):]
+                if tested in ingestor.questions_best_is_min:
+                    best, worst = lowest, highest[::-1]
+                else:
+                    best, worst = highest, lowest[::-1]
+                self.assertEqual(list(runner.find_topk(tested, k, "best").items()), best)
+                self.assertEqual(list(runner.find_topk(tested, k, "worst").items()), worst)
+
+        self.assertEqual(runner.find_best5(question), {"Guam": 5.0, "Ohio": 20.0, "Utah": 20.0, "Iowa": 20.0})
+        self.assertEqual(runner.find_worst5(question), {"Iowa": 20.0, "Utah": 20.0, "Ohio": 20.0, "Guam": 5.0})
+        self.assertEqual(runner.find_topk(question, 2, "worst", "stratification"),
+                         {"('Ohio', 'Sex', 'Female')": 30.0, "('Iowa', 'Sex', 'Female')": 20.0})
+
+        data = {"question": "Percent of adults aged 18 years and older who have an overweight classification",
+                "k": 1, "direction": "worst"}
+        job_id = self.client.post('/api/topk', json=data).json["job_id"]
+        response = self.client.get(f'/api/get_results/{job_id}?wait=5')
+        self.assertEqual(response.json, {"status": "done", "data": {"Nevada": 30.0}})
+
+        response = self.client.post('/api/topk', json=dict(data, group="county"))
+        self.assertEqual(response.status_code, 400)
+
+    def test_40_vectorized_groupby(self):
+        '''Test that the vectorized group-bys build the same cube, sums and key order included,
+        as adding the rows one by one, also when adding to existing aggregates.'''
+        nan = float("nan")
+        columns = {
+            "Question": ["Q2", "Q1", "Q2", "Q1", nan, "Q2"] * 2,
+            "LocationDesc": ["Utah", "Ohio", "Ohio", nan, "Utah", "Utah"] * 2,
+            "Data_Value": [0.1, 0.2, 0.7, 1e16, 3.0, nan] + [0.3, 1.0, 0.1, 2.5, 1.0, 0.2],
+            "StratificationCategory1": ["Sex", "Age", nan, "Sex", "Sex", "Sex"] * 2,
+            "Stratification1": ["Male", "18 - 24", "Male", nan, "Female", "Female"] * 2,
+        }
+
+        def add_one_by_one(cube, rows):
+            for i in rows:
+                cube.add(normalize_missing(columns["Question"][i]), normalize_missing(columns["LocationDesc"][i]),
+                         columns["StratificationCategory1"][i], columns["Stratification1"][i],
+                         columns["Data_Value"][i])
+            return cube
+
+        def encode_rows(rows):
+            return [encode_column([columns[column][i] for i in rows])
+                    for column in ["Question", "LocationDesc", "StratificationCategory1", "Stratification1"]]
+
+        expected = add_one_by_one(AggregateCube(), range(12))
+        cube = add_rows(AggregateCube(), encode_rows(range(6)), columns["Data_Value"][:6])
+        add_rows(cube, encode_rows(range(6, 12)), columns["Data_Value"][6:])
+        # json renders the NaN sums, which are not equal to themselves
+        self.assertEqual(json.dumps(cube.export()), json.dumps(expected.export()))
+
+        built = DataIngestor("./test.csv", CompactDataset.from_columns(columns))
+        self.assertEqual(json.dumps(built.cube.export()),
+                         json.dumps(add_one_by_one(AggregateCube(), [0, 2, 5, 6, 8, 11, 1, 3, 7, 9, 4, 10])
+                                    .export()))
+
+        groups, first = factorize(np.array([7, 3, 7, 9, 3]))
+        self.assertEqual(groups.tolist(), [0, 1, 0, 2, 1])
+        self.assertEqual(first.tolist(), [0, 1, 3])
+
+    def test_41_failed_jobs(self):
+        '''Test that a job raising an exception is completed with the "error" status together
+        with the identical jobs attached to it, without stopping the worker or caching the key.'''
+        data = {
+            "question": "Percent of adults aged 18 years and older who have an overweight classification",
+            "state": "Atlantis"
+        }
+        pool = self.server.tasks_runner
+
+        job_ids = [self.client.post('/api/state_diff_from_mean', json=data).json["job_id"] for _ in range(2)]
+        for job_id in job_ids:
+            response = self.client.get(f'/api/get_results/{job_id}?wait=5')
+            self.assertEqual(response.json["status"], "error")
+            self.assertIn("TypeError", response.json["data"])
+
+        self.assertEqual(pool.result_cache.in_flight, {})
+        self.assertTrue(all(thread.is_alive() for thread in pool.threads))
+        self.assertEqual(self.client.get('/api/jobs?status=error').json["data"],
+                         [{str(job_id): "error"} for job_id in job_ids])
+
+        # The worker still computes the next jobs
+        job_id = self.client.post('/api/state_mean', json=dict(data, state="Nevada")).json["job_id"]
+        response = self.client.get(f'/api/get_results/{job_id}?wait=5')
+        self.assertEqual(response.json, {"status": "done", "data": {"Nevada": 30.0}})
+
+    def test_42_dataset_views(self):
+        '''Test that a dataset unpacked without copying reads its columns through views over
+        the buffer, and can still be appended to.'''
+        dataset = self.server.data_ingestor.dataset
+        blob = bytearray(pack_dataset(dataset))
+        viewed = unpack_dataset(blob, copy=False)
+
+        self.assertIsInstance(viewed.values, memoryview)
+        question = dataset.questions[0]
+        self.assertEqual(list(viewed.rows(question)), list(dataset.rows(question)))
+
+        appended = viewed.append({"Question": [question], "LocationDesc": ["Ohio"], "Data_Value": [1.0],
+                                  "StratificationCategory1": ["Age"], "Stratification1": ["18 - 24"]})
+        self.assertEqual(list(appended.rows(question)),
+                         list(dataset.rows(question)) + [("Ohio", 1.0, "Age", "18 - 24")])
+
+    def test_43_batch_with_failed_job(self):
+        '''Test that a failing job of a batch only fails itself, the other jobs still finish.'''
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        jobs = [{"job_type": "state_mean", "question": question, "state": "Nevada"},
+                {"job_type": "state_diff_from_mean", "question": question, "state": "Atlantis"},
+                {"job_type": "global_mean", "question": question}]
+
+        job_ids = self.client.post('/api/batch', json=jobs).json["job_ids"]
+        results = [self.client.get(f'/api/get_results/{job_id}?wait=5').json for job_id in job_ids]
+
+        self.assertEqual(results[0], {"status": "done", "data": {"Nevada": 30.0}})
+        self.assertEqual(results[1]["status"], "error")
+        self.assertEqual(results[2], {"status": "done", "data": {"global_mean": 20.0}})
+
+        # In the synchronous mode, the batch falls back to jobs reporting the error
+        response = self.client.post('/api/batch?sync=1', json=jobs)
+        self.assertEqual(len(response.json["job_ids"]), 3)
+
+    def test_44_invalid_priority(self):
+        '''Test that a request with a priority that is not a number is rejected before its job
+        is registered, so that it never blocks the identical jobs.'''
+        data = {"question": "Percent of adults aged 18 years and older who have an overweight classification"}
+
+        for priority in ["high", None, True, [1]]:
+            response = self.client.post('/api/global_mean', json=dict(data, priority=priority))
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/batch', json={"jobs": [dict(data, job_type="global_mean")],
+                                                        "priority": "high"})
+        self.assertEqual(response.status_code, 400)
+        for body in [{"jobs": 5}, [1], {"job_type": "global_mean"}, "jobs", {"jobs": [None]}]:
+            response = self.client.post('/api/batch', json=body)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.server.tasks_runner.jobs_dict), 0)
+
+        job_id = self.client.post('/api/global_mean', json=dict(data, priority=2.5)).json["job_id"]
+        response = self.client.get(f'/api/get_results/{job_id}?wait=5')
+        self.assertEqual(response.json, {"status": "done", "data": {"global_mean": 20.0}})
+
+    def test_45_metrics_of_finished_threads(self):
+        '''Test that the shards of finished threads are folded into the retired totals instead
+        of piling up, without losing what they recorded.'''
+        metrics = Metrics()
+
+        def record():
+            metrics.inc("tp_jobs_submitted_total", "global_mean")
+            metrics.observe("tp_compute_seconds", "global_mean", 0.001)
+
+        for _ in range(100):
+            thread = threading.Thread(target=record)
+            thread.start()
+            thread.join()
+        del thread
+
+        counters, histograms = metrics.collect()
+        self.assertEqual(counters, {("tp_jobs_submitted_total", "global_mean"): 100})
+        self.assertEqual(sum(histograms[("tp_compute_seconds", "global_mean")][:-1]), 100)
+        self.assertEqual(metrics.shards, [])
+
+    def test_46_cube_copy_while_caching_means(self):
+        '''Test that the cube can be copied while other threads cache the means of its
+        questions.'''
+        cube = AggregateCube()
+        for question in range(2000):
+            cube.add(question, "Ohio", "Age (years)", "18 - 24", 1.0)
+        stop = threading.Event()
+
+        def cache_means():
+            while not stop.is_set():
+                for question in range(2000):
+                    cube.means(question, "state")
+                cube.means_cache.clear()
+
+        thread = threading.Thread(target=cache_means)
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        thread.start()
+        try:
+            for _ in range(200):
+                copied = cube.copy({0})
+                self.assertNotIn((0, "state"), copied.means_cache)
+        finally:
+            stop.set()
+            thread.join()
+            sys.setswitchinterval(switch_interval)
+
+    def test_47_webserver_created_once(self):
+        '''Test that threads importing the app for the first time at once create it once.'''
+        import app
+        created = []
+
+        def create_webserver():
+            time.sleep(0.05)
+            created.append(object())
+            app.__dict__["webserver"] = created[-1]
+
+        with mock.patch.dict(app.__dict__, {"create_webserver": create_webserver}):
+            del app.__dict__["webserver"]
+            imported = []
+            threads = [threading.Thread(target=lambda: imported.append(app.webserver)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(created), 1)
+        self.assertEqual(imported, created * 4)
+        self.assertIs(app.webserver, self.server)
+
+    def test_48_failed_result_write(self):
+        '''Test that a job whose result cannot be stored is completed with an error, together
+        with the identical job attached to it, and that the other jobs of its batch still finish.'''
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        jobs = [{"job_type": "global_mean", "question": question},
+                {"job_type": "global_mean", "question": question},
+                {"job_type": "state_mean", "question": question, "state": "Nevada"}]
+        pool = self.server.tasks_runner
+        pool.result_cache.clear()
+        put = pool.result_store.put
+
+        def failing_put(job_id, res, status="done"):
+            if status == "done" and "global_mean" in res:
+                raise OSError("No space left on device")
+            return put(job_id, res, status)
+
+        with mock.patch.object(pool.result_store, "put", side_effect=failing_put):
+            job_ids = self.client.post('/api/batch', json=jobs).json["job_ids"]
+            results = [self.client.get(f'/api/get_results/{job_id}?wait=5').json for job_id in job_ids]
+
+        self.assertEqual([result["status"] for result in results], ["error", "error", "done"])
+        self.assertIn("OSError", results[0]["data"])
+        self.assertEqual(results[2]["data"], {"Nevada": 30.0})
+        self.assertEqual(pool.result_cache.in_flight, {})
+
+    def test_49_job_store_kept_while_running(self):
+        '''Test that a pool shut down while a thread is still computing keeps its jobs from
+        being recovered by another server until the thread stops.'''
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        ingestor = self.server.data_ingestor
+        computing = threading.Event()
+        release = threading.Event()
+
+        def execute_task(runner, task):
+            computing.set()
+            release.wait(5)
+            return [(task, {"global_mean": 0}, 0.0)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.dict(os.environ, {"TP_JOB_STORE": os.path.join(directory, "jobs.db"),
+                                              "TP_NUM_OF_THREADS": "1", "TP_SHUTDOWN_TIMEOUT": "0.05"}), \
+                    mock.patch.object(TaskRunner, "execute_task", execute_task):
+                first = ThreadPool(ingestor.data, ingestor)
+                job_id = first.jobs_dict.allocate("global_mean", {"question": question, "state": None})
+                first.submit_job([job_id, "global_mean", {"question": question, "state": None}])
+                self.assertTrue(computing.wait(5))
+                first.shutdown()
+
+                second = ThreadPool(ingestor.data, ingestor)
+                try:
+                    self.assertEqual(second.jobs_dict.recover(), [])
+                    release.set()
+                    self.assertTrue(second.wait_for_job(job_id, 5))
+                    self.assertEqual(second.jobs_dict.recover(), [])
+                finally:
+                    second.shutdown()
+
+    def test_50_process_pool_worker_logs(self):
+        '''Test that the records logged by the worker processes are written by the web process.'''
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        ingestor = self.server.data_ingestor
+
+        with mock.patch.dict(os.environ, {"TP_NUM_OF_THREADS": "1"}), \
+                mock.patch.object(log.logger, "handle", wraps=log.logger.handle) as handle:
+            pool = ProcessPool(ingestor.data, ingestor)
+            try:
+                data = {"question": question, "state": "Atlantis", "priority": 0, "options": None}
+                job_id = pool.jobs_dict.allocate("state_diff_from_mean")
+                pool.submit_job([job_id, "state_diff_from_mean", data])
+                self.assertTrue(pool.wait_for_job(job_id, 5))
+            finally:
+                pool.shutdown()
+
+        messages = [call.args[0].getMessage() for call in handle.call_args_list]
+        self.assertTrue(any(message.startswith(f"Job {job_id} (state_diff_from_mean) failed") and "TypeError" in message
+                            for message in messages), messages)
+
     def test_99_graceful_shutdown(self):
         '''Test the graceful shutdown endpoint.'''
         response = self.client.get('api/graceful_shutdown')